@@ -6,16 +6,36 @@
 from __future__ import print_function
 from __future__ import division
 
+import fcntl
 import gzip
+import hashlib
+import json
+import math
+import mmap
 import os
+import pickle
+import platform
 import pexpect
 import re
+import resource
+import signal
+import socket
 import string
 import shutil
+import struct
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
 import time
 
+# pexpect 4 runs the child using ptyprocess
+try:
+    import ptyprocess
+except ImportError:
+    ptyprocess = None
+
 # Deal with gratuitous urllib changes in Python 3
 
 if sys.version_info >= (3, 13, 0):
@@ -29,6 +49,15 @@ else:
     import urllib as good_old_urllib
     import urlparse as good_old_urlparse
 
+# And to the HTTP server modules
+
+if sys.version_info[0] >= 3:
+    import http.server as good_old_httpserver
+    import socketserver as good_old_socketserver
+else:
+    import BaseHTTPServer as good_old_httpserver
+    import SocketServer as good_old_socketserver
+
 # Find a function for quoting shell commands
 try:
     from shlex import quote as sh_quote
@@ -59,11 +88,19 @@ netbsd_archive_url = "https://archive.netbsd.org/pub/NetBSD-archive/"
 # 'kernel_name' list, rather than using sysinst.  If multiple
 # kernel names are listed, the first one present in the release
 # is used.
+#
+# The qemu 'max_cpus' property is the largest number of virtual CPUs
+# to give the guest by default; ports without it get a single CPU.
+# The 'host_machines' property lists the host machine types (as
+# reported by uname -m or uname -p) on which the guest can run using
+# hardware virtualization rather than emulation.
 
 arch_props = {
     'i386': {
         'qemu': {
             'executable': 'qemu-system-i386',
+            'max_cpus': 4,
+            'host_machines': ['i386', 'i486', 'i586', 'i686', 'x86_64', 'amd64'],
         },
         'scratch_disk': 'wd1d',
         'boot_from_default': 'floppy',
@@ -72,6 +109,8 @@ arch_props = {
     'amd64': {
         'qemu': {
             'executable': 'qemu-system-x86_64',
+            'max_cpus': 8,
+            'host_machines': ['x86_64', 'amd64'],
         },
         'scratch_disk': 'wd1d',
         'memory_size': '192M',
@@ -104,6 +143,8 @@ arch_props = {
         'qemu': {
             'executable': 'qemu-system-aarch64',
             'machine_default': 'virt',
+            'max_cpus': 4,
+            'host_machines': ['aarch64', 'arm64'],
         },
         'image_name': 'arm64.img.gz',
         'kernel_name': ['netbsd-GENERIC64.img.gz'],
@@ -161,6 +202,7 @@ arch_props = {
         'qemu': {
             'executable': 'qemu-system-riscv64',
             'machine_default': 'virt',
+            'max_cpus': 4,
         },
         'image_name': 'riscv64.img.gz',
         'kernel_name': ['netbsd-GENERIC64.gz'],
@@ -211,6 +253,68 @@ def try_program(argv):
    except OSError:
        return False
 
+# Return the number of CPUs available to us on the host
+
+def host_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+# Return the set of names the host machine type goes by, e.g.,
+# "x86_64" on Linux or "amd64" on NetBSD.  On some systems, like
+# NetBSD/evbarm, the CPU architecture is reported by uname -p only.
+
+def host_machines():
+    return set([m for m in (os.uname()[4], platform.processor()) if m])
+
+# Functions for checking whether the host supports a given hardware
+# accelerator and we have the permissions needed to use it
+
+def host_has_kvm():
+    return os.uname()[0] == 'Linux' and \
+        os.access('/dev/kvm', os.R_OK | os.W_OK)
+
+def host_has_nvmm():
+    return os.uname()[0] == 'NetBSD' and \
+        os.access('/dev/nvmm', os.R_OK | os.W_OK)
+
+def host_has_hvf():
+    if os.uname()[0] != 'Darwin':
+        return False
+    try:
+        output = subprocess.check_output(['sysctl', '-n', 'kern.hv_support'],
+                                         stderr = fnull)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return output.strip() == b'1'
+
+# The hardware accelerators we know how to use with qemu, in order of
+# preference
+
+qemu_hw_accels = [
+    ('kvm', host_has_kvm),
+    ('nvmm', host_has_nvmm),
+    ('hvf', host_has_hvf),
+]
+
+# Return the set of accelerators supported by the given qemu
+# executable, or None if it is too old to tell us.
+
+def qemu_accels(qemu):
+    try:
+        output = subprocess.check_output([qemu, '-accel', 'help'],
+                                         stderr = fnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    # The first line is a heading like "Accelerators supported in
+    # QEMU binary:"
+    lines = output.decode('ASCII', 'ignore').splitlines()[1:]
+    return set([l.strip() for l in lines if re.match(r'\s*\w+\s*$', l)])
+
 # Create a directory if missing
 
 def mkdir_p(dir):
@@ -224,17 +328,131 @@ def rm_f(fn):
     except:
         pass
 
+# Return the total size of the files in a directory tree, in bytes
+
+def tree_size(dir):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(dir):
+        for fn in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, fn)).st_size
+            except OSError:
+                pass
+    return total
+
+# Return the amount of memory available for new allocations on the
+# host without swapping, in bytes, or None if not known
+
+def host_mem_available():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                m = re.match(r'MemAvailable:\s+(\d+) kB', line)
+                if m:
+                    return int(m.group(1)) * 1024
+    except IOError:
+        pass
+    return None
+
 # Create a hard link, removing the destination first
 def ln_f(src, dst):
     rm_f(dst)
     os.link(src, dst)
 
+# Recreate the directory tree "src" as "dst" using hard links,
+# copying the files where they cannot be linked
+
+def link_tree(src, dst):
+    for dirpath, dirnames, filenames in os.walk(src):
+        dstdir = os.path.join(dst, os.path.relpath(dirpath, src))
+        mkdir_p(dstdir)
+        for fn in filenames:
+            try:
+                ln_f(os.path.join(dirpath, fn), os.path.join(dstdir, fn))
+            except OSError:
+                shutil.copyfile(os.path.join(dirpath, fn), os.path.join(dstdir, fn))
+
 # Uncompress a file
 def gunzip(src, dst):
     with gzip.open(src, 'rb') as srcf:
         with open(dst, 'wb') as dstf:
             shutil.copyfileobj(srcf, dstf)
 
+# Return the command for running the NetBSD tool "name", such as
+# makefs or installboot.  On a non-NetBSD host, the tools need to be
+# cross-built and installed in the PATH with an "nb" prefix, as done
+# by build.sh.
+
+def netbsd_tool(name):
+    if os.uname()[0] == 'NetBSD':
+        return '/usr/sbin/' + name
+    else:
+        return 'nb' + name
+
+# Encode a path name for use in an mtree specification file, escaping
+# white space, non-ASCII characters, and characters special to mtree
+# as octal
+
+def mtree_vis(name):
+    if sys.version_info[0] >= 3:
+        b = name.encode('UTF-8', 'surrogateescape')
+    else:
+        b = bytearray(name)
+    return ''.join([chr(c) if c > 32 and c < 127 and not chr(c) in '\\#*?[' \
+                    else '\\%03o' % c for c in b])
+
+# Return the contents of a NetBSD entropy seed file as saved by
+# "rndctl -S", containing "nbytes" bytes of entropy from the host.
+# The format is that of a little-endian rndsave_t: the amount
+# of entropy in bits, 512 bytes of data, and a SHA-1 digest of
+# the preceding fields.
+
+def make_entropy_file(nbytes):
+    f = open("/dev/random", "rb")
+    data = f.read(nbytes)
+    f.close()
+    assert(len(data) == nbytes)
+    header = struct.pack('<I', nbytes * 8)
+    data = data + b"\000" * (512 - nbytes)
+    return header + data + hashlib.sha1(header + data).digest()
+
+# Return a disklabel(8) prototype file for a disk of "total_sectors"
+# sectors with the given partitions, each a tuple of (letter, size,
+# offset, fstype), with sizes and offsets in sectors
+
+def disklabel_proto(total_sectors, partitions):
+    sectors = 63
+    tracks = 16
+    lines = [
+        "type: ESDI",
+        "disk: anita",
+        "label: anita",
+        "bytes/sector: 512",
+        "sectors/track: %d" % sectors,
+        "tracks/cylinder: %d" % tracks,
+        "sectors/cylinder: %d" % (sectors * tracks),
+        "cylinders: %d" % (total_sectors // (sectors * tracks)),
+        "total sectors: %d" % total_sectors,
+        "rpm: 3600",
+        "interleave: 1",
+        "",
+        "%d partitions:" % len(partitions),
+    ]
+    for letter, size, offset, fstype in partitions:
+        lines.append(" %s: %d %d %s" % (letter, size, offset, fstype))
+    return '\n'.join(lines) + '\n'
+
+# Remove a directory tree that may contain read-only directories
+
+def rm_tree(dir):
+    def onerror(func, path, exc_info):
+        os.chmod(os.path.dirname(path), 0o755)
+        if os.path.isdir(path) and not os.path.islink(path):
+            os.chmod(path, 0o755)
+        func(path)
+    if os.path.exists(dir):
+        shutil.rmtree(dir, onerror = onerror)
+
 # Quote a shell command.  This is intended to make it possible to
 # manually cut and paste logged command into a shell.
 
@@ -264,12 +482,62 @@ def spawn(command, args):
 class pexpect_spawn_log(pexpect.spawn):
     def __init__(self, logf, *args, **kwargs):
         self.structured_log_f = logf
+        # The Watchdog watching the expect() calls, if any
+        self.watchdog = None
         return super(pexpect_spawn_log, self).__init__(*args, **kwargs)
     def expect(self, pattern, *args, **kwargs):
         slog(self.structured_log_f, "expect", pattern, timestamp = False);
-        r = pexpect.spawn.expect(self, pattern, *args, **kwargs)
+        if self.watchdog and self.watchdog.applies(pattern, args, kwargs):
+            timeout = args[0] if args else kwargs.get('timeout', -1)
+            r = self.watchdog.expect(self, pattern, timeout)
+        else:
+            r = pexpect.spawn.expect(self, pattern, *args, **kwargs)
         slog(self.structured_log_f, "match", self.match.group(0), timestamp = False);
         return r
+    if ptyprocess:
+        def _spawnpty(self, args, **kwargs):
+            return polled_ptyprocess.spawn(args, **kwargs)
+
+# Subclass ptyprocess.PtyProcess so that the delayafterclose and
+# delayafterterminate delays become upper bounds on the time to wait
+# for the child to exit rather than fixed delays.  This matters
+# because they need to be long for the benefit of slow-exiting VMMs,
+# but most of the time the VMM exits promptly.
+
+if ptyprocess:
+    class polled_ptyprocess(ptyprocess.PtyProcess):
+        # Wait for the child to exit for at most "seconds" seconds.
+        # Returns true if it exited.
+        def wait_exit(self, seconds):
+            deadline = time.time() + seconds
+            while self.isalive():
+                if time.time() >= deadline:
+                    return False
+                time.sleep(0.1)
+            return True
+        def close(self, force = True):
+            if not self.closed:
+                self.flush()
+                self.fileobj.close()
+                if not self.wait_exit(self.delayafterclose):
+                    if not self.terminate(force):
+                        raise ptyprocess.PtyProcessError('Could not terminate the child.')
+                self.fd = -1
+                self.closed = True
+        def terminate(self, force = False):
+            if not self.isalive():
+                return True
+            sigs = [signal.SIGHUP, signal.SIGCONT, signal.SIGINT]
+            if force:
+                sigs.append(signal.SIGKILL)
+            try:
+                for sig in sigs:
+                    self.kill(sig)
+                    if self.wait_exit(self.delayafterterminate):
+                        return True
+                return False
+            except OSError:
+                return self.wait_exit(self.delayafterterminate)
 
 if sys.version_info < (3, 13, 0):
     # Subclass urllib.FancyURLopener so that we can catch
@@ -288,6 +556,28 @@ def my_urlretrieve(url, filename):
             good_old_urllib.urlcleanup()
     return r
 
+# Get the bytes "start" through "end" (inclusive) of "url" using an
+# HTTP range request, returning the data and the total size of the
+# file.  Raises IOError if the server does not support ranges.
+
+def http_get_range(url, start, end):
+    try:
+        from urllib.request import Request, urlopen
+    except ImportError:
+        from urllib2 import Request, urlopen
+    f = urlopen(Request(url, headers = {'Range': 'bytes=%d-%d' % (start, end)}))
+    try:
+        content_range = f.info().get('Content-Range') or ''
+        m = re.match(r'bytes (\d+)-(\d+)/(\d+)$', content_range.strip())
+        if not m or int(m.group(1)) != start:
+            raise IOError("%s: range requests not supported" % url)
+        data = f.read()
+    finally:
+        f.close()
+    if len(data) != int(m.group(2)) - start + 1:
+        raise IOError("%s: short read" % url)
+    return data, int(m.group(3))
+
 # Download a file, cleaning up the partial file if the transfer
 # fails or is aborted before completion.
 
@@ -318,6 +608,45 @@ def make_sparse_image(fn, size):
     f.write(b"\000")
     f.close()
 
+# Fill an existing image file of the given size with NULs, without
+# truncating it first, so that any holes are allocated.  This may be
+# done while a VMM has the image open, as long as the guest has not
+# written to it yet.  If the threading.Event "cancel" is set, give up
+# with an exception.
+
+def densify_image(fn, size, cancel = None):
+    f = open(fn, "r+b")
+    blocksize = 64 * 1024
+    while size > 0:
+        if cancel and cancel.is_set():
+            f.close()
+            raise RuntimeError("cancelled")
+        chunk = min(size, blocksize)
+        f.write(b"\000" * chunk)
+        size = size - chunk
+    f.close()
+
+# Copy the image file "src" to "dst".  If "sparse" is true, blocks
+# of NULs are not written, leaving holes in the copy.
+
+def copy_image(src, dst, sparse):
+    blocksize = 64 * 1024
+    zeros = b"\000" * blocksize
+    fi = open(src, "rb")
+    fo = open(dst, "wb")
+    while True:
+        data = fi.read(blocksize)
+        if not data:
+            break
+        if sparse and data == zeros[:len(data)]:
+            fo.seek(len(data), 1)
+        else:
+            fo.write(data)
+    # Extend the file if it ends in a hole
+    fo.truncate()
+    fo.close()
+    fi.close()
+
 def make_image(fn, size, format):
     if format == 'dense':
         f = make_dense_image
@@ -398,6 +727,117 @@ else:
     def is_real_error(url, e):
         return False
 
+# Parse a checksum file in the BSD format of the SHA512 and MD5 files
+# of NetBSD releases, returning a dict mapping each file name to a
+# tuple of the hashlib algorithm name and the hex digest
+
+def parse_checksum_file(fn):
+    r = {}
+    f = open(fn, 'r')
+    for line in f:
+        m = re.match(r'(\w+) \((.*)\) = ([0-9a-fA-F]+)$', line.strip())
+        if m:
+            r[m.group(2)] = (m.group(1).lower(), m.group(3).lower())
+    f.close()
+    return r
+
+# Return the hex digest of the file "fn" using the hashlib algorithm
+# "alg".  The file is mapped into memory rather than read, and hashlib
+# releases the global interpreter lock while hashing it, so that
+# several files can be hashed in parallel by threads.
+
+def file_digest(fn, alg):
+    h = hashlib.new(alg)
+    f = open(fn, 'rb')
+    try:
+        if os.fstat(f.fileno()).st_size > 0:
+            m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            try:
+                h.update(m)
+            finally:
+                m.close()
+    finally:
+        f.close()
+    return h.hexdigest()
+
+# A persistent cache of file digests, stored as JSON in the file
+# "path", so that files already verified need not be hashed again.
+# Entries are keyed by the path of the file and are valid only as
+# long as its size and modification time are unchanged.
+
+class ChecksumCache(object):
+    # Serializes saving, as the cache file may be shared by several
+    # distributions in the same process
+    save_lock = threading.Lock()
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self.load()
+    def load(self):
+        try:
+            f = open(self.path, 'r')
+            try:
+                return json.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            return {}
+    def key(self, fn):
+        st = os.stat(fn)
+        return [st.st_size, st.st_mtime]
+    def digest(self, fn, alg):
+        key = self.key(fn)
+        with self.lock:
+            entry = self.entries.get(os.path.abspath(fn))
+        if entry and entry[:2] == key and entry[2] == alg:
+            return entry[3]
+        digest = file_digest(fn, alg)
+        with self.lock:
+            self.entries[os.path.abspath(fn)] = key + [alg, digest]
+        return digest
+    def forget(self, fn):
+        with self.lock:
+            self.entries.pop(os.path.abspath(fn), None)
+    # Save the cache, merging in any entries saved by others in the
+    # meantime
+    def save(self):
+        with self.save_lock:
+            entries = self.load()
+            with self.lock:
+                entries.update(self.entries)
+            tmp = self.path + '.tmp.%d' % os.getpid()
+            f = open(tmp, 'w')
+            json.dump(entries, f, sort_keys = True)
+            f.close()
+            os.rename(tmp, self.path)
+
+# Verify the files "files", a list of (path, algorithm, hex digest)
+# tuples, up to "jobs" at a time, using the ChecksumCache "cache".
+# Returns the list of paths of the files that do not match.
+
+def verify_checksums(files, cache, jobs):
+    queue = list(files)
+    bad = []
+    lock = threading.Lock()
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                fn, alg, expected = queue.pop(0)
+            if cache.digest(fn, alg) != expected:
+                with lock:
+                    bad.append(fn)
+    if not files:
+        return []
+    tasks = [BackgroundTask(worker) for i in range(min(jobs, len(files)))]
+    for task in tasks:
+        task.done.wait()
+    for task in tasks:
+        task.check()
+    cache.save()
+    return [f[0] for f in files if f[0] in bad]
+
 # Map a URL to a directory name.  No two URLs should map to the same
 # directory.
 
@@ -412,8 +852,9 @@ def url2dir(url):
         return "-"
     return "work-" + re.sub(bad_chars_re, munge, url) + "+" + "".join(tail)
 
-# Inverse of the above; not used, but included just to show that the
-# mapping is invertible and therefore collision-free
+# Inverse of the above, showing that the mapping is invertible and
+# therefore collision-free.  Used by the garbage collector to report
+# which distribution a work directory belongs to.
 
 class InvalidDir(Exception):
     pass
@@ -476,6 +917,1197 @@ def gather_input(child, seconds):
     except pexpect.TIMEOUT:
         pass
 
+# Receive and log input from the child until it has been quiet for
+# "quiet" seconds, or for at most "ceiling" seconds.  Like
+# gather_input(), the input is left in the buffer.  Returns the
+# time waited, in seconds.
+
+def wait_for_quiet(child, quiet, ceiling):
+    start = time.time()
+    while True:
+        remaining = ceiling - (time.time() - start)
+        if remaining <= 0:
+            break
+        n = len(child.buffer)
+        gather_input(child, min(quiet, remaining))
+        if len(child.buffer) == n:
+            break
+    return time.time() - start
+
+# An incremental VT100/xterm screen emulator, tracking the text on
+# the screen and which characters are in reverse video.  It is fed
+# the console output by making it one of the logfile_read files of
+# the child, so that the state of curses based programs like sysinst
+# can be queried directly instead of matching their output, which
+# curses optimizes by redrawing only the parts of the screen that
+# changed.
+
+class Screen(object):
+    # DEC special graphics characters (line drawing), as ASCII
+    graphics = {'j': '+', 'k': '+', 'l': '+', 'm': '+', 'n': '+',
+                't': '+', 'u': '+', 'v': '+', 'w': '+',
+                'q': '-', 'x': '|', 'a': '#', '`': '+', '~': 'o'}
+    def __init__(self, rows = 24, cols = 80):
+        self.rows = rows
+        self.cols = cols
+        self.reset()
+    def reset(self):
+        self.cells = [self.blank_row() for i in range(self.rows)]
+        self.row = 0
+        self.col = 0
+        self.wrap_pending = False
+        self.reverse = False
+        self.top = 0
+        self.bottom = self.rows - 1
+        self.saved = (0, 0, False)
+        # Whether G0 and G1 are DEC special graphics, and whether G1
+        # is shifted in
+        self.g_graphics = [False, False]
+        self.shifted = False
+        self.state = 'normal'
+        self.params = ''
+    def blank_row(self):
+        return [(' ', False) for i in range(self.cols)]
+    # The file interface used by pexpect
+    def write(self, data):
+        for b in bytearray(data):
+            self.feed(chr(b))
+    def flush(self):
+        pass
+    def feed(self, c):
+        if self.state == 'normal':
+            self.feed_normal(c)
+        elif self.state == 'esc':
+            self.state = 'normal'
+            self.feed_esc(c)
+        elif self.state == 'csi':
+            if '\x30' <= c <= '\x3f':
+                self.params += c
+            elif '\x40' <= c <= '\x7e':
+                self.state = 'normal'
+                self.feed_csi(c)
+            elif c == '\x1b':
+                self.state = 'esc'
+        elif self.state in ('g0', 'g1'):
+            self.g_graphics[self.state == 'g1'] = (c == '0')
+            self.state = 'normal'
+        elif self.state == 'osc':
+            if c in '\x07\x1b':
+                self.state = 'normal'
+        else:
+            # Skip the character after ESC #
+            self.state = 'normal'
+    def feed_normal(self, c):
+        if c == '\x1b':
+            self.state = 'esc'
+        elif c == '\r':
+            self.move(self.row, 0)
+        elif c in '\n\x0b\x0c':
+            self.index()
+        elif c == '\b':
+            self.move(self.row, self.col - 1)
+        elif c == '\t':
+            self.move(self.row, (self.col // 8 + 1) * 8)
+        elif c == '\x0e':
+            self.shifted = True
+        elif c == '\x0f':
+            self.shifted = False
+        elif c < ' ' or c == '\x7f':
+            pass
+        else:
+            if self.wrap_pending:
+                self.move(self.row, 0)
+                self.index()
+            if self.g_graphics[self.shifted]:
+                c = self.graphics.get(c, c)
+            self.cells[self.row][self.col] = (c, self.reverse)
+            if self.col == self.cols - 1:
+                self.wrap_pending = True
+            else:
+                self.col += 1
+    def feed_esc(self, c):
+        if c == '[':
+            self.state = 'csi'
+            self.params = ''
+        elif c in '()':
+            self.state = ['g0', 'g1'][c == ')']
+        elif c == ']':
+            self.state = 'osc'
+        elif c == '#':
+            self.state = 'skip'
+        elif c == '7':
+            self.saved = (self.row, self.col, self.reverse)
+        elif c == '8':
+            row, col, self.reverse = self.saved
+            self.move(row, col)
+        elif c == 'D':
+            self.index()
+        elif c == 'E':
+            self.move(self.row, 0)
+            self.index()
+        elif c == 'M':
+            if self.row == self.top:
+                self.scroll(self.top, self.bottom, -1)
+            else:
+                self.move(self.row - 1, self.col)
+        elif c == 'c':
+            self.reset()
+    def feed_csi(self, final):
+        private = self.params.startswith('?') or self.params.startswith('>')
+        args = [int(a) if a.isdigit() else None
+                for a in self.params.lstrip('?>').split(';')]
+        def arg(i, default = 1):
+            if i < len(args) and args[i]:
+                return args[i]
+            return default
+        if private:
+            # Modes and queries, which do not change the screen
+            return
+        if final == 'A':
+            self.move(max(self.row - arg(0), 0), self.col)
+        elif final == 'B':
+            self.move(self.row + arg(0), self.col)
+        elif final == 'C':
+            self.move(self.row, self.col + arg(0))
+        elif final == 'D':
+            self.move(self.row, self.col - arg(0))
+        elif final in 'Hf':
+            self.move(arg(0) - 1, arg(1) - 1)
+        elif final in 'G`':
+            self.move(self.row, arg(0) - 1)
+        elif final == 'd':
+            self.move(arg(0) - 1, self.col)
+        elif final == 'J':
+            mode = arg(0, 0)
+            if mode == 0:
+                self.erase(self.row, self.col, self.cols)
+                rows = range(self.row + 1, self.rows)
+            elif mode == 1:
+                self.erase(self.row, 0, self.col + 1)
+                rows = range(0, self.row)
+            else:
+                rows = range(0, self.rows)
+            for row in rows:
+                self.cells[row] = self.blank_row()
+        elif final == 'K':
+            mode = arg(0, 0)
+            if mode == 0:
+                self.erase(self.row, self.col, self.cols)
+            elif mode == 1:
+                self.erase(self.row, 0, self.col + 1)
+            else:
+                self.erase(self.row, 0, self.cols)
+        elif final == 'X':
+            self.erase(self.row, self.col, self.col + arg(0))
+        elif final == 'm':
+            for a in args:
+                if not a:
+                    self.reverse = False
+                elif a == 7:
+                    self.reverse = True
+                elif a == 27:
+                    self.reverse = False
+        elif final == 'r':
+            self.top = arg(0) - 1
+            self.bottom = min(arg(1, self.rows), self.rows) - 1
+            self.move(0, 0)
+        elif final in 'LM' and self.top <= self.row <= self.bottom:
+            self.scroll(self.row, self.bottom, arg(0) * [-1, 1][final == 'M'])
+        elif final == 'S':
+            self.scroll(self.top, self.bottom, arg(0))
+        elif final == 'T':
+            self.scroll(self.top, self.bottom, -arg(0))
+        elif final in '@P':
+            line = self.cells[self.row]
+            n = min(arg(0), self.cols - self.col)
+            if final == '@':
+                line[self.col:] = [(' ', False)] * n + line[self.col:self.cols - n]
+            else:
+                line[self.col:] = line[self.col + n:] + [(' ', False)] * n
+    # Move the cursor, clamped to the screen
+    def move(self, row, col):
+        self.row = max(0, min(row, self.rows - 1))
+        self.col = max(0, min(col, self.cols - 1))
+        self.wrap_pending = False
+    # Move the cursor down one line, scrolling at the bottom of the
+    # scrolling region
+    def index(self):
+        self.wrap_pending = False
+        if self.row == self.bottom:
+            self.scroll(self.top, self.bottom, 1)
+        elif self.row < self.rows - 1:
+            self.row += 1
+    # Scroll rows "top" through "bottom" up by "n" lines (down if
+    # negative)
+    def scroll(self, top, bottom, n):
+        region = self.cells[top:bottom + 1]
+        n = max(-len(region), min(n, len(region)))
+        if n > 0:
+            region = region[n:] + [self.blank_row() for i in range(n)]
+        elif n < 0:
+            region = [self.blank_row() for i in range(-n)] + region[:n]
+        self.cells[top:bottom + 1] = region
+    def erase(self, row, start, end):
+        for col in range(start, min(end, self.cols)):
+            self.cells[row][col] = (' ', False)
+    # Return the text of row "row"
+    def line(self, row):
+        return ''.join([c for c, reverse in self.cells[row]])
+    # Return the text of the screen, one line per row
+    def text(self):
+        return '\n'.join([self.line(row).rstrip() for row in range(self.rows)])
+    # Search the screen text for the regular expression "pattern"
+    def search(self, pattern):
+        return re.search(pattern, self.text(), re.M)
+    # Return the menu items visible on the screen, like "c: Base  Yes",
+    # as a list of (letter, label, value, selected, row, col) tuples,
+    # where letter, label, and value are bytes, value is the
+    # Yes/No/All/None column or None if absent, selected is true if
+    # the item is highlighted, and row and col are the position of
+    # the letter
+    def menu_items(self):
+        items = []
+        for row in range(self.rows):
+            line = self.line(row)
+            for m in re.finditer(r'(?:^|[^A-Za-z0-9])([a-z]): ' +
+                                 r'([^ |+]+(?: [^ |+]+)*)' +
+                                 r'(?:\s\s+(Yes|No|All|None)\b)?', line):
+                selected = self.cells[row][m.start(1)][1]
+                value = m.group(3)
+                if value is not None:
+                    value = value.encode('ASCII')
+                items.append((m.group(1).encode('ASCII'),
+                              m.group(2).encode('latin-1'), value, selected,
+                              row, m.start(1)))
+        return items
+
+# A local copy of the file at "url" that is filled in on demand by
+# HTTP range requests, and in the background by prefetching the rest
+# of the file in order.  The copy is kept in "path" + ".part", with a
+# map of the chunks present in "path" + ".map" so that a later run
+# can pick up where this one left off, and is renamed to "path" when
+# complete.
+
+class StreamedImage(object):
+    chunk_size = 1024 * 1024
+    def __init__(self, url, path):
+        self.url = url
+        self.path = path
+        self.part_path = path + '.part'
+        self.map_path = path + '.map'
+        dummy, self.size = http_get_range(url, 0, 0)
+        self.n_chunks = (self.size + self.chunk_size - 1) // self.chunk_size
+        self.present = bytearray(self.n_chunks)
+        if os.path.exists(self.part_path) and os.path.exists(self.map_path) and \
+           os.path.getsize(self.part_path) == self.size:
+            f = open(self.map_path, 'rb')
+            saved = bytearray(f.read())
+            f.close()
+            if len(saved) == self.n_chunks:
+                self.present = saved
+        else:
+            mkdir_p(os.path.dirname(os.path.abspath(path)))
+            make_sparse_image(self.part_path, self.size)
+        self.f = open(self.part_path, 'r+b')
+        # Protects self.present, self.fetching, and the file position
+        self.lock = threading.Lock()
+        # Events for the chunks being fetched, by chunk number
+        self.fetching = {}
+        self.complete = False
+        self.closed = False
+        self.prefetch_thread = threading.Thread(target = self.prefetch)
+        self.prefetch_thread.daemon = True
+        self.prefetch_thread.start()
+    def chunks_present(self):
+        return sum([1 for c in self.present if c])
+    # Make sure chunk "c" is present, fetching it if needed.  If
+    # another thread is already fetching it, wait for that instead.
+    def fetch(self, c):
+        with self.lock:
+            if self.present[c]:
+                return
+            event = self.fetching.get(c)
+            mine = event is None
+            if mine:
+                event = self.fetching[c] = threading.Event()
+        if not mine:
+            event.wait()
+            if not self.present[c]:
+                raise IOError("could not fetch %s" % self.url)
+            return
+        try:
+            start = c * self.chunk_size
+            end = min(start + self.chunk_size, self.size) - 1
+            data, size = http_get_range(self.url, start, end)
+            with self.lock:
+                self.f.seek(start)
+                self.f.write(data)
+                self.present[c] = 1
+        finally:
+            with self.lock:
+                del self.fetching[c]
+            event.set()
+    def read(self, offset, length):
+        if length == 0:
+            return b''
+        for c in range(offset // self.chunk_size,
+                       (offset + length - 1) // self.chunk_size + 1):
+            self.fetch(c)
+        with self.lock:
+            self.f.seek(offset)
+            return self.f.read(length)
+    def save_map(self):
+        with self.lock:
+            data = bytes(self.present)
+        f = open(self.map_path, 'wb')
+        f.write(data)
+        f.close()
+    def prefetch(self):
+        try:
+            for c in range(self.n_chunks):
+                if self.closed:
+                    return
+                self.fetch(c)
+                if c % 64 == 63:
+                    self.save_map()
+        except Exception as e:
+            print("warning: prefetching %s failed: %s" % (self.url, e),
+                  file=sys.stderr)
+            return
+        # Complete; the open file remains usable after the rename
+        with self.lock:
+            self.f.flush()
+            os.rename(self.part_path, self.path)
+            rm_f(self.map_path)
+            self.complete = True
+    def close(self):
+        self.closed = True
+        self.prefetch_thread.join()
+        if not self.complete:
+            self.save_map()
+        self.f.close()
+
+# A read-only NBD server (using the fixed newstyle handshake) on a
+# Unix domain socket, for attaching "image" to qemu.  The image is
+# any object with a "size" attribute and a read(offset, length)
+# method, such as a StreamedImage.  Each connection is served by a
+# thread of its own.
+
+class NBDServer(object):
+    NBDMAGIC = b'NBDMAGIC'
+    IHAVEOPT = b'IHAVEOPT'
+    REPLY_MAGIC = 0x3e889045565a9
+    REQUEST_MAGIC = 0x25609513
+    SIMPLE_REPLY_MAGIC = 0x67446698
+    OPT_EXPORT_NAME, OPT_ABORT, OPT_INFO, OPT_GO = 1, 2, 6, 7
+    REP_ACK, REP_INFO, REP_ERR_UNSUP = 1, 3, 2 ** 31 + 1
+    CMD_READ, CMD_WRITE, CMD_DISC, CMD_FLUSH = 0, 1, 2, 3
+    FLAG_FIXED_NEWSTYLE, FLAG_NO_ZEROES = 1, 2
+    # Transmission flags: has flags, read only, and flush supported
+    transmission_flags = 1 | 2 | 4
+    def __init__(self, image, log):
+        self.image = image
+        self.log = log
+        self.dir = tempfile.mkdtemp(prefix = 'anita-nbd-')
+        self.path = os.path.join(self.dir, 'nbd.sock')
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(4)
+        self.closed = False
+        self.thread = threading.Thread(target = self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+    # The qemu file name for connecting to the server
+    def qemu_uri(self):
+        return 'nbd:unix:' + self.path
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
+        self.sock.close()
+        shutil.rmtree(self.dir, ignore_errors = True)
+    def serve(self):
+        while not self.closed:
+            try:
+                conn, addr = self.sock.accept()
+            except (socket.error, OSError):
+                break
+            t = threading.Thread(target = self.connection, args = (conn,))
+            t.daemon = True
+            t.start()
+    def recv_exactly(self, conn, n):
+        data = b''
+        while len(data) < n:
+            more = conn.recv(n - len(data))
+            if not more:
+                raise EOFError()
+            data += more
+        return data
+    def connection(self, conn):
+        try:
+            if self.handshake(conn):
+                self.transmission(conn)
+        except EOFError:
+            pass
+        except Exception as e:
+            self.log("nbd: %s" % e)
+        finally:
+            conn.close()
+    def reply(self, conn, option, type, data = b''):
+        conn.sendall(struct.pack('>QIII', self.REPLY_MAGIC, option, type, len(data)) + data)
+    # Negotiate the options, returning true if the client wants to
+    # proceed to the transmission phase
+    def handshake(self, conn):
+        conn.sendall(self.NBDMAGIC + self.IHAVEOPT +
+                     struct.pack('>H', self.FLAG_FIXED_NEWSTYLE | self.FLAG_NO_ZEROES))
+        client_flags = struct.unpack('>I', self.recv_exactly(conn, 4))[0]
+        while True:
+            magic, option, length = struct.unpack('>8sII', self.recv_exactly(conn, 16))
+            if magic != self.IHAVEOPT:
+                return False
+            # There is only one export, so the export name and any
+            # information requests in the option data are ignored
+            self.recv_exactly(conn, length)
+            if option == self.OPT_EXPORT_NAME:
+                conn.sendall(struct.pack('>QH', self.image.size, self.transmission_flags) +
+                             [b'\0' * 124, b''][client_flags & self.FLAG_NO_ZEROES != 0])
+                return True
+            elif option in (self.OPT_INFO, self.OPT_GO):
+                # NBD_INFO_EXPORT: the size and transmission flags
+                self.reply(conn, option, self.REP_INFO,
+                           struct.pack('>HQH', 0, self.image.size, self.transmission_flags))
+                self.reply(conn, option, self.REP_ACK)
+                if option == self.OPT_GO:
+                    return True
+            elif option == self.OPT_ABORT:
+                self.reply(conn, option, self.REP_ACK)
+                return False
+            else:
+                self.reply(conn, option, self.REP_ERR_UNSUP)
+    def transmission(self, conn):
+        while True:
+            magic, flags, type, handle, offset, length = \
+                struct.unpack('>IHHQQI', self.recv_exactly(conn, 28))
+            if magic != self.REQUEST_MAGIC:
+                return
+            error = 0
+            data = b''
+            if type == self.CMD_READ:
+                if offset + length > self.image.size:
+                    error = 22 # EINVAL
+                else:
+                    try:
+                        data = self.image.read(offset, length)
+                    except Exception as e:
+                        self.log("nbd: read error: %s" % e)
+                        error = 5 # EIO
+                        data = b''
+            elif type == self.CMD_WRITE:
+                self.recv_exactly(conn, length)
+                error = 1 # EPERM
+            elif type == self.CMD_DISC:
+                return
+            elif type == self.CMD_FLUSH:
+                pass
+            else:
+                error = 22 # EINVAL
+            conn.sendall(struct.pack('>IIQ', self.SIMPLE_REPLY_MAGIC, error, handle) + data)
+
+# A connection to the QEMU Machine Protocol (QMP) server of a qemu
+# process, for controlling qemu without going through the monitor
+# multiplexed on the console.  Asynchronous events received while
+# waiting for command responses are kept in the "events" list.
+
+class QMP(object):
+    def __init__(self, path, timeout = 10):
+        self.events = []
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # qemu creates the socket shortly after starting
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.sock.connect(path)
+                break
+            except socket.error:
+                if time.time() >= deadline:
+                    self.sock.close()
+                    raise
+                time.sleep(0.1)
+        self.sock.settimeout(timeout)
+        self.f = self.sock.makefile('rb')
+        # Read the greeting and enter command mode
+        self.read()
+        self.command('qmp_capabilities')
+    def read(self):
+        line = self.f.readline()
+        if not line:
+            raise RuntimeError("QMP connection closed")
+        return json.loads(line.decode('UTF-8'))
+    # Execute the QMP command "name" with the arguments in the dict
+    # "args", and return its return value
+    def command(self, name, args = None):
+        msg = {'execute': name}
+        if args:
+            msg['arguments'] = args
+        self.sock.sendall((json.dumps(msg) + "\n").encode('UTF-8'))
+        while True:
+            r = self.read()
+            if 'event' in r:
+                self.events.append(r)
+            elif 'error' in r:
+                raise RuntimeError("QMP command %s failed: %s" %
+                                   (name, r['error'].get('desc')))
+            elif 'return' in r:
+                return r['return']
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+# The exit status of the anita command when the watchdog fires
+
+watchdog_exit_status = 124
+
+# Raised when the watchdog detects a panic, an unexpected firmware
+# prompt, or a hang
+
+class WatchdogError(RuntimeError):
+    pass
+
+# Patterns indicating that the guest has crashed, at any time
+watchdog_crash_patterns = [
+    r'db\{\d+\}> ',
+    r'(?m)^panic: ',
+]
+
+# Patterns indicating that the guest has unexpectedly rebooted or
+# dropped into the firmware, once the system is up and running
+watchdog_firmware_patterns = [
+    r'SeaBIOS \(version',
+    r'>> NetBSD/\S+ BIOS Boot',
+    r'\r\n0 > ',
+]
+
+# The phases of a run whose durations are recorded in the history
+# and used for deriving timeouts.  The "command" phase is not, as
+# its duration depends on the commands run.
+
+history_phases = ['install', 'boot', 'tests', 'halt']
+
+# The phases of a run for the purposes of the watchdog, and for
+# each, the maximum time the console may remain silent, and whether
+# to watch for firmware prompts.  Phases not listed here, like
+# halting the system or interacting with the console, are not
+# watched.
+
+watchdog_phases = {
+    'install': (1800, False),
+    'boot': (900, False),
+    'command': (None, True),
+    'tests': (3600, True),
+}
+
+# A watchdog for the expect() calls on a child, which in addition to
+# the patterns being expected, watches for signs that the guest has
+# crashed or hung, and if so, calls the function "hit" with the child,
+# a description of the problem, and its kind: "ddb", "panic",
+# "firmware", or "hang".  "hit" should raise an exception.
+
+class Watchdog(object):
+    def __init__(self, hit):
+        self.hit = hit
+        self.phase = None
+        # The time limit for the current phase as a whole, if any,
+        # and the corresponding deadline
+        self.phase_limit = None
+        self.phase_deadline = None
+        # True while the watchdog is handling a hit, to keep it
+        # from watching the expect() calls made by the handler
+        self.busy = False
+    def set_phase(self, phase, limit = None):
+        self.phase = phase
+        self.phase_limit = limit
+        self.phase_deadline = None
+        if limit is not None:
+            self.phase_deadline = time.time() + limit
+    # Return true if the watchdog should watch an expect() call with
+    # the given arguments
+    def applies(self, pattern, args, kwargs):
+        if self.busy or not self.phase in watchdog_phases:
+            return False
+        if len(args) > 1 or [k for k in kwargs if k != 'timeout']:
+            return False
+        patterns = pattern if isinstance(pattern, list) else [pattern]
+        return not pexpect.TIMEOUT in patterns
+    def expect(self, child, pattern, timeout):
+        patterns = pattern if isinstance(pattern, list) else [pattern]
+        inactivity, firmware = watchdog_phases[self.phase]
+        watch_patterns = watchdog_crash_patterns[:]
+        if firmware:
+            watch_patterns += watchdog_firmware_patterns
+        if timeout == -1:
+            timeout = child.timeout
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            t = None
+            if deadline is not None:
+                t = max(deadline - time.time(), 0)
+            if inactivity is not None and (t is None or t > inactivity):
+                t = inactivity
+            if self.phase_deadline is not None:
+                phase_t = max(self.phase_deadline - time.time(), 0)
+                if t is None or t > phase_t:
+                    t = phase_t
+            n = len(child.buffer)
+            try:
+                i = pexpect.spawn.expect(child, patterns + watch_patterns, t)
+            except pexpect.TIMEOUT:
+                if self.phase_deadline is not None and \
+                   time.time() >= self.phase_deadline:
+                    self.handle_hit(child, "%s took longer than %d seconds" %
+                                    (self.phase, self.phase_limit), 'hang')
+                if deadline is not None and time.time() >= deadline:
+                    raise
+                if len(child.buffer) == n:
+                    self.handle_hit(child, "no console output for %d seconds "
+                                    "during %s" % (inactivity, self.phase),
+                                    'hang')
+                continue
+            if i < len(patterns):
+                return i
+            kind = ('ddb', 'panic')[i - len(patterns)] \
+                if i - len(patterns) < len(watchdog_crash_patterns) else 'firmware'
+            self.handle_hit(child, "saw %r during %s" %
+                            (child.match.group(0), self.phase), kind)
+    def handle_hit(self, child, what, kind):
+        self.busy = True
+        try:
+            self.hit(child, what, kind)
+        finally:
+            self.busy = False
+        # In case "hit" did not raise an exception
+        raise WatchdogError(what)
+
+# Timeouts for the phases of a run are derived from the durations
+# of the same phase in at least history_min_samples past runs on the
+# same port and VMM: the history_percentile percentile of the
+# durations, times history_safety_factor, but no less than
+# history_min_timeout seconds.
+
+history_min_samples = 5
+history_max_samples = 100
+history_percentile = 95
+history_safety_factor = 3.0
+history_min_timeout = 30
+
+# Return the "p" percentile of the list of numbers "values", using
+# the nearest-rank method
+
+def percentile(values, p):
+    values = sorted(values)
+    rank = max(int(math.ceil(p / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+# A local SQLite database of the history of past runs: the
+# configuration, outcome, and host resource usage of each run, the
+# durations of its phases, and the results of the individual test
+# cases.  The schema is upgraded in place as needed, with the
+# version kept in the "user_version" pragma.
+
+class History(object):
+    def __init__(self, fn):
+        import sqlite3
+        # Wait for other anita processes sharing the database
+        self.db = sqlite3.connect(fn, timeout = 60)
+        # Write-ahead logging makes the commits done on every run
+        # cheap and lets readers run concurrently with writers
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.upgrade()
+    def upgrade(self):
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            self.db.execute("CREATE TABLE phases (arch TEXT, vmm TEXT, " +
+                            "phase TEXT, start REAL, duration REAL)")
+            self.db.execute("CREATE INDEX phases_key ON phases (arch, vmm, phase)")
+            version = 1
+        if version < 2:
+            self.db.execute("CREATE TABLE runs (id INTEGER PRIMARY KEY, " +
+                            "url TEXT, arch TEXT, vmm TEXT, accel TEXT, " +
+                            "options TEXT, start REAL, end REAL, " +
+                            "outcome TEXT, tests_status INTEGER, " +
+                            "boot_to_login REAL, user_time REAL, " +
+                            "system_time REAL, max_child_rss INTEGER)")
+            self.db.execute("ALTER TABLE phases ADD COLUMN run_id INTEGER")
+            self.db.execute("CREATE TABLE tests (run_id INTEGER, " +
+                            "program TEXT, name TEXT, result TEXT, " +
+                            "duration REAL, reason TEXT)")
+            self.db.execute("CREATE INDEX tests_run ON tests (run_id)")
+            self.db.execute("CREATE INDEX tests_case ON tests (program, name)")
+            version = 2
+        self.db.execute("PRAGMA user_version = %d" % version)
+        self.db.commit()
+    # Record the start of a run, returning its ID
+    def start_run(self, url, arch, vmm, options):
+        c = self.db.execute("INSERT INTO runs (url, arch, vmm, options, start) " +
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (url, arch, vmm, json.dumps(options, sort_keys = True),
+                             time.time()))
+        self.db.commit()
+        return c.lastrowid
+    # Set columns of the runs table for the run "run_id" from the
+    # dict "values"
+    def update_run(self, run_id, values):
+        keys = sorted(values.keys())
+        self.db.execute("UPDATE runs SET " +
+                        ", ".join(["%s = ?" % k for k in keys]) +
+                        " WHERE id = ?",
+                        [values[k] for k in keys] + [run_id])
+        self.db.commit()
+    def add_phase(self, run_id, arch, vmm, phase, start, duration):
+        self.db.execute("INSERT INTO phases (run_id, arch, vmm, phase, start, duration) " +
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (run_id, arch, vmm, phase, start, duration))
+        self.db.commit()
+    # Add test case results, as returned by parse_atf_tps()
+    def add_tests(self, run_id, results):
+        self.db.executemany("INSERT INTO tests (run_id, program, name, " +
+                            "result, duration, reason) VALUES (?, ?, ?, ?, ?, ?)",
+                            [(run_id,) + tuple(r) for r in results])
+        self.db.commit()
+    # Return the durations of the most recent instances of a phase
+    def phase_durations(self, arch, vmm, phase):
+        rows = self.db.execute("SELECT duration FROM phases " +
+                               "WHERE arch = ? AND vmm = ? AND phase = ? " +
+                               "ORDER BY start DESC LIMIT ?",
+                               (arch, vmm, phase, history_max_samples))
+        return [row[0] for row in rows]
+    # Return the timeout for a phase derived from its past durations,
+    # or None if there is not enough history
+    def phase_timeout(self, arch, vmm, phase):
+        durations = self.phase_durations(arch, vmm, phase)
+        if len(durations) < history_min_samples:
+            return None
+        return max(percentile(durations, history_percentile) *
+                   history_safety_factor, history_min_timeout)
+
+    # Queries for the "anita history" command.  Each returns a list
+    # of column headings and a list of rows.
+
+    # The test cases with the longest average duration
+    def slowest(self, limit = 20):
+        return (['arch', 'test program', 'test case', 'average', 'max', 'runs'],
+                self.db.execute("SELECT r.arch, t.program, t.name, " +
+                                "AVG(t.duration), MAX(t.duration), COUNT(*) " +
+                                "FROM tests t JOIN runs r ON t.run_id = r.id " +
+                                "GROUP BY r.arch, t.program, t.name " +
+                                "ORDER BY AVG(t.duration) DESC LIMIT ?",
+                                (limit,)).fetchall())
+    # The URLs of the distributions most recently tested, newest first
+    def tested_urls(self, limit):
+        return [row[0] for row in
+                self.db.execute("SELECT r.url FROM runs r " +
+                                "WHERE EXISTS (SELECT * FROM tests t " +
+                                "WHERE t.run_id = r.id) " +
+                                "GROUP BY r.url ORDER BY MAX(r.start) DESC " +
+                                "LIMIT ?", (limit,))]
+    # The passing test cases whose average duration has grown by
+    # more than "factor" and at least "min_increase" seconds between
+    # the runs of the distributions "old_url" and "new_url"
+    def regressions(self, old_url, new_url, factor = 1.5, min_increase = 1.0,
+                    limit = 20):
+        return (['arch', 'test program', 'test case', 'old', 'new'],
+                self.db.execute("SELECT * FROM (" +
+                                "SELECT r.arch, t.program, t.name, " +
+                                "AVG(CASE WHEN r.url = ? THEN t.duration END) AS o, " +
+                                "AVG(CASE WHEN r.url = ? THEN t.duration END) AS n " +
+                                "FROM tests t JOIN runs r ON t.run_id = r.id " +
+                                "WHERE r.url IN (?, ?) AND t.result = 'passed' " +
+                                "GROUP BY r.arch, t.program, t.name) " +
+                                "WHERE n > o * ? AND n - o >= ? " +
+                                "ORDER BY n - o DESC LIMIT ?",
+                                (old_url, new_url, old_url, new_url,
+                                 factor, min_increase, limit)).fetchall())
+    # The test cases that have both passed and failed when testing
+    # the same distribution, with the number of such distributions
+    def flaky(self, limit = 20):
+        return (['arch', 'test program', 'test case', 'builds', 'passed', 'failed'],
+                self.db.execute("SELECT arch, program, name, COUNT(*), " +
+                                "SUM(p), SUM(f) FROM (" +
+                                "SELECT r.url, r.arch, t.program, t.name, " +
+                                "SUM(t.result = 'passed') AS p, " +
+                                "SUM(t.result = 'failed') AS f " +
+                                "FROM tests t JOIN runs r ON t.run_id = r.id " +
+                                "GROUP BY r.url, r.arch, t.program, t.name " +
+                                "HAVING p > 0 AND f > 0) " +
+                                "GROUP BY arch, program, name " +
+                                "ORDER BY COUNT(*) DESC, SUM(f) DESC LIMIT ?",
+                                (limit,)).fetchall())
+    def close(self):
+        self.db.close()
+
+# Parse the output of atf-run in the file "fn", returning a list of
+# test case results, each a tuple of the test program (relative to
+# /usr/tests), test case name, result, duration in seconds, and
+# reason for the result (or None)
+
+def parse_atf_tps(fn):
+    results = []
+    program = None
+    tc_start = None
+    f = open(fn, 'rb')
+    for line in f:
+        # The reasons may contain arbitrary output of the tests
+        line = line.decode('utf-8', 'replace')
+        m = re.match(r'tp-start: ([\d.]+), (\S+), \d+', line)
+        if m:
+            program = re.sub(r'^/usr/tests/', '', m.group(2))
+            continue
+        m = re.match(r'tc-start: ([\d.]+), (\S+)', line)
+        if m:
+            tc_start = float(m.group(1))
+            continue
+        m = re.match(r'tc-end: ([\d.]+), ([^,]+), (\w+)(, (.*))?', line)
+        if m and program is not None:
+            duration = None
+            if tc_start is not None:
+                duration = float(m.group(1)) - tc_start
+            results.append((program, m.group(2), m.group(3), duration,
+                            m.group(5)))
+            tc_start = None
+    f.close()
+    return results
+
+# Run a function in a background thread.  Any exception raised by
+# the function is re-raised in the caller of check().
+
+class BackgroundTask(object):
+    def __init__(self, func):
+        self.exc_info = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target = self.run, args = (func,))
+        self.thread.daemon = True
+        self.thread.start()
+    def run(self, func):
+        try:
+            func()
+        except:
+            self.exc_info = sys.exc_info()
+        finally:
+            self.done.set()
+    def check(self):
+        if self.exc_info:
+            raise self.exc_info[1]
+
+# Return the path of the file "name" in the directory "root", or None
+# if it would be outside the directory
+
+def path_in_dir(root, name):
+    parts = [p for p in name.split('/') if p not in ('', '.')]
+    if '..' in parts:
+        return None
+    return os.path.join(root, *parts)
+
+# An HTTP request handler serving the files in the directory tree
+# "self.server.root", supporting byte range requests, for installing
+# the sets over the network
+
+class DistHTTPRequestHandler(good_old_httpserver.BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.serve(False)
+    def do_GET(self):
+        self.serve(True)
+    def serve(self, send_body):
+        path = good_old_urllib.unquote(self.path.split('?')[0])
+        fn = path_in_dir(self.server.root, path)
+        if fn is None or not os.path.isfile(fn):
+            self.send_error(404)
+            return
+        size = os.path.getsize(fn)
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header:
+            # Only a single byte range is supported
+            m = re.match(r'bytes=(\d*)-(\d*)$', range_header.strip())
+            if m and m.group(1):
+                start = int(m.group(1))
+                if m.group(2):
+                    end = min(int(m.group(2)), size - 1)
+            elif m and m.group(2):
+                start = max(0, size - int(m.group(2)))
+            if not m or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        self.end_headers()
+        if not send_body:
+            return
+        f = open(fn, 'rb')
+        try:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(remaining, 256 * 1024))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+        finally:
+            f.close()
+    def log_message(self, format, *args):
+        self.server.log("http: %s %s" % (self.address_string(), format % args))
+
+class DistHTTPServer(good_old_socketserver.ThreadingMixIn,
+                     good_old_httpserver.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+# A TFTP server (RFC 1350) serving the files in the directory tree
+# "root" and receiving only the files named by the keys of the dict
+# "uploads", into the host files given by its values, with
+# support for the blksize, tsize, timeout, and windowsize options
+# (RFC 2347, 2348, 2349, and 7440).  Each transfer is handled by a
+# thread of its own.
+
+class TFTPServer(object):
+    RRQ, WRQ, DATA, ACK, ERROR, OACK = range(1, 7)
+    def __init__(self, root, uploads, addr, log):
+        self.root = root
+        self.uploads = uploads
+        self.log = log
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(addr)
+        self.port = self.sock.getsockname()[1]
+        self.closed = False
+        self.thread = threading.Thread(target = self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+    def close(self):
+        self.closed = True
+        self.sock.close()
+    def serve(self):
+        while not self.closed:
+            try:
+                packet, peer = self.sock.recvfrom(65536)
+            except (socket.error, OSError):
+                break
+            t = threading.Thread(target = self.transfer, args = (packet, peer))
+            t.daemon = True
+            t.start()
+    def transfer(self, packet, peer):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind((self.sock.getsockname()[0], 0))
+            self.handle(sock, packet, peer)
+        except Exception as e:
+            self.log("tftp: %s: %s" % (peer[0], e))
+        finally:
+            sock.close()
+    def send_error(self, sock, peer, code, message):
+        sock.sendto(struct.pack('!HH', self.ERROR, code) +
+                    message.encode('ASCII') + b'\0', peer)
+    def handle(self, sock, packet, peer):
+        opcode = struct.unpack('!H', packet[:2])[0]
+        fields = packet[2:].split(b'\0')
+        if opcode not in (self.RRQ, self.WRQ) or len(fields) < 2:
+            self.send_error(sock, peer, 4, "illegal TFTP operation")
+            return
+        name = fields[0].decode('ASCII', 'replace')
+        if fields[1].lower() != b'octet':
+            self.send_error(sock, peer, 0, "only octet mode is supported")
+            return
+        requested = {}
+        for i in range(2, len(fields) - 1, 2):
+            requested[fields[i].decode('ASCII', 'replace').lower()] = \
+                fields[i + 1].decode('ASCII', 'replace')
+        blksize = 512
+        windowsize = 1
+        timeout = 1.0
+        accepted = []
+        if 'blksize' in requested:
+            blksize = max(8, min(int(requested['blksize']), 65464))
+            accepted.append(('blksize', blksize))
+        if 'windowsize' in requested:
+            windowsize = max(1, min(int(requested['windowsize']), 64))
+            accepted.append(('windowsize', windowsize))
+        if 'timeout' in requested:
+            timeout = float(max(1, min(int(requested['timeout']), 255)))
+            accepted.append(('timeout', int(timeout)))
+        sock.settimeout(timeout)
+        if opcode == self.RRQ:
+            fn = path_in_dir(self.root, name)
+            if fn is None or not os.path.isfile(fn):
+                self.send_error(sock, peer, 1, "file not found")
+                return
+            if 'tsize' in requested:
+                accepted.append(('tsize', os.path.getsize(fn)))
+            self.log("tftp: %s: sending %s" % (peer[0], name))
+            f = open(fn, 'rb')
+            try:
+                self.send_file(sock, peer, f, blksize, windowsize, accepted)
+            finally:
+                f.close()
+        else:
+            # Uploads replace any existing file only once complete
+            fn = self.uploads.get(name)
+            if fn is None:
+                self.send_error(sock, peer, 2, "access violation")
+                return
+            if 'tsize' in requested:
+                accepted.append(('tsize', int(requested['tsize'])))
+            self.log("tftp: %s: receiving %s" % (peer[0], name))
+            f = open(fn + '.tmp', 'wb')
+            try:
+                ok = self.receive_file(sock, peer, f, blksize, windowsize, accepted)
+            finally:
+                f.close()
+            if ok:
+                os.rename(fn + '.tmp', fn)
+            else:
+                rm_f(fn + '.tmp')
+    def oack(self, accepted):
+        return struct.pack('!H', self.OACK) + \
+            b''.join([("%s\0%s\0" % (k, v)).encode('ASCII') for k, v in accepted])
+    # Send the packets "packets" until a packet from the peer is
+    # received, up to "retries" times, and return the packet
+    # received, or None if there was none
+    def exchange(self, sock, peer, packets, retries = 5):
+        for i in range(retries):
+            for p in packets:
+                sock.sendto(p, peer)
+            try:
+                while True:
+                    reply, addr = sock.recvfrom(65536)
+                    if addr == peer:
+                        return reply
+            except socket.timeout:
+                pass
+        return None
+    def send_file(self, sock, peer, f, blksize, windowsize, accepted):
+        # The block number of the last block acknowledged
+        acked = 0
+        if accepted:
+            reply = self.exchange(sock, peer, [self.oack(accepted)])
+            if reply is None or struct.unpack('!HH', reply[:4]) != (self.ACK, 0):
+                return
+        last = None
+        while True:
+            # Send a window of blocks starting after the last one
+            # acknowledged
+            packets = []
+            for n in range(acked + 1, acked + 1 + windowsize):
+                if last is not None and n > last:
+                    break
+                f.seek((n - 1) * blksize)
+                data = f.read(blksize)
+                if len(data) < blksize:
+                    last = n
+                packets.append(struct.pack('!HH', self.DATA, n & 0xffff) + data)
+            reply = self.exchange(sock, peer, packets)
+            if reply is None:
+                raise RuntimeError("timed out")
+            opcode, block = struct.unpack('!HH', reply[:4])
+            if opcode == self.ERROR:
+                raise RuntimeError("transfer aborted by the client")
+            if opcode != self.ACK:
+                continue
+            # The acknowledged block number is 16 bits and wraps
+            # around; find the block in the window it refers to
+            delta = (block - acked) & 0xffff
+            if delta <= len(packets):
+                acked += delta
+            if last is not None and acked >= last:
+                return
+    def receive_file(self, sock, peer, f, blksize, windowsize, accepted):
+        if accepted:
+            reply = self.oack(accepted)
+        else:
+            reply = struct.pack('!HH', self.ACK, 0)
+        received = 0
+        in_window = 0
+        while True:
+            if reply is None:
+                # In the middle of a window, wait for the next block
+                # without sending anything
+                packet = self.exchange(sock, peer, [], 1)
+            else:
+                packet = self.exchange(sock, peer, [reply])
+            if packet is None:
+                if reply is None:
+                    # Have the client resend the rest of the window
+                    reply = struct.pack('!HH', self.ACK, received & 0xffff)
+                    continue
+                return False
+            opcode, block = struct.unpack('!HH', packet[:4])
+            if opcode == self.ERROR:
+                return False
+            if opcode != self.DATA:
+                continue
+            data = packet[4:]
+            if block == (received + 1) & 0xffff:
+                f.write(data)
+                received += 1
+                in_window += 1
+                if len(data) < blksize:
+                    sock.sendto(struct.pack('!HH', self.ACK, block), peer)
+                    return True
+                if in_window < windowsize:
+                    reply = None
+                    continue
+            # Acknowledge the last block received in order, at the
+            # end of a window, or to have the client resend from
+            # there after a loss
+            in_window = 0
+            reply = struct.pack('!HH', self.ACK, received & 0xffff)
+
+# The built-in distribution server: an HTTP server for installing
+# the sets, and a TFTP server for booting and receiving the test
+# results as given by "uploads" (see TFTPServer), both listening on
+# the address "addr" only and running in background threads
+
+class DistServer(object):
+    def __init__(self, root, uploads, addr, http_port, tftp_port, log):
+        self.http = DistHTTPServer((addr, http_port), DistHTTPRequestHandler)
+        self.http.root = root
+        self.http.log = log
+        self.http_port = self.http.server_address[1]
+        self.http_thread = threading.Thread(target = self.http.serve_forever)
+        self.http_thread.daemon = True
+        self.http_thread.start()
+        try:
+            self.tftp = TFTPServer(root, uploads, (addr, tftp_port), log)
+        except:
+            self.http.shutdown()
+            self.http.server_close()
+            raise
+        self.tftp_port = self.tftp.port
+    def close(self):
+        self.http.shutdown()
+        self.http.server_close()
+        self.tftp.close()
+
+# Wait for the threading.Event "event" to be set, while logging any
+# input from the child.  Returns the time waited, in seconds.
+
+def gather_input_until(child, event):
+    start = time.time()
+    while not event.is_set():
+        gather_input(child, 0.1)
+    return time.time() - start
+
 # Reverse the order of sublists of v of length sublist_len
 # for which the predicate pred is true.
 
@@ -504,12 +2136,114 @@ def reverse_virtio_drives(v):
             and sublist[3].startswith('virtio-blk-device')
     reverse_sublists(v, 4, is_virtio_blk)
 
+# The NIC models selectable using the nic_model option, and for
+# each, the qemu device model and the name of the corresponding
+# NetBSD driver
+
+qemu_nic_models = {
+    'e1000': ('e1000', 'wm'),
+    'virtio': ('virtio-net-pci', 'vioif'),
+}
+
+# The disk I/O policies, as qemu drive attributes.  The "throwaway"
+# policy is for disks whose contents don't matter if the host crashes,
+# such as snapshotted system disks: it ignores flushes and passes
+# discards through to the image file.  The "durable" policy honors
+# flushes from the guest.  The "throttled" policy is like "durable"
+# but also applies the I/O limits given by the disk_iops and disk_bps
+# options, to keep many concurrent VMs from starving each other.
+# io_uring is added to the "throwaway" policy when available.
+
+disk_io_policies = {
+    'throwaway': [('cache', 'unsafe'), ('discard', 'unmap')],
+    'durable': [('cache', 'writeback')],
+    'throttled': [('cache', 'writeback')],
+}
+
+# Return the qemu version as a tuple of integers, or None if unknown
+
+def qemu_version(qemu):
+    try:
+        output = subprocess.check_output([qemu, '--version'], stderr = fnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    m = re.search(r'version (\d+)\.(\d+)', output.decode('ASCII', 'ignore'))
+    if not m:
+        return None
+    return tuple(int(n) for n in m.groups())
+
+# Return true if qemu can use io_uring for disk I/O on this host.
+# That requires Linux 5.1 or newer with io_uring not disabled for us,
+# qemu 5.0 or newer built with io_uring support, and no seccomp
+# profile (such as that of a container) blocking it, so after the
+# cheap checks, try opening a file using io_uring in a qemu with no
+# machine that quits right away.
+
+def qemu_has_io_uring(qemu):
+    if os.uname()[0] != 'Linux':
+        return False
+    m = re.match(r'(\d+)\.(\d+)', os.uname()[2])
+    if not m or tuple(int(n) for n in m.groups()) < (5, 1):
+        return False
+    try:
+        with open('/proc/sys/kernel/io_uring_disabled') as f:
+            disabled = f.read().strip()
+        # 1 means allowed only for privileged processes
+        if disabled == '2' or disabled == '1' and os.geteuid() != 0:
+            return False
+    except IOError:
+        pass
+    version = qemu_version(qemu)
+    if version is None or version < (5, 0):
+        return False
+    fd, probe_fn = tempfile.mkstemp(prefix = 'anita-io_uring-')
+    try:
+        os.write(fd, b"\000" * 512)
+        os.close(fd)
+        try:
+            p = subprocess.Popen([qemu, '-nodefaults', '-machine', 'none',
+                                  '-display', 'none', '-S', '-monitor', 'stdio',
+                                  '-blockdev', qemu_format_attrs([
+                                      ('driver', 'file'),
+                                      ('node-name', 'probe'),
+                                      ('filename', probe_fn),
+                                      ('aio', 'io_uring'),
+                                      ('read-only', 'on')])],
+                                 stdin = subprocess.PIPE,
+                                 stdout = subprocess.PIPE,
+                                 stderr = subprocess.STDOUT)
+        except OSError:
+            return False
+        if sys.version_info >= (3, 3):
+            # Don't let a qemu hanging in the io_uring setup hang us
+            try:
+                p.communicate(b"quit\n", timeout = 30)
+            except subprocess.TimeoutExpired:
+                p.kill()
+                p.communicate()
+                return False
+        else:
+            p.communicate(b"quit\n")
+        return p.returncode == 0
+    finally:
+        rm_f(probe_fn)
+
 # Format at set of key-value pairs as used in qemu command line options.
 # Takes a sequence of tuples.
 
 def qemu_format_attrs(attrs):
     return ','.join(["%s=%s" % pair for pair in attrs])
 
+# Return the qemu arguments "args" with the image files and their
+# formats removed from the drive options, leaving the description of
+# the virtual hardware that a saved guest state can be restored into.
+# This allows for media having been changed, such as the sets CD of
+# a pipelined install being inserted only after the guest has booted.
+
+def qemu_hardware_args(args):
+    return [re.sub(r'(?:^|,)(?:file|format)=[^,]*', '', arg).lstrip(',')
+            for arg in args]
+
 #############################################################################
 
 # A NetBSD version.
@@ -625,8 +2359,14 @@ class Version(object):
 
     flat_sets = flatten_set_dict_list(sets)
 
-    def __init__(self, sets = None):
+    def __init__(self, sets = None, download_dir = None):
         self.tempfiles = []
+        self.m_checksum_cache = None
+        # Where to build the install sets ISO, if not the work directory
+        self.sets_iso_dir = None
+        # The download directory, if shared with other ports of the
+        # same release rather than in the work directory
+        self.download_dir = download_dir
         if sets is not None:
             if not any([re.match(r'kern-', s) for s in sets]):
                 raise RuntimeError("no kernel set specified")
@@ -647,13 +2387,20 @@ class Version(object):
         self.workdir = dir
     # The directory where we mirror files needed for installation
     def download_local_mi_dir(self):
+        if self.download_dir:
+            return os.path.join(self.download_dir, '')
         return self.workdir + "/download/"
     def download_local_arch_dir(self):
         return self.download_local_mi_dir() + self.arch() + "/"
     # The path to the install sets ISO image, which
     # may or may not also be the install boot ISO
     def install_sets_iso_path(self):
-        return os.path.join(self.workdir, self.install_sets_iso_name())
+        return os.path.join(self.sets_iso_dir or self.workdir,
+                            self.install_sets_iso_name())
+    # True if the install sets ISO is built by us from the downloaded
+    # files, as opposed to being downloaded itself
+    def sets_iso_is_generated(self):
+        return True
     # The path to the ISO used for booting an installed
     # macppc system (not to be confused with the installation
     # boot ISO)
@@ -720,8 +2467,13 @@ class Version(object):
             except:
                 pass
 
+    # True if the set "setname" is machine independent, that is,
+    # the same for all ports
+    def set_is_mi(self, setname):
+        return re.match(r'.*src$', setname) is not None
+
     def set_path(self, setname, ext):
-        if re.match(r'.*src$', setname):
+        if self.set_is_mi(setname):
             return ['source', 'sets', setname + ext]
         else:
             return [self.arch(), 'binary', 'sets', setname + ext]
@@ -740,35 +2492,45 @@ class Version(object):
         # Deal with architectures that we don't know how to install
         # using sysinst, but instead use a pre-installed image
         if 'image_name' in arch_props[self.arch()]:
-            download_if_missing_3(self.dist_url(), self.download_local_arch_dir(), ["binary", "gzimg", arch_props[self.arch()]['image_name']])
+            got = []
+            self.fetch(got, self.dist_url(), self.download_local_arch_dir(), ["binary", "gzimg", arch_props[self.arch()]['image_name']])
             for file in arch_props[self.arch()]['kernel_name']:
-                if download_if_missing_3(self.dist_url(), self.download_local_arch_dir(), ["binary", "kernel", file], True):
+                if self.fetch(got, self.dist_url(), self.download_local_arch_dir(), ["binary", "kernel", file], True):
                     break
+            self.verify_downloads(got)
             # Nothing more to do as we aren't doing a full installation
             return
 
+        self.download_boot_media()
+        self.download_sets()
+
+    # Download the files needed to boot the installer, but not
+    # the sets, so that the installer can be started while the sets
+    # are still being downloaded
+    def download_boot_media(self):
+        got = []
         if self.arch() in ['hpcmips', 'landisk', 'macppc', 'alpha']:
-            download_if_missing_3(self.dist_url(), self.download_local_arch_dir(), ["binary", "kernel", "netbsd-GENERIC.gz"])
+            self.fetch(got, self.dist_url(), self.download_local_arch_dir(), ["binary", "kernel", "netbsd-GENERIC.gz"])
 
         # Download installation kernel if needed
         inst_kernel_prop = arch_props[self.arch()].get('inst_kernel')
         if inst_kernel_prop is not None:
-            download_if_missing_3(self.dist_url(), self.download_local_arch_dir(),
-                                  inst_kernel_prop.split(os.path.sep))
+            self.fetch(got, self.dist_url(), self.download_local_arch_dir(),
+                       inst_kernel_prop.split(os.path.sep))
 
         i = 0
         # Depending on the NetBSD version, there may be two or more
         # boot floppies.  Treat any floppies past the first two as
         # optional files.
         for floppy in self.potential_floppies():
-            download_if_missing_3(self.dist_url(),
+            self.fetch(got, self.dist_url(),
                 self.download_local_arch_dir(),
                 ["installation", "floppy", floppy],
                 True)
             i = i + 1
 
         for bootcd in (self.boot_isos()):
-            download_if_missing_3(self.dist_url(),
+            self.fetch(got, self.dist_url(),
                 self.download_local_arch_dir(),
                 ["installation", "cdrom", bootcd],
                 True)
@@ -777,28 +2539,120 @@ class Version(object):
         if self.arch() in ['i386', 'amd64']:
             # Must be optional so that we can still install NetBSD 4.0
             # where it doesn't exist yet.
-            download_if_missing_3(self.dist_url(),
+            self.fetch(got, self.dist_url(),
                 self.download_local_arch_dir(),
                 ["installation", "misc", "pxeboot_ia32.bin"],
                 True)
-            download_if_missing_3(self.dist_url(),
+            self.fetch(got, self.dist_url(),
                 self.download_local_arch_dir(),
                 ["binary", "kernel", "netbsd-INSTALL.gz"],
                 True)
+        self.verify_downloads(got)
 
+    # Download the installation sets, or if "mi_only" is true, only
+    # the machine independent ones.  If the threading.Event "cancel"
+    # is set, give up with an exception before the next set.
+    def download_sets(self, mi_only = False, cancel = None):
+        got = []
         for set in self.flat_sets:
+            if mi_only and not self.set_is_mi(set['filename']):
+                continue
+            if cancel and cancel.is_set():
+                raise RuntimeError("cancelled")
             if set['install']:
                 present = [
-                    download_if_missing_3(self.mi_url(),
-                                          self.download_local_mi_dir(),
-                                          self.set_path(set['filename'],
-                                                        ext),
-                                          True)
+                    self.fetch(got, self.mi_url(),
+                               self.download_local_mi_dir(),
+                               self.set_path(set['filename'],
+                                             ext),
+                               True)
                     for ext in set_exts
                 ]
                 if not set['optional'] and not any(present):
                     raise RuntimeError('install set %s does not exist with extension %s' %
                                        (set['filename'], ' nor '.join(set_exts)))
+        self.verify_downloads(got)
+
+    # Download like download_if_missing_3(), adding the file to the
+    # list "got" if present, for verification by verify_downloads()
+    def fetch(self, got, urlbase, dirbase, relpath, optional = False):
+        present = download_if_missing_3(urlbase, dirbase, relpath, optional)
+        if present:
+            got.append((urlbase, dirbase, relpath))
+        return present
+
+    # The cache of the digests of the downloaded files
+    def checksum_cache(self):
+        if self.m_checksum_cache is None:
+            self.m_checksum_cache = ChecksumCache(
+                os.path.normpath(self.download_local_mi_dir()) + '.checksums')
+        return self.m_checksum_cache
+
+    # Return the checksums of the files in the directory "reldir" of
+    # a download tree, as parsed by parse_checksum_file(), from the
+    # SHA512 or failing that, MD5 file of the directory, or None if
+    # there is neither.  With "refresh", download the checksum file
+    # again rather than use the one downloaded earlier.
+    def download_checksums(self, urlbase, dirbase, reldir, refresh = False):
+        for sumfile in ('SHA512', 'MD5'):
+            fn = os.path.join(*([dirbase] + reldir + [sumfile]))
+            if refresh:
+                rm_f(fn)
+                rm_f(fn + ".MISSING")
+            if download_if_missing_3(urlbase, dirbase, reldir + [sumfile], True):
+                return parse_checksum_file(fn)
+        return None
+
+    # Verify the downloaded files "got", as collected by fetch(),
+    # against the checksum files of the directories they were
+    # downloaded from, in parallel.  If files do not match, the
+    # checksum files may be out of date, as when a daily build has
+    # been replaced, so they are downloaded again, and the files
+    # still not matching are downloaded again too.  If they still do
+    # not match, the release is presumably being updated under us,
+    # and we give up.
+    def verify_downloads(self, got):
+        dirs = {}
+        for urlbase, dirbase, relpath in got:
+            dirs.setdefault((urlbase, dirbase, tuple(relpath[:-1])), []).append(relpath[-1])
+        # Return the (path, algorithm, digest) tuples of the files
+        # "names" in a directory with checksums
+        def expected(dirbase, reldir, names, sums):
+            return [(os.path.join(*([dirbase] + list(reldir) + [name])),) + sums[name]
+                    for name in names if name in sums]
+        cache = self.checksum_cache()
+        files = []
+        for (urlbase, dirbase, reldir), names in dirs.items():
+            sums = self.download_checksums(urlbase, dirbase, list(reldir))
+            if sums is not None:
+                files += expected(dirbase, reldir, names, sums)
+        bad = verify_checksums(files, cache, host_cpus())
+        if not bad:
+            return
+        # Check all the files of the directories with mismatches
+        # against the new checksums, as files that matched the old
+        # ones may be out of date as well
+        files = []
+        for (urlbase, dirbase, reldir), names in dirs.items():
+            if not [name for name in names
+                    if os.path.join(*([dirbase] + list(reldir) + [name])) in bad]:
+                continue
+            sums = self.download_checksums(urlbase, dirbase, list(reldir), True) or {}
+            still_bad = verify_checksums(expected(dirbase, reldir, names, sums),
+                                         cache, host_cpus())
+            for name in names:
+                fn = os.path.join(*([dirbase] + list(reldir) + [name]))
+                if name in sums and not fn in still_bad:
+                    continue
+                print("warning: %s does not match its checksum, downloading it again"
+                      % fn, file=sys.stderr)
+                cache.forget(fn)
+                os.unlink(fn)
+                download_if_missing_3(urlbase, dirbase, list(reldir) + [name])
+                files += expected(dirbase, reldir, [name], sums)
+        bad = verify_checksums(files, cache, host_cpus())
+        if bad:
+            raise RuntimeError("%s does not match its checksum" % bad[0])
 
     # Create an ISO image
     def make_iso(self, image, dir):
@@ -828,14 +2682,40 @@ class Version(object):
         rm_f(image)
         spawn(makefs[0], makefs + [image, dir])
 
+    # The parts of a shared download directory that go on the
+    # install sets ISO
+    def install_sets_parts(self):
+        return [self.arch(), 'source']
+
+    # The approximate size of the files going on the install sets ISO
+    def install_sets_size(self):
+        if not self.download_dir:
+            return tree_size(self.download_local_mi_dir())
+        return sum([tree_size(os.path.join(self.download_local_mi_dir(), part))
+                    for part in self.install_sets_parts()])
+
+    # The directory tree to make the install sets ISO from
+    def install_sets_tree(self):
+        if not self.download_dir:
+            return os.path.dirname(os.path.realpath(os.path.join(self.download_local_mi_dir(), self.arch())))
+        # The download directory also contains the files of other
+        # ports, so link the ones for this port into a tree of its own
+        dir = os.path.join(self.workdir, 'sets_tree')
+        rm_tree(dir)
+        for part in self.install_sets_parts():
+            src = os.path.join(self.download_local_mi_dir(), part)
+            if os.path.isdir(src):
+                link_tree(src, os.path.join(dir, part))
+        return dir
+
     # Create the install sets ISO image
     def make_install_sets_iso(self):
         self.download()
+        tree = self.install_sets_tree()
         if self.arch() == 'macppc':
             gunzip(os.path.join(self.download_local_arch_dir(), 'binary/kernel/netbsd-INSTALL.gz'),
-                   os.path.join(self.download_local_mi_dir(), 'netbsd-INSTALL'))
-        self.make_iso(self.install_sets_iso_path(),
-            os.path.dirname(os.path.realpath(os.path.join(self.download_local_mi_dir(), self.arch()))))
+                   os.path.join(tree, 'netbsd-INSTALL'))
+        self.make_iso(self.install_sets_iso_path(), tree)
         self.tempfiles.append(self.install_sets_iso_path())
 
     # Create the runtime boot ISO image (macppc only)
@@ -969,6 +2849,8 @@ class ISO(Version):
          return url2dir(self.m_iso_url)
     def make_install_sets_iso(self):
         self.download()
+    def sets_iso_is_generated(self):
+        return False
     def download(self):
         if self.m_iso_path is None:
             download_if_missing_2(self.m_iso_url, self.install_sets_iso_path())
@@ -1001,6 +2883,274 @@ def distribution(distarg, **kwargs):
     else:
         raise RuntimeError("expected distribution URL or directory, got " + distarg)
 
+# Return the distributions for the ports "archs" of the release tree
+# at "root", the directory containing the per-port directories and
+# "source", sharing the download directory "download_dir"
+
+def release_tree_distributions(root, archs, download_dir, **kwargs):
+    if not root.endswith('/'):
+        root += '/'
+    return [distribution(root + arch + '/', download_dir = download_dir, **kwargs)
+            for arch in archs]
+
+# Download the files for installing the distributions "dists", which
+# share a download directory.  The machine independent files are
+# downloaded once, and then the files of each port, up to "jobs"
+# ports at a time.
+
+def download_distributions(dists, jobs):
+    if not dists:
+        return
+    dists[0].download_sets(mi_only = True)
+    queue = list(dists)
+    lock = threading.Lock()
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                dist = queue.pop(0)
+            dist.download()
+    tasks = [BackgroundTask(worker) for i in range(min(jobs, len(dists)))]
+    for task in tasks:
+        task.done.wait()
+    for task in tasks:
+        task.check()
+
+# Return the number of VMs for the ports "archs" that can run in
+# parallel on the host, each with a CPU of its own and with its
+# memory (of "memory_size", or the port default) fitting in the
+# memory available
+
+def max_parallel_vms(archs, memory_size = None):
+    memory = max([parse_size(memory_size or
+                             arch_props[arch].get('memory_size') or '32M')
+                  for arch in archs])
+    n = host_cpus()
+    mem = host_mem_available()
+    if mem is not None:
+        n = min(n, mem // memory)
+    return max(1, min(n, len(archs)))
+
+# The name of the lock file of a work directory.  Anita holds a shared
+# lock on it while using the work directory, and the garbage collector
+# an exclusive one while removing files from it.
+
+workdir_lock_name = '.anita-lock'
+
+# Lock the work directory "dir", creating it if needed, to keep the
+# garbage collector from removing files from it while in use.  If the
+# garbage collector is removing the directory, wait for it to finish
+# and recreate the directory.  The modification time of the lock file
+# records when the directory was last used.  Returns a file object
+# whose closing releases the lock.
+
+def lock_workdir(dir):
+    fn = os.path.join(dir, workdir_lock_name)
+    while True:
+        mkdir_p(dir)
+        f = open(fn, 'a')
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        try:
+            if os.stat(fn).st_ino == os.fstat(f.fileno()).st_ino:
+                break
+        except OSError:
+            pass
+        # Removed while we were waiting for the lock
+        f.close()
+    os.utime(fn, None)
+    return f
+
+# The disk space used by the file or directory tree "path", in bytes
+
+def disk_usage(path):
+    if not os.path.isdir(path) or os.path.islink(path):
+        try:
+            return os.lstat(path).st_blocks * 512
+        except OSError:
+            return 0
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fn in dirnames + filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, fn)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+# Classify the files in the top level of the work directory "dir" by
+# how costly they are to recreate, returning a list of (path, kind)
+# tuples where "kind" is one of
+#
+#   'regenerable' - made from other files in the work directory when
+#                   needed, or left behind by an interrupted run
+#   'installed'   - the installed system, and the files made along
+#                   with it and needed for booting it
+#   'download'    - the downloaded distribution
+#
+# Other files, like logs and test results, are not listed.  The
+# directories of the ports run using --archs are classified
+# recursively.
+
+def workdir_artifacts(dir):
+    r = []
+    for name in sorted(os.listdir(dir)):
+        path = os.path.join(dir, name)
+        if os.path.isdir(path) and \
+           os.path.exists(os.path.join(path, workdir_lock_name)):
+            r += workdir_artifacts(path)
+        elif name == 'download':
+            r.append((path, 'download'))
+        elif name in ('wd0.img', 'boot.iso') or \
+             re.match(r'netbsd-[A-Za-z0-9_]+$', name):
+            r.append((path, 'installed'))
+        elif name.endswith('.iso') or name.endswith('.checksums') or \
+             name in ('sets_tree', 'runtime_boot_iso', 'checkpoints',
+                      'tests-results.img', 'netbsd_install', 'netbsd_generic',
+                      'wd0-overlay.qcow2', 'hostinstall', 'root.img',
+                      'hostinstall.spec', 'hostinstall.disklabel', 'tftp',
+                      'bench-get'):
+            r.append((path, 'regenerable'))
+    return r
+
+# Try to lock the work directory "dir" and its port subdirectories
+# for removing files, returning the list of lock files, or None if
+# the directory is in use.
+
+def lock_workdir_exclusive(dir):
+    locks = []
+    for dirpath in [dir] + [os.path.join(dir, name) for name in os.listdir(dir)]:
+        fn = os.path.join(dirpath, workdir_lock_name)
+        if not os.path.exists(fn):
+            continue
+        f = open(fn, 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            f.close()
+            for lock in locks:
+                lock.close()
+            return None
+        locks.append(f)
+    return locks
+
+# How long a work directory without a lock file, as used by older
+# versions of anita, must have gone unmodified before the garbage
+# collector considers it not in use, in seconds
+
+gc_unlocked_idle_time = 86400
+
+# The time the work directory "dir" was last used, from its lock
+# files, or for directories predating them, the newest modification
+# time of the files in its top level.  The modification time of the
+# directory itself is used only if it is empty, as it also changes
+# when the garbage collector removes files.
+
+def workdir_last_used(dir):
+    times = []
+    for name in os.listdir(dir):
+        try:
+            times.append(os.path.getmtime(os.path.join(dir, name)))
+            times.append(os.path.getmtime(os.path.join(dir, name, workdir_lock_name)))
+        except OSError:
+            pass
+    if not times:
+        return os.path.getmtime(dir)
+    return max(times)
+
+# Remove files from the work directories in the directory "root",
+# leaving alone those in use.  The regenerable files of every work
+# directory are removed, as are entire work directories unused for
+# more than "max_age" seconds.  If the remaining work directories use
+# more than "max_size" bytes, entire work directories are removed,
+# least recently used first, until they fit.  With "dry_run", only
+# report what would be removed.  Returns the number of bytes freed.
+
+def collect_garbage(root, max_age = None, max_size = None, dry_run = False):
+    workdirs = []
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if not name.startswith('work-') or not os.path.isdir(path):
+            continue
+        try:
+            url = dir2url(name)
+        except (InvalidDir, AttributeError, IndexError, ValueError):
+            continue
+        workdirs.append([path, url, workdir_last_used(path)])
+    def fmt_size(n):
+        return "%.1fM" % (n / (1024.0 * 1024))
+    def remove(path):
+        if dry_run:
+            return
+        if os.path.isdir(path) and not os.path.islink(path):
+            rm_tree(path)
+        else:
+            rm_f(path)
+    freed = 0
+    now = time.time()
+    idle = []
+    total = 0
+    for path, url, last_used in workdirs:
+        locks = lock_workdir_exclusive(path)
+        if locks is None or \
+           not locks and now - last_used < gc_unlocked_idle_time:
+            size = disk_usage(path)
+            total += size
+            print("%s: %s, %s (%s)" %
+                  (url, ("in use", "not locked but recently modified")[locks is not None],
+                   fmt_size(size), path))
+            continue
+        try:
+            days = (now - last_used) / 86400
+            if max_age is not None and now - last_used > max_age:
+                size = disk_usage(path)
+                print("%s: unused for %.1f days, removing %s (%s)" %
+                      (url, days, fmt_size(size), path))
+                remove(path)
+                freed += size
+                continue
+            size = disk_usage(path)
+            kinds = set()
+            for artifact, kind in workdir_artifacts(path):
+                if kind == 'regenerable':
+                    artifact_size = disk_usage(artifact)
+                    print("%s: removing %s (%s)" %
+                          (url, artifact, fmt_size(artifact_size)))
+                    remove(artifact)
+                    freed += artifact_size
+                    size -= artifact_size
+                else:
+                    kinds.add(kind)
+            print("%s: %s%s, last used %.1f days ago (%s)" %
+                  (url, fmt_size(size), ''.join([', ' + k for k in sorted(kinds)]),
+                   days, path))
+            total += size
+            idle.append((last_used, path, url, size))
+        finally:
+            for lock in locks:
+                lock.close()
+    if max_size is not None:
+        idle.sort()
+        while total > max_size and idle:
+            last_used, path, url, size = idle.pop(0)
+            locks = lock_workdir_exclusive(path)
+            if locks is None:
+                continue
+            try:
+                print("%s: over the size budget, removing %s (%s)" %
+                      (url, fmt_size(size), path))
+                remove(path)
+            finally:
+                for lock in locks:
+                    lock.close()
+            total -= size
+            freed += size
+    if dry_run:
+        print("would free %s" % fmt_size(freed))
+    else:
+        print("freed %s" % fmt_size(freed))
+    return freed
+
 #############################################################################
 
 def vmm_is_xen(vmm):
@@ -1070,18 +3220,320 @@ else:
     def bytes2hex(s):
         return s.encode('hex')
 
-class Anita(object):
-    def __init__(self, dist, workdir = None, vmm = None, vmm_args = None,
-        disk_size = None, memory_size = None, persist = False, boot_from = None,
-        structured_log = None, structured_log_file = None, no_install = False,
-        tests = 'atf', dtb = '', xen_type = 'pv', image_format = 'dense',
-        machine = None, network_config = None, partitioning_scheme = None,
-        no_entropy = False):
-        self.dist = dist
-        if workdir:
-            self.workdir = workdir
+# Read the console I/O recorded in the structured log file "fn",
+# returning a list of (tag, timestamp, data) tuples where tag is
+# "recv" or "send"
+
+def read_console_log(fn):
+    import ast
+    events = []
+    f = open(fn, "r")
+    for line in f:
+        m = re.match(r'(recv|send)\(([\d.]+), (.*)\)$', line.rstrip('\n'))
+        if not m:
+            continue
+        data = ast.literal_eval(m.group(3))
+        if not isinstance(data, bytes):
+            data = data.encode('latin-1')
+        events.append((m.group(1), float(m.group(2)), data))
+    f.close()
+    return events
+
+# Numbers in data sent to the VM, which may differ between the
+# recorded run and the replay, like the timestamps in shell prompts
+
+replay_number_re = b'[0-9]+(?:\\.[0-9]+)?'
+
+# Return a regular expression matching data sent to the VM that
+# corresponds to the recorded data "data", where numbers may differ,
+# and data censored in the log (like entropy) may be anything of the
+# same length
+
+def replay_send_re(data):
+    r = b''
+    for part in re.split(b'(' + replay_number_re + b'|\\*+)', data):
+        if re.match(replay_number_re + b'$', part):
+            r += b'(' + replay_number_re + b')'
+        elif part.startswith(b'*'):
+            r += b'[\\s\\S]{%d}' % len(part)
+        else:
+            r += re.escape(part)
+    return re.compile(r)
+
+# Play back the console output recorded in the structured log "fn"
+# on stdin/stdout, which should be a pty, waiting for the data sent
+# to the VM in the recorded run to be sent again before continuing.
+# If "speed" is zero, the output is played back as fast as possible,
+# otherwise at "speed" times the recorded pace.  Numbers sent that
+# differ from the recorded ones, like those in shell prompts, are
+# substituted in the output that follows.  If the data sent diverges
+# from the recording, a message is output and the process exits with
+# status 1.  This is run in a child process as the "VMM" when
+# replaying.
+
+def replay_console(fn, speed):
+    import select
+    import termios
+    import tty
+    events = read_console_log(fn)
+    # Don't flush any data already sent
+    tty.setraw(0, termios.TCSANOW)
+    substitutions = []
+    pending = b''
+    last_ts = None
+    last_real = time.time()
+    def diverged(expected):
+        os.write(1, ("\r\nanita-replay: diverged from %s: expected %r, got %r\r\n" %
+                     (fn, expected, pending)).encode('latin-1'))
+        sys.exit(1)
+    for tag, ts, data in events:
+        if tag == 'recv':
+            if speed and last_ts is not None:
+                delay = last_real + (ts - last_ts) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            for old, new in substitutions:
+                data = data.replace(old, new)
+            os.write(1, data)
+        else:
+            # The empty quoted strings inserted by quote_prompt()
+            # move with the length of the prompt, so ignore them
+            data = data.replace(b"''", b"")
+            pattern = replay_send_re(data)
+            literal_prefix = re.split(b'(?:' + replay_number_re + b'|\\*)', data)[0]
+            while True:
+                received = pending.replace(b"''", b"")
+                m = pattern.match(received)
+                # Wait a bit for more digits if the match ends at a
+                # number that may be incomplete
+                if m and (m.end() < len(received) or
+                          not received[-1:].isdigit() or
+                          not select.select([0], [], [], 0.1)[0]):
+                    break
+                n = min(len(received), len(literal_prefix))
+                if received[:n] != literal_prefix[:n] or \
+                   b'\n' in data and received.count(b'\n') >= data.count(b'\n') or \
+                   len(received) > 2 * len(data) + 64:
+                    diverged(data)
+                chunk = os.read(0, 4096)
+                if not chunk:
+                    return
+                pending += chunk
+            old_numbers = re.findall(replay_number_re, data)
+            for old, new in zip(old_numbers, m.groups()):
+                # Short numbers are too likely to occur by accident
+                if old != new and len(old) >= 4:
+                    substitutions.append((old, new))
+            substitutions.sort(key = lambda sub: -len(sub[0]))
+            # Consume the data matched, skipping empty quoted strings
+            i = 0
+            n = 0
+            while n < m.end():
+                if pending[i:i + 2] == b"''":
+                    i += 2
+                else:
+                    i += 1
+                    n += 1
+            pending = pending[i:]
+        last_ts = ts
+        last_real = time.time()
+
+# The prompts of the main part of the sysinst conversation, after
+# the disk and the sets have been chosen, as (state, pattern) pairs.
+# Many different things can happen at this point:
+#
+# Versions older than 2009/08/23 21:16:17 will display a menu
+# for choosing the extraction verbosity
+#
+# Versions older than 2010/03/30 20:09:25 will display a menu for
+# choosing the CD-ROM device (newer versions will choose automatically)
+#
+# Versions older than Fri Apr 6 23:48:53 2012 UTC will ask
+# you to "Please choose the timezone", wheras newer ones will
+# instead as you to "Configure the additional items".
+#
+# At various points, we may or may not get "Hit enter to continue"
+# prompts (and some of them seem to appear nondeterministically)
+#
+# i386/amd64 can ask whether to use normal or serial console bootblocks
+#
+# Try to deal with all of the possible options, by waiting for any of
+# the prompts and then performing the action for its state.  When
+# several prompts match, the one earliest in the output wins, and of
+# those starting at the same place, the one earliest in this list.
+#
+# It has happened (at least with NetBSD 3.0.1) that sysinst paints the
+# screen twice.  This can cause problem because we will then respond
+# twice, and the second response will be interpreted as a response to
+# a subsequent prompt.  Therefore, we check whether the match is the
+# same as the previous one and ignore it if so.
+#
+# OTOH, -current as of 2009.08.23.20.57.40 will issue the message "Hit
+# enter to continue" twice in a row, first as a result of MAKEDEV
+# printing a warning messages "MAKEDEV: dri0: unknown device", and
+# then after "sysinst will give you the opportunity to configure
+# some essential things first".  We match the latter text separately
+# so that the "Hit enter to continue" matches are not consecutive.
+#
+# The changes of Apr 6 2012 broght with them a new redraw problem,
+# which is worked around by counting the "essential things" prompts.
+
+sysinst_prompts = [
+    ('progress_bar', r"a: Progress bar"),
+    ('install_from', r"Select medium|Install from"),
+    ('cdrom_device', r"Enter the CDROM device"),
+    ('hit_enter', r"Hit enter to continue"),
+    ('serial_bootblocks', r"b: Use serial port com0"),
+    ('timezone', r"Please choose the timezone"),
+    ('essential_things', r"essential things"),
+    ('additional_items', r"Configure the additional items"),
+    ('multiple_cds', r"Multiple CDs found"),
+    ('http_site', r"The following are the http site"),
+    ('network_accurate', r"Is the network information you entered accurate"),
+    ('interface_oldstyle', r"I have found the following network interface"),
+    ('interface_newstyle', r"Which network device would you like to use"),
+    ('continue_anyway', r"No allows you to continue anyway"),
+    ('cant_connect', r"Can't connect to"),
+    ('newfs', r"/sbin/newfs"),
+    ('install_bootcode', r"Do you want to install the NetBSD bootcode"),
+    ('update_mbr_bootcode',
+     r"Do you want to update the bootcode in the Master Boot Record to the latest"),
+    ('custom_installation', r"([a-z]): Custom installation"),
+    ('correct_geometry', r"a: This is the correct geometry"),
+    ('use_one_of_these_disks', r"a: Use one of these disks"),
+    ('set_sizes', r"([a-z]): Set sizes of NetBSD partitions"),
+    ('partitioning_scheme', r"a partitioning scheme"),
+    ('entire_disk', r"([a-z]): Use the entire disk"),
+    ('update_bootcode', r'Do you want to update the bootcode'),
+    ('disk_name', r"Please enter a name for your NetBSD disk"),
+    # Matching "This is your last chance" will not work
+    ('ready_to_install', r"ready to install NetBSD on your hard disk"),
+    ('partitions_ok', r"We now have your (?:BSD.|GPT.)?(?:disklabel )?partitions"),
+    ('non_netbsd_partition', r'Your disk currently has a non-NetBSD partition'),
+    ('bios_geometry',
+     r"Sysinst could not automatically determine the BIOS geometry of the disk"),
+    ('reedit_disklabel', r"Do you want to re-edit the disklabel partitions"),
+    # To reset the timeout while set extraction is making progress
+    ('command', r'Command: '),
+    ('entropy', r'not enough entropy'),
+    ('root_password', r'Changing local password for root'),
+    ('accept_partition_sizes', r'(Accept partition sizes)|(Go on)'),
+]
+
+# The install checkpoints, as (name, states, after) tuples, in the
+# order they are reached.  The checkpoint "name" is taken when
+# sysinst waits for input in one of the "states" of sysinst_prompts,
+# provided that the state "after" (if not None) has been seen
+# earlier.  The pseudo-state "configured" is entered when the
+# conversation of sysinst_prompts has finished.  A checkpoint saves
+# the guest state and disk image so that a failed install can be
+# resumed from the latest one rather than started over.
+
+sysinst_checkpoints = [
+    # The disk has been partitioned and the file systems created,
+    # and sysinst asks where to get the sets from
+    ('partitioned', ('install_from', 'cdrom_device', 'multiple_cds'),
+     'newfs'),
+    # The sets have been extracted
+    ('extracted', ('hit_enter', 'timezone'), 'essential_things'),
+    # The system has been configured, except for what anita
+    # configures itself after the install.  This is taken once the
+    # conversation has finished, after "x: Finished configuring" has
+    # been sent in the additional_items state; at that prompt, the
+    # guest is no further along than at the "extracted" checkpoint.
+    ('configured', ('configured',), 'additional_items'),
+]
+
+# Changes to sysinst_prompts for NetBSD versions of at least a given
+# major version, as a dict mapping the major version to a list of
+# (state, pattern) pairs.  A pattern replaces that of an existing
+# state, or if the state is new, is added at the end; a pattern of
+# None removes the state.  Overlays for successive versions are
+# applied in order.  Removing prompts that cannot occur makes each
+# wait cheaper and avoids misinterpreting stray output.
+
+sysinst_overlays = {
+    # The netbsd-6 branch was created in 2012, after the removal of
+    # the extraction verbosity and CD-ROM device menus, but before
+    # the timezone prompt was replaced.
+    6: [('progress_bar', None),
+        ('cdrom_device', None)],
+    7: [('timezone', None)],
+}
+
+# The compiled prompts for each major version (or None for unknown),
+# as a tuple of a list of states and a list of compiled patterns.
+# These are compiled once per process, as pexpect would otherwise
+# compile the patterns anew for every expect() call.
+
+sysinst_compiled_prompts = {}
+
+def compiled_sysinst_prompts(major_version):
+    if major_version in sysinst_compiled_prompts:
+        return sysinst_compiled_prompts[major_version]
+    prompts = list(sysinst_prompts)
+    if major_version is not None:
+        for v in sorted(sysinst_overlays.keys()):
+            if v > major_version:
+                break
+            for state, pattern in sysinst_overlays[v]:
+                states = [p[0] for p in prompts]
+                if state in states:
+                    i = states.index(state)
+                    if pattern is None:
+                        del prompts[i]
+                    else:
+                        prompts[i] = (state, pattern)
+                elif pattern is not None:
+                    prompts.append((state, pattern))
+    # Compile the patterns like pexpect does for a non-Unicode child
+    compiled = ([state for state, pattern in prompts],
+                [re.compile(pattern.encode('ASCII'), re.DOTALL)
+                 for state, pattern in prompts])
+    sysinst_compiled_prompts[major_version] = compiled
+    return compiled
+
+# Return the NetBSD major version of the distribution "dist" if it can
+# be determined from its version number or URL, otherwise None
+
+def dist_major_version(dist):
+    ver = getattr(dist, 'ver', None)
+    if ver is None:
+        for attr in ('url', 'm_iso_url'):
+            m = re.search(r'[Nn]et[Bb][Ss][Dd]-(\d+)[._/-]', getattr(dist, attr, ''))
+            if m:
+                ver = m.group(1)
+                break
+    if ver is None:
+        return None
+    m = re.match(r'(\d+)', ver)
+    if m is None:
+        return None
+    return int(m.group(1))
+
+class Anita(object):
+    def __init__(self, dist, workdir = None, vmm = None, vmm_args = None,
+        disk_size = None, memory_size = None, persist = False, boot_from = None,
+        structured_log = None, structured_log_file = None, no_install = False,
+        tests = 'atf', dtb = '', xen_type = 'pv', image_format = 'dense',
+        machine = None, network_config = None, partitioning_scheme = None,
+        no_entropy = False, accel = 'auto', cpus = 'auto',
+        disk_interface = 'ide', nic_model = None, disk_io_policy = 'auto',
+        disk_iops = None, disk_bps = None, ephemeral_dir = None,
+        ephemeral_budget = None, pipelined_install = False,
+        install_method = 'sysinst', teardown = 'auto', chain_boot = False,
+        watchdog = True, history_db = None, transfer_size = None,
+        shell_protocol = 'classic', replay_log = None, replay_speed = 0,
+        install_checkpoints = False, install_retries = 0,
+        dist_server = False, stream_iso = False):
+        self.dist = dist
+        if workdir:
+            self.workdir = workdir
         else:
             self.workdir = dist.default_workdir()
+        # Keep the garbage collector away from the work directory
+        # for as long as we may use it
+        self.workdir_lock = lock_workdir(self.workdir)
 
         self.structured_log = structured_log
         self.structured_log_file = structured_log_file
@@ -1163,10 +3615,175 @@ class Anita(object):
         self.partitioning_scheme = partitioning_scheme
         self.no_entropy = no_entropy
 
+        if accel is None:
+            accel = 'auto'
+        if cpus is None:
+            cpus = 'auto'
+        if not re.match(r'(auto:)?[1-9]\d*$|auto$', str(cpus)):
+            raise RuntimeError("invalid number of CPUs: %s" % cpus)
+        self.accel = accel
+        self.cpus = cpus
+
+        # Paravirtualized or AHCI devices are opt-in, and only for x86
+        # guests under qemu, as the other ports have fixed device
+        # types.
+        if disk_interface is None:
+            disk_interface = 'ide'
+        if not disk_interface in ('ide', 'ahci', 'virtio'):
+            raise RuntimeError("unknown disk interface %s" % disk_interface)
+        if nic_model is not None and not nic_model in qemu_nic_models:
+            raise RuntimeError("unknown NIC model %s" % nic_model)
+        if (disk_interface != 'ide' or nic_model is not None) and \
+           not (self.vmm == 'qemu' and dist.arch() in ('i386', 'amd64')):
+            raise RuntimeError("selecting the disk interface or NIC model " +
+                               "is only supported for i386 and amd64 under qemu")
+        self.disk_interface = disk_interface
+        self.nic_model = nic_model
+
+        if disk_io_policy is None:
+            disk_io_policy = 'auto'
+        if not disk_io_policy in ('auto',) + tuple(disk_io_policies):
+            raise RuntimeError("unknown disk I/O policy %s" % disk_io_policy)
+        self.disk_io_policy = disk_io_policy
+        self.disk_iops = disk_iops and int(disk_iops)
+        self.disk_bps = disk_bps and parse_size(disk_bps)
+        if (self.disk_iops or self.disk_bps) and \
+           not disk_io_policy in ('auto', 'throttled'):
+            raise RuntimeError("disk I/O limits require the throttled policy")
+        # Whether qemu can use io_uring, determined when first needed
+        self.io_uring_ok = None
+
+        # Throwaway and regenerable files such as the system disk
+        # image of a run that installs from scratch, the install sets
+        # ISO, the scratch disk, and decompressed kernels can be
+        # placed in an "ephemeral" directory, typically on a
+        # memory-backed file system such as /dev/shm, instead of
+        # the work directory.  Each run uses a subdirectory of its
+        # own that is removed at the end of the run.  Downloads,
+        # test results, and previously installed system disk images
+        # stay in the work directory.
+        self.ephemeral_dir = None
+        self.ephemeral_budget = ephemeral_budget and parse_size(ephemeral_budget)
+        self.ephemeral_capacity = None
+        self.ephemeral_reserved = 0
+        self.ephemeral_files = {}
+        self.pipelined_install = pipelined_install
+
+        # The system can be installed either by running sysinst
+        # in the guest, or by building the disk image on the host
+        # from the sets, which is faster but does not test sysinst.
+        if install_method is None:
+            install_method = 'sysinst'
+        if not install_method in ('sysinst', 'host'):
+            raise RuntimeError("unknown install method %s" % install_method)
+        if install_method == 'host':
+            if not (self.vmm == 'qemu' and dist.arch() in ('i386', 'amd64')):
+                raise RuntimeError("installing on the host is only supported " +
+                                   "for i386 and amd64 under qemu")
+            if partitioning_scheme not in (None, 'MBR'):
+                raise RuntimeError("installing on the host is only supported " +
+                                   "with the MBR partitioning scheme")
+        self.install_method = install_method
+
+        if teardown is None:
+            teardown = 'auto'
+        if not teardown in ('auto', 'fast', 'graceful'):
+            raise RuntimeError("unknown teardown policy %s" % teardown)
+        self.teardown = teardown
+        # Whether the system disk of the running VM is snapshotted
+        self.system_disk_snapshotted = False
+
+        # When installing and booting in the same run, the VM used
+        # for the install can be reset into the installed system
+        # rather than starting a new one.  While such an install is
+        # in progress, chain_boot_vmm_args holds the VMM arguments
+        # for the boot, and when it has succeeded, chained is true.
+        # If the system disk is to be snapshotted, the writes after
+        # the install go to system_disk_overlay.
+        self.watchdog = None
+        if watchdog:
+            self.watchdog = Watchdog(self.watchdog_hit)
+
+        # The history of past runs, if kept, and the phase of the
+        # current run, when it started, and whether it was resumed
+        # from an install checkpoint and so is not representative
+        self.history = None
+        self.run_id = None
+        if history_db:
+            self.history = History(history_db)
+        self.phase = None
+        self.phase_start = None
+        self.phase_resumed = False
+
+        # The size of the scratch disk used by put_files() and
+        # get_files(), or None if file transfers are not enabled,
+        # and the image file of the scratch disk of the running VM
+        self.transfer_size = None
+        if transfer_size:
+            self.transfer_size = parse_size(transfer_size)
+        self.scratch_disk_path = None
+        self.scratch_disk_size = None
+
+        self.chain_boot = chain_boot
+        self.chain_boot_vmm_args = None
+        self.chained = False
+        self.system_disk_overlay = None
+
+        # State of a pipelined install in progress
+        self.install_prep = None
+        self.install_disk_ready = None
+        self.sets_cd_pending = False
+        if ephemeral_dir:
+            mkdir_p(ephemeral_dir)
+            self.ephemeral_dir = tempfile.mkdtemp(prefix = 'anita-',
+                                                  dir = ephemeral_dir)
+        # The accelerator and number of vCPUs actually chosen, as
+        # determined by choose_qemu_accel()
+        self.qemu_accel = None
+        self.qemu_cpus = None
+        self.qemu_accel_chosen = False
+
         self.is_logged_in = False
         self.halted = False
         self.tests = tests
 
+        # How shell_cmd() runs commands, and with the "framed"
+        # protocol, the prompt of the shell set up for running them
+        # in the current login session
+        if shell_protocol not in ('framed', 'classic'):
+            raise RuntimeError("unknown shell protocol %s" % shell_protocol)
+        self.shell_protocol = shell_protocol
+        self.shell_prompt = None
+
+        # The structured log to replay instead of running the VMM,
+        # if any, and the speed to replay it at
+        self.replay_log = replay_log
+        self.replay_speed = replay_speed
+
+        # Whether to take install checkpoints, and how many times
+        # to retry a failed install
+        if install_checkpoints and (self.vmm != 'qemu' or replay_log):
+            print("warning: install checkpoints require qemu, not taking them",
+                  file=sys.stderr)
+            install_checkpoints = False
+        self.install_checkpoints = install_checkpoints
+        self.install_retries = install_retries
+        # The checkpoint the current install is resumed from, if any
+        self.resume_checkpoint = None
+
+        # Whether to run the built-in distribution server for noemu,
+        # and the server once started
+        self.use_dist_server = dist_server
+        self.dist_server = None
+        # Whether to stream ISO distributions rather than downloading
+        # them before boot, and the image and NBD server doing it
+        self.stream_iso = stream_iso
+        self.iso_stream = None
+        self.iso_nbd = None
+        # The qemu arguments describing the virtual hardware of the
+        # running qemu, as returned by qemu_hardware_args()
+        self.qemu_hardware = None
+
         # Number of CD-ROM devices
         self.n_cdrom = 0
 
@@ -1186,32 +3803,404 @@ class Anita(object):
 
         self.child = None
         self.cleanup_child_func = None
+        # The Screen tracking the console of the child
+        self.screen = None
+
+        # The QMP socket of the running qemu, if any, and the
+        # connection to it, made when first needed
+        self.qmp_dir = None
+        self.qmp_conn = None
+
+        if self.history:
+            self.run_id = self.history.start_run(self.dist_url(),
+                self.dist.arch(), self.vmm, self.history_options())
+            self.rusage_start = resource.getrusage(resource.RUSAGE_CHILDREN)
 
     def __enter__(self):
         return self
 
-    def __exit__(self, *stuff):
+    def __exit__(self, exc_type, exc_value, traceback):
         self.slog("exit")
         self.cleanup_child()
+        self.cleanup_ephemeral()
+        self.unlock_workdir()
+        if self.history:
+            self.end_history_run(exc_type.__name__ if exc_type else 'ok')
         return False
 
+    # A string identifying the distribution being installed
+    def dist_url(self):
+        for attr in ('url', 'm_iso_url'):
+            if hasattr(self.dist, attr):
+                return getattr(self.dist, attr)
+        return self.dist.dist_url()
+
+    # The options of the run that affect performance, for the history
+    def history_options(self):
+        return {
+            'disk_size': self.disk_size,
+            'memory_size': self.memory_size_bytes,
+            'persist': self.persist,
+            'tests': self.tests,
+            'image_format': self.image_format,
+            'machine': self.machine,
+            'accel': self.accel,
+            'cpus': self.cpus,
+            'disk_interface': self.disk_interface,
+            'nic_model': self.nic_model,
+            'disk_io_policy': self.disk_io_policy,
+            'install_method': self.install_method,
+            'pipelined_install': self.pipelined_install,
+            'chain_boot': self.chain_boot,
+            'teardown': self.teardown,
+            'vmm_args': self.extra_vmm_args,
+        }
+
+    # Record the outcome (None if not known) and the host resources
+    # used by the VMM in the history, and close it.  The CPU times
+    # are those of all the child processes that have exited during
+    # the run, and the RSS is the largest maximum resident set size
+    # of any child process of anita so far, which is normally that
+    # of the VMM, in the units of getrusage(2).
+    def end_history_run(self, outcome):
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.history.update_run(self.run_id, {
+            'end': time.time(),
+            'outcome': outcome,
+            'accel': self.qemu_accel,
+            'user_time': usage.ru_utime - self.rusage_start.ru_utime,
+            'system_time': usage.ru_stime - self.rusage_start.ru_stime,
+            'max_child_rss': usage.ru_maxrss,
+        })
+        self.history.close()
+        self.history = None
+
     def cleanup(self):
         self.cleanup_child()
+        self.cleanup_ephemeral()
+        if self.dist_server:
+            self.dist_server.close()
+            self.dist_server = None
+        self.unlock_workdir()
+        if self.history:
+            self.end_history_run(None)
+
+    def unlock_workdir(self):
+        if self.workdir_lock:
+            self.workdir_lock.close()
+            self.workdir_lock = None
+
+    def cleanup_ephemeral(self):
+        if self.ephemeral_dir:
+            shutil.rmtree(self.ephemeral_dir, ignore_errors = True)
+            self.ephemeral_dir = None
+            self.ephemeral_files = {}
+
+    # Return the number of bytes we can still place in the ephemeral
+    # directory, taking into account the space in its file system,
+    # the memory available on the host (less that needed by the
+    # guest), and the budget, if any.
+
+    def ephemeral_room(self):
+        if self.ephemeral_capacity is None:
+            st = os.statvfs(self.ephemeral_dir)
+            capacity = st.f_bavail * st.f_frsize
+            mem = host_mem_available()
+            if mem is not None:
+                capacity = min(capacity, mem - self.memory_size_bytes)
+            if self.ephemeral_budget is not None:
+                capacity = min(capacity, self.ephemeral_budget)
+            self.ephemeral_capacity = capacity
+        return self.ephemeral_capacity - self.ephemeral_reserved
+
+    # Return the path of the throwaway or regenerable file "name",
+    # which may grow to "size" bytes.  If there is an ephemeral
+    # directory with room for the file, it goes there, otherwise
+    # in the work directory.  The choice is remembered, so that
+    # all references to the file within a run agree.
+
+    def ephemeral_file(self, name, size):
+        path = self.ephemeral_files.get(name)
+        if path:
+            return path
+        if self.ephemeral_dir and self.ephemeral_room() >= size:
+            path = os.path.join(self.ephemeral_dir, name)
+            self.ephemeral_reserved += size
+            self.slog("placing %s in %s" % (name, self.ephemeral_dir))
+        else:
+            if self.ephemeral_dir:
+                print("warning: no room for %s (%d bytes) in %s, using %s instead" %
+                      (name, size, self.ephemeral_dir, self.workdir), file=sys.stderr)
+            path = os.path.join(self.workdir, name)
+        self.ephemeral_files[name] = path
+        return path
 
     def cleanup_child(self):
         if self.cleanup_child_func:
             self.cleanup_child_func()
             self.cleanup_child_func = None
         self.child = None
+        self.cleanup_qmp()
+        self.stop_iso_stream()
+        self.scratch_disk_path = None
+        if self.system_disk_overlay:
+            rm_f(self.system_disk_overlay)
+            self.system_disk_overlay = None
+
+    # Return true if the install ISO should be streamed rather than
+    # downloaded up front: it must be an ISO distribution that has
+    # not been fully downloaded yet, and the VMM must be qemu
+
+    def want_iso_stream(self):
+        return self.stream_iso and self.vmm == 'qemu' and \
+            isinstance(self.dist, ISO) and self.dist.m_iso_path is None and \
+            not os.path.exists(self.dist.install_sets_iso_path())
+
+    # Return the qemu file name of the install sets ISO, streaming
+    # it through a local NBD server if so configured.  Falls back to
+    # downloading the whole ISO if the server does not support range
+    # requests.
+
+    def install_sets_iso_file(self):
+        if self.iso_nbd:
+            return self.iso_nbd.qemu_uri()
+        if self.want_iso_stream():
+            try:
+                self.iso_stream = StreamedImage(self.dist.m_iso_url,
+                    self.dist.install_sets_iso_path())
+                self.iso_nbd = NBDServer(self.iso_stream, self.slog)
+                self.slog("streaming %s, %d of %d chunks cached" %
+                          (self.dist.m_iso_url, self.iso_stream.chunks_present(),
+                           self.iso_stream.n_chunks))
+                return self.iso_nbd.qemu_uri()
+            except Exception as e:
+                print("warning: cannot stream %s, downloading it instead: %s" %
+                      (self.dist.m_iso_url, e), file=sys.stderr)
+                self.stop_iso_stream()
+                self.dist.make_install_sets_iso()
+        return self.dist.install_sets_iso_path()
+
+    def stop_iso_stream(self):
+        if self.iso_nbd:
+            self.iso_nbd.close()
+            self.iso_nbd = None
+        if self.iso_stream:
+            self.iso_stream.close()
+            self.iso_stream = None
+
+    def cleanup_qmp(self):
+        if self.qmp_conn:
+            try:
+                self.qmp_conn.close()
+            except:
+                pass
+            self.qmp_conn = None
+        if self.qmp_dir:
+            shutil.rmtree(self.qmp_dir, ignore_errors = True)
+            self.qmp_dir = None
+
+    # Return a QMP connection to the running qemu, or None if there
+    # is none or it can't be established, in which case the caller
+    # should fall back on the monitor on the console
+    def qmp(self):
+        if self.qmp_conn:
+            return self.qmp_conn
+        if not self.qmp_dir or not (self.child and self.child.isalive()):
+            return None
+        try:
+            self.qmp_conn = QMP(os.path.join(self.qmp_dir, 'qmp.sock'))
+        except Exception as e:
+            print("warning: could not connect to QMP: %s" % e, file=sys.stderr)
+            self.cleanup_qmp()
+        return self.qmp_conn
+
+    # Execute a QMP command, returning a tuple of a boolean
+    # indicating success and the return value
+    def qmp_command(self, name, args = None):
+        if self.replay_log:
+            return self.replay_qmp_command(name, args)
+        qmp = self.qmp()
+        if not qmp:
+            return False, None
+        self.slog("QMP command %s %s" % (name, args or ''))
+        try:
+            r = qmp.command(name, args)
+        except Exception as e:
+            print("warning: %s" % e, file=sys.stderr)
+            return False, None
+        return True, r
+
+    # Return the run state of the qemu guest, e.g., "running" or
+    # "shutdown", or None if not known
+    def qemu_status(self):
+        ok, r = self.qmp_command('query-status')
+        if not ok:
+            return None
+        return r.get('status')
+
+    # When replaying, there is no qemu to send QMP commands to, and
+    # their effects are part of the recording.  Log them and pretend
+    # they succeeded.
+    def replay_qmp_command(self, name, args):
+        self.slog("not replaying QMP command %s %s" % (name, args or ''))
+        return True, {
+            'query-status': {'status': 'running'},
+            'query-migrate': {'status': 'completed'},
+        }.get(name, {})
+
+    # Make qemu exit immediately
+    def qemu_quit(self):
+        if self.replay_log:
+            self.replay_qmp_command('quit', None)
+            return
+        qmp = self.qmp()
+        if not qmp:
+            return
+        self.slog("QMP command quit")
+        try:
+            qmp.command('quit')
+        except:
+            # qemu may exit before responding
+            pass
+
+    # Change the media in the qemu drive "device" using QMP.  Returns
+    # true on success.
+    def qmp_change_media(self, device, path):
+        ok, r = self.qmp_command('blockdev-change-medium',
+                                 {'device': device, 'filename': path,
+                                  'format': 'raw'})
+        return ok
+
+    # Save the state of the stopped guest to the file "path", for
+    # later restoring with "-incoming".  The guest is left stopped.
+    # Returns true on success.
+    def qmp_save_state(self, path):
+        ok, r = self.qmp_command('stop')
+        if not ok:
+            return False
+        ok, r = self.qmp_command('migrate',
+                                 {'uri': 'exec:cat > %s' % sh_quote(path)})
+        if not ok:
+            return False
+        while True:
+            ok, r = self.qmp_command('query-migrate')
+            if not ok:
+                return False
+            status = r.get('status')
+            if status == 'completed':
+                return True
+            if status in ('failed', 'cancelled'):
+                print("warning: saving the guest state failed: %s" %
+                      r.get('error-desc', status), file=sys.stderr)
+                return False
+            time.sleep(0.1)
+
+    # The directory holding the install checkpoints
+    def checkpoint_dir(self):
+        return os.path.join(self.workdir, 'checkpoints')
+
+    # Take the install checkpoint "name" while sysinst is waiting for
+    # input in the state "state".  The prompt has been matched by the
+    # last expect() on "child", and "variables" is a dict of the state
+    # of the sysinst conversation to be restored along with the guest.
+    # Failure to take a checkpoint is not fatal to the install.
+    def save_install_checkpoint(self, child, name, state, variables):
+        start = time.time()
+        # Have the checkpoint include the sets CD of a pipelined
+        # install rather than depend on the background task
+        self.wait_install_sets(child)
+        # The screen is not redrawn when the checkpoint is restored,
+        # so save the output of the prompt for expecting it again,
+        # and the screen contents
+        pending = child.after
+        wait_for_quiet(child, 1, 10)
+        pending += child.buffer
+        dir = os.path.join(self.checkpoint_dir(), name)
+        tmpdir = dir + '.tmp'
+        rm_tree(tmpdir)
+        mkdir_p(tmpdir)
+        if not self.qmp_save_state(os.path.abspath(os.path.join(tmpdir, 'state'))):
+            print("warning: could not take install checkpoint %s" % name,
+                  file=sys.stderr)
+            rm_tree(tmpdir)
+            self.qmp_command('cont')
+            return
+        copy_image(self.wd0_path(), os.path.join(tmpdir, 'wd0.img'), True)
+        info = {
+            'name': name,
+            'state': state,
+            'hardware': self.qemu_hardware,
+            'pending': pending,
+            'screen': self.screen,
+            'variables': variables,
+        }
+        f = open(os.path.join(tmpdir, 'info'), 'wb')
+        pickle.dump(info, f)
+        f.close()
+        rm_tree(dir)
+        os.rename(tmpdir, dir)
+        ok, r = self.qmp_command('cont')
+        if not ok:
+            raise RuntimeError("could not continue the guest after checkpointing it")
+        self.slog("took install checkpoint %s at sysinst state %s in %.3f seconds" %
+                  (name, state, time.time() - start))
+
+    # Return the information about the latest usable install
+    # checkpoint, or None if there is none
+    def latest_install_checkpoint(self):
+        if not self.install_checkpoints:
+            return None
+        for name, states, after in reversed(sysinst_checkpoints):
+            dir = os.path.join(self.checkpoint_dir(), name)
+            if not os.path.exists(os.path.join(dir, 'info')):
+                continue
+            try:
+                f = open(os.path.join(dir, 'info'), 'rb')
+                info = pickle.load(f)
+                f.close()
+            except Exception as e:
+                print("warning: ignoring install checkpoint %s: %s" % (name, e),
+                      file=sys.stderr)
+                continue
+            info['dir'] = dir
+            return info
+        return None
+
+    # Wait for the qemu started with the guest state of the install
+    # checkpoint "info" to load it, and continue the guest where
+    # the checkpoint was taken
+    def restore_install_checkpoint(self, child, info):
+        start = time.time()
+        while True:
+            status = self.qemu_status()
+            if status is None:
+                raise RuntimeError("could not restore install checkpoint %s" %
+                                   info['name'])
+            if status != 'inmigrate':
+                break
+            gather_input(child, 0.1)
+        if status != 'running':
+            ok, r = self.qmp_command('cont')
+            if not ok:
+                raise RuntimeError("could not continue the guest from install checkpoint %s" %
+                                   info['name'])
+        self.screen.__dict__.update(info['screen'].__dict__)
+        child.buffer = info['pending']
+        self.slog("restored install checkpoint %s at sysinst state %s in %.3f seconds" %
+                  (info['name'], info['state'], time.time() - start))
+
+    def remove_install_checkpoints(self):
+        rm_tree(self.checkpoint_dir())
 
     # Get the name of the actual uncompressed kernel file, out of
     # potentially multiple alternative kernels.  Used with images.
     def actual_kernel(self):
         for kernel_name in self.get_arch_prop('kernel_name'):
             kernel_name_nogz = kernel_name[:-3]
-            kernel_fn = os.path.join(self.workdir, kernel_name_nogz)
-            if os.path.exists(kernel_fn):
-                return kernel_fn
+            for kernel_fn in (self.ephemeral_files.get(kernel_name_nogz),
+                              os.path.join(self.workdir, kernel_name_nogz)):
+                if kernel_fn and os.path.exists(kernel_fn):
+                    return kernel_fn
         raise RuntimeError("missing kernel")
 
     def arch_vmm_args(self):
@@ -1235,9 +4224,15 @@ class Anita(object):
                     '-dtb', self.dtb
                 ]
         elif self.dist.arch() == 'evbarm-aarch64':
+            # With hardware virtualization, the guest must run on
+            # the host CPU model
+            if self.qemu_accel in ('kvm', 'hvf'):
+                cpu = 'host'
+            else:
+                cpu = 'cortex-a57'
             a = [
                 '-M', self.machine,
-                '-cpu', 'cortex-a57',
+                '-cpu', cpu,
             ]
         elif self.dist.arch() == 'alpha':
             a = [ '-append', 'root=/dev/wd0a' ]
@@ -1262,13 +4257,32 @@ class Anita(object):
 
     def pexpect_spawn(self, command, args):
         print(quote_shell_command([command] + args))
-        child = pexpect_spawn_log(self.structured_log_f, command, args)
+        if self.replay_log:
+            print("replaying the console output from %s instead" % self.replay_log)
+            args = ['-c', 'import sys; sys.path.insert(0, %r); import anita; '
+                    'anita.replay_console(%r, %r)' %
+                    (os.path.dirname(os.path.abspath(__file__)),
+                     os.path.abspath(self.replay_log), self.replay_speed)]
+            command = sys.executable
+        env = None
+        if self.ephemeral_dir:
+            # Make qemu put the temporary files backing snapshotted
+            # disks in the ephemeral directory
+            env = dict(os.environ, TMPDIR = self.ephemeral_dir)
+        child = pexpect_spawn_log(self.structured_log_f, command, args,
+                                  env = env)
         print("child pid is %d" % child.pid)
         return child
 
-    # The path to the NetBSD hard disk image
+    # The path to the NetBSD hard disk image.  When using an ephemeral
+    # directory, an already installed image in the work directory is
+    # used if present, but a new one is installed in the ephemeral
+    # directory and thrown away at the end of the run.
     def wd0_path(self):
-        return os.path.join(self.workdir, "wd0.img")
+        path = os.path.join(self.workdir, "wd0.img")
+        if self.ephemeral_dir is None or os.path.exists(path):
+            return path
+        return self.ephemeral_file("wd0.img", parse_size(self.disk_size))
 
     # Return the memory size rounded up to whole megabytes
     def memory_megs(self):
@@ -1279,15 +4293,18 @@ class Anita(object):
         return megs
 
     def configure_child(self, child):
-        # Log reads from child
-        child.logfile_read = multifile([self.unstructured_log_f, Logger('recv', self.structured_log_f)])
+        # Log reads from child, and track the screen contents
+        self.screen = Screen()
+        child.logfile_read = multifile([self.unstructured_log_f, Logger('recv', self.structured_log_f),
+                                        self.screen])
         # Log writes to child
         child.logfile_send = Logger('send', self.structured_log_f)
         child.timeout = 3600
         child.setecho(False)
         # Xen installs sometimes fail if we don't increase this
         # from the default of 0.1 seconds.  And powering down noemu
-        # using iLO3 over ssh takes more than 5 seconds.
+        # using iLO3 over ssh takes more than 5 seconds.  With
+        # pexpect 4, these are upper bounds; see polled_ptyprocess.
         child.delayafterclose = 30.0
         # Also increase this just in case
         child.delayafterterminate = 30.0
@@ -1298,6 +4315,110 @@ class Anita(object):
             ptyproc.delayafterterminate = child.delayafterterminate
         self.halted = False
         self.child = child
+        child.watchdog = self.watchdog
+
+    # Wait until the console has been quiet for "quiet" seconds and
+    # predicate(self.screen) returns true, or raise pexpect.TIMEOUT
+    # after "timeout" seconds.  The console output received so far
+    # is then discarded from the expect buffer, as the caller is
+    # expected to act on the screen contents rather than on matching
+    # that output.
+    def wait_for_screen(self, child, predicate, timeout = 3600, quiet = 0.2):
+        deadline = time.time() + timeout
+        while True:
+            wait_for_quiet(child, quiet, max(deadline - time.time(), quiet))
+            if predicate(self.screen):
+                break
+            if time.time() >= deadline:
+                raise pexpect.TIMEOUT("timeout waiting for screen:\n" +
+                                      self.screen.text())
+        child.buffer = child.buffer[:0]
+
+    # Enter a new phase of the run, or end the current one if "phase"
+    # is None.  Records the duration of the previous phase in the
+    # history, unless it was an install resumed from a checkpoint,
+    # and limits the duration of the new one based on the history.
+    def set_phase(self, phase):
+        now = time.time()
+        if self.phase in history_phases and self.history and \
+           not self.phase_resumed:
+            self.history.add_phase(self.run_id, self.dist.arch(),
+                                   self.history_vmm(),
+                                   self.history_phase(self.phase),
+                                   self.phase_start, now - self.phase_start)
+            if self.phase == 'boot':
+                self.history.update_run(self.run_id, {
+                    'boot_to_login': now - self.phase_start
+                })
+        self.phase = phase
+        self.phase_start = now
+        self.phase_resumed = phase == 'install' and \
+            self.resume_checkpoint is not None
+        if phase is None:
+            return
+        limit = None
+        if phase in history_phases:
+            limit = self.phase_timeout(phase, None)
+        if limit is None:
+            self.slog("phase %s" % phase)
+        elif self.watchdog:
+            self.slog("phase %s, limit %d seconds" % (phase, limit))
+        else:
+            self.slog("phase %s, limit %d seconds not enforced without the watchdog" %
+                      (phase, limit))
+        if self.watchdog:
+            self.watchdog.set_phase(phase, limit)
+
+    # The name of "phase" in the history.  The duration of the tests
+    # depends on which tests are run, so test runs are only compared
+    # with others using the same test tool.
+    def history_phase(self, phase):
+        if phase == 'tests':
+            return 'tests-' + self.tests
+        return phase
+
+    # The VMM as identified in the history, including the qemu
+    # accelerator, as run times with and without hardware
+    # acceleration are not comparable
+    def history_vmm(self):
+        if self.vmm == 'qemu':
+            self.choose_qemu_accel()
+            return 'qemu-%s' % (self.qemu_accel or 'default')
+        return self.vmm
+
+    # Return the timeout for "phase" derived from the history, or
+    # "default" if there isn't enough history
+    def phase_timeout(self, phase, default):
+        if not self.history:
+            return default
+        t = self.history.phase_timeout(self.dist.arch(), self.history_vmm(),
+                                       self.history_phase(phase))
+        if t is None:
+            return default
+        return t
+
+    # Called by the watchdog when it detects a problem.  If the guest
+    # is at the ddb prompt, or can be made to enter ddb, gather
+    # diagnostics from ddb into the log, then give up.
+    def watchdog_hit(self, child, what, kind):
+        print("watchdog: %s" % what, file=sys.stderr)
+        self.slog("watchdog: %s" % what)
+        if kind == 'firmware':
+            raise WatchdogError(what)
+        ddb_prompt = watchdog_crash_patterns[0]
+        try:
+            if kind == 'hang' and self.vmm == 'qemu':
+                # Send a break through the qemu console multiplexer,
+                # which enters ddb if the kernel is alive enough
+                child.send("\001b")
+            if kind != 'ddb':
+                child.expect(ddb_prompt, timeout = 10)
+            for cmd in ("bt", "ps", "show registers"):
+                child.send(cmd + "\n")
+                child.expect(ddb_prompt, timeout = 30)
+        except (pexpect.TIMEOUT, pexpect.EOF):
+            self.slog("watchdog: could not get diagnostics from ddb")
+        raise WatchdogError(what)
 
     def start_simh(self, vmm_args = []):
         f = open(os.path.join(self.workdir, 'netbsd.ini'), 'w')
@@ -1331,9 +4452,10 @@ class Anita(object):
         f.close()
         return data == b'EFI PART'
 
-    def start_qemu(self, vmm_args, snapshot_system_disk):
+    def start_qemu(self, vmm_args, snapshot_system_disk, incoming = None):
         # Log the qemu version to stdout
-        subprocess.call([self.qemu, '--version'])
+        if not self.replay_log:
+            subprocess.call([self.qemu, '--version'])
         try:
             # Identify the exact qemu version in pkgsrc if applicable,
             # ignoring exceptions that may be raised if qemu was not
@@ -1348,11 +4470,18 @@ class Anita(object):
             f('glib2 package', ['pkg_info', '-e', 'glib2'])
         except:
             pass
+        self.choose_qemu_accel()
+        self.system_disk_snapshotted = snapshot_system_disk
+        other_args = vmm_args + self.extra_vmm_args + self.arch_vmm_args()
         qemu_args = [
                 "-m", str(self.memory_megs())
             ] + self.qemu_disk_args(self.wd0_path(), 0, True, snapshot_system_disk) + [
                 "-nographic"
-            ] + vmm_args + self.extra_vmm_args + self.arch_vmm_args()
+            ] + self.qemu_accel_args(other_args) + other_args
+        # Use the selected NIC model unless a NIC was configured above
+        if self.nic_model is not None and not '-nic' in qemu_args:
+            qemu_args += ['-nic', 'user,' + qemu_format_attrs(self.qemu_nic_attrs())]
+            self.slog("expecting network interface %s" % self.nic_name())
         # Deal with virtio device ordering issues
         arch = self.dist.arch()
         if arch == 'evbarm-aarch64' or \
@@ -1371,12 +4500,111 @@ class Anita(object):
                 rootdev = 'ld4a'
             qemu_args += [ '-append', 'root=' + rootdev ]
 
+        self.qemu_hardware = qemu_hardware_args(qemu_args)
+
+        # Restore a saved guest state if requested
+        if incoming:
+            qemu_args += ['-incoming', incoming]
+
+        # Add a QMP socket for controlling qemu, in a temporary
+        # directory of its own, as the length of socket paths is
+        # limited
+        self.cleanup_qmp()
+        if not '-qmp' in qemu_args and not self.replay_log:
+            self.qmp_dir = tempfile.mkdtemp(prefix = 'anita-qmp-')
+            qemu_args += ['-qmp', 'unix:%s,server=on,wait=off' %
+                          os.path.join(self.qmp_dir, 'qmp.sock')]
+
         # Start the actual qemu child process
         child = self.pexpect_spawn(self.qemu, qemu_args)
         self.configure_child(child)
 
         return child
 
+    # Return true if the qemu arguments "args" choose an accelerator
+
+    def qemu_args_choose_accel(self, args):
+        return any([arg in args for arg in ('-accel', '-enable-kvm', '-no-kvm')]) or \
+            any(['accel=' in arg for arg in args])
+
+    # Choose the qemu accelerator and number of virtual CPUs to use,
+    # unless the user has already done so using --vmm-args.  With
+    # an accelerator of "auto", the first hardware accelerator
+    # that is supported by both the host and qemu is used, provided
+    # that the guest architecture matches the host; otherwise, we
+    # fall back on TCG emulation.
+
+    def choose_qemu_accel(self):
+        if self.qemu_accel_chosen:
+            return
+        self.qemu_accel_chosen = True
+        user_args = self.extra_vmm_args
+        accel = None
+        if self.accel == 'none' or self.qemu_args_choose_accel(user_args):
+            pass
+        elif self.accel == 'auto':
+            supported = qemu_accels(self.qemu)
+            if supported is None:
+                print("qemu does not list its accelerators, using its default")
+            else:
+                hw_ok = host_machines() & \
+                    set(self.get_arch_vmm_prop('host_machines') or [])
+                if hw_ok:
+                    for name, host_has in qemu_hw_accels:
+                        if name in supported and host_has():
+                            accel = name
+                            break
+                if accel is None and 'tcg' in supported:
+                    accel = 'tcg'
+        else:
+            # Explicitly requested; assume the user knows best
+            accel = self.accel
+        self.qemu_accel = accel
+
+        cpus = None
+        if '-smp' in user_args:
+            pass
+        elif str(self.cpus).startswith('auto'):
+            max_cpus = self.get_arch_vmm_prop('max_cpus') or 1
+            cpus = min(max_cpus, host_cpus())
+            # "auto:N" limits the automatic choice to N CPUs
+            if str(self.cpus).startswith('auto:'):
+                cpus = min(cpus, int(self.cpus[5:]))
+        else:
+            cpus = int(self.cpus)
+        self.qemu_cpus = cpus
+
+        print("accelerator:", accel or "qemu default")
+        print("virtual CPUs:", cpus or "qemu default")
+        self.slog("accelerator %s, %s virtual CPUs" % (accel, cpus))
+
+    # Return the qemu command line arguments implementing the choices
+    # made by choose_qemu_accel(), leaving out those already given in
+    # the other qemu arguments "other_args", which may include more
+    # than the --vmm-args seen by choose_qemu_accel()
+
+    def qemu_accel_args(self, other_args):
+        accel = self.qemu_accel
+        cpus = self.qemu_cpus
+        if self.qemu_args_choose_accel(other_args):
+            accel = None
+        if '-smp' in other_args:
+            cpus = None
+        a = []
+        if accel:
+            if accel == 'tcg' and cpus and cpus > 1:
+                # Run each virtual CPU in a host thread of its own
+                a += ['-accel', 'tcg,thread=multi']
+            else:
+                a += ['-accel', accel]
+            if accel in ('kvm', 'hvf') and \
+               self.dist.arch() in ('i386', 'amd64'):
+                if not '-cpu' in other_args:
+                    a += ['-cpu', 'host']
+        if cpus and cpus > 1:
+            a += ['-smp', str(cpus)]
+        return a
+
     def xen_disk_arg(self, path, devno = 0, cdrom = False):
         writable = not cdrom
         if self.vmm == 'xm':
@@ -1394,36 +4622,130 @@ class Anita(object):
             s += ",cdrom"
         return s
 
+    # Return the qemu drive attributes implementing the disk I/O
+    # policy.  If the policy is "auto", choose "throwaway" if the
+    # system disk is snapshotted, "throttled" if I/O limits have been
+    # given, and "durable" otherwise.
+
+    def qemu_disk_io_attrs(self, snapshot):
+        policy = self.disk_io_policy
+        if policy == 'auto':
+            if self.disk_iops or self.disk_bps:
+                policy = 'throttled'
+            elif snapshot:
+                policy = 'throwaway'
+            else:
+                policy = 'durable'
+        attrs = list(disk_io_policies[policy])
+        if policy == 'throwaway':
+            if self.io_uring_ok is None:
+                self.io_uring_ok = qemu_has_io_uring(self.qemu)
+            if self.io_uring_ok:
+                attrs += [('aio', 'io_uring')]
+        elif policy == 'throttled':
+            if self.disk_iops:
+                attrs += [('throttling.iops-total', str(self.disk_iops))]
+            if self.disk_bps:
+                attrs += [('throttling.bps-total', str(self.disk_bps))]
+        return attrs
+
     def qemu_disk_args(self, path, devno = 0, writable = True, snapshot = False):
         drive_attrs = [
             ('file', path),
             ('format', 'raw'),
             ('media', 'disk'),
-            ('snapshot', ["off", "on"][snapshot])
+            ('snapshot', ["off", "on"][snapshot]),
+            ('id', 'hd%d' % devno),
         ]
+        # Disks other than the system disk are never snapshotted,
+        # but they share the fate of the system disk: if it is
+        # thrown away at the end of the run, so are they (after
+        # any results have been extracted).
+        if devno == 0:
+            run_is_throwaway = snapshot
+        else:
+            run_is_throwaway = not self.persist
+        drive_attrs += self.qemu_disk_io_attrs(run_is_throwaway)
         dev_args = []
         if self.dist.arch() == 'evbarm-earmv7hf' and self.machine == 'virt' or \
            self.dist.arch() == 'evbarm-aarch64' or \
            self.dist.arch() == 'riscv-riscv64':
             # Use virtio
-            drive_attrs += [('if', 'none'), ('id', 'hd%d' % devno)]
+            drive_attrs += [('if', 'none')]
             dev_args += ['-device', 'virtio-blk-device,drive=hd%d' % devno]
         elif self.dist.arch() == 'evbarm-earmv7hf':
             # Use SD card
             drive_attrs += [('if', 'sd')]
+        elif self.disk_interface == 'virtio':
+            # The disks attach as ld0, ld1, ... in command line order
+            drive_attrs += [('if', 'none')]
+            dev_args += ['-device', 'virtio-blk-pci,drive=hd%d' % devno]
+        elif self.disk_interface == 'ahci':
+            # The disks attach as wd0, wd1, ... one per AHCI port.
+            # The controller is created along with the system disk.
+            drive_attrs += [('if', 'none')]
+            if devno == 0:
+                dev_args += ['-device', 'ahci,id=ahci']
+            dev_args += ['-device', 'ide-hd,drive=hd%d,bus=ahci.%d' % (devno, devno)]
         else:
             pass
         return ["-drive", qemu_format_attrs(drive_attrs)] + dev_args
 
-    def qemu_add_cdrom(self, path, extra_attrs = None):
+    # Return the qemu NIC attributes for the selected NIC model, if any
+    def qemu_nic_attrs(self):
+        if self.nic_model is None:
+            return []
+        return [('model', qemu_nic_models[self.nic_model][0])]
+
+    # The name of the guest network interface we expect to be used,
+    # or None if not known
+    def nic_name(self):
+        if self.nic_model is None:
+            return None
+        return qemu_nic_models[self.nic_model][1] + '0'
+
+    # The NetBSD device name of the system disk, without partition
+    # letter, as seen by a guest using the selected disk interface,
+    # or None if not known
+    def system_disk_name(self):
+        if self.disk_interface == 'virtio':
+            return 'ld0'
+        elif self.dist.arch() in ('i386', 'amd64') and self.vmm == 'qemu':
+            return 'wd0'
+        return None
+
+    # The NetBSD device name of the raw partition of the scratch disk
+    # used for exporting data from the guest, or None if there is none
+    def scratch_disk(self):
+        if vmm_is_xen(self.vmm):
+            return 'xbd1d'
+        elif self.dist.arch() == 'evbarm-earmv7hf' and self.machine == 'virt':
+            return 'ld5c'
+        elif self.disk_interface == 'virtio':
+            return 'ld1d'
+        else:
+            return self.get_arch_prop('scratch_disk')
+
+    # Return the qemu arguments for adding a CD-ROM drive containing
+    # the image "path", and the NetBSD device name of the drive.  If
+    # path is None, the drive is created empty, and media can be
+    # inserted later using the drive ID "drive_id".
+    def qemu_add_cdrom(self, path, extra_attrs = None, drive_id = None):
         if extra_attrs is None:
             extra_attrs = []
-        drive_attrs = [
-            ('file', path),
-            ('format', 'raw'),
+        if path is None:
+            drive_attrs = []
+        else:
+            drive_attrs = [
+                ('file', path),
+                ('format', 'raw'),
+            ]
+        drive_attrs += [
             ('media', 'cdrom'),
             ('readonly', 'on'),
         ]
+        if drive_id:
+            drive_attrs += [('id', drive_id)]
         if self.dist.arch() in ('macppc', 'sparc64'):
             assert(self.n_cdrom == 0)
             drive_attrs += [('index', '2')]
@@ -1503,14 +4825,40 @@ class Anita(object):
 
         def cleanup_domu():
             spawn(self.vmm, [self.vmm, "destroy", name])
-        self.cleanup_child_func = cleanup_domu
+        if not self.replay_log:
+            self.cleanup_child_func = cleanup_domu
 
         return child
 
+    # Start the built-in distribution server if not running already,
+    # serving the downloaded distribution over HTTP and TFTP and
+    # receiving uploads by TFTP into the work directory
+    def start_dist_server(self):
+        if self.dist_server:
+            return
+        # Listen only on the address the guest reaches us at, unless
+        # configured otherwise, and accept only the test results
+        self.dist_server = DistServer(self.dist.download_local_mi_dir(),
+                                      {'tests-results.img':
+                                       os.path.join(self.workdir, 'tests-results.img')},
+                                      self.net_config.get('bind_addr') or self.server_addr(),
+                                      int(self.net_config.get('http_port') or 8080),
+                                      int(self.net_config.get('tftp_port') or 6969),
+                                      self.slog)
+        self.slog("distribution server listening on HTTP port %d and TFTP port %d" %
+                  (self.dist_server.http_port, self.dist_server.tftp_port))
+
+    # The address of the server for installing the sets over HTTP
+    # and uploading the test results by TFTP, as seen by the guest
+    def server_addr(self):
+        return self.net_config.get('serveraddr') or "10.169.0.1"
+
     def start_noemu(self, vmm_args):
+        if self.use_dist_server:
+            self.start_dist_server()
         noemu_always_args = [
             '--workdir', self.workdir,
-            '--releasedir', os.path.join(self.workdir, 'download'),
+            '--releasedir', self.dist.download_local_mi_dir(),
             '--arch', self.dist.arch()
         ]
         child = self.pexpect_spawn('sudo', ['noemu'] +
@@ -1559,10 +4907,12 @@ class Anita(object):
             child.logfile_send = CensorLogger(old_logfile_send)
             child.logfile_read = CensorLogger(old_logfile_read)
             child.send(text)
-            gather_input(child, 1)
+            # Wait for the echo, so that it too is censored
+            t = wait_for_quiet(child, 0.5, 1)
         finally:
             child.logfile_send = old_logfile_send
             child.logfile_read = old_logfile_read
+        self.slog("waited %.3f seconds for entropy echo" % t)
         child.send('\n')
         if multiline:
             child.send('\n')
@@ -1581,13 +4931,108 @@ class Anita(object):
             child.send(time.strftime(format, now).encode('ASCII') + b"\n")
         child.send(b"f\n")
 
+    # Return the kind of media to boot the installer from
+    def install_boot_from(self):
+        if self.boot_from is None:
+            self.boot_from = self.dist.boot_from_default()
+        if self.boot_from is None:
+            self.boot_from = 'cdrom'
+        return self.boot_from
+
+    # Return true if the install can be pipelined, that is, the
+    # installer started before the sets have been downloaded.  This
+    # requires qemu, which lets us insert the sets CD later, and boot
+    # media separate from the sets.
+    def install_can_be_pipelined(self):
+        return self.vmm == 'qemu' and \
+            not self.get_arch_prop('image_name') and \
+            self.dist.sets_iso_is_generated() and \
+            self.dist.arch() != 'macppc' and \
+            self.install_boot_from() in ('floppy', 'cdrom', 'kernel')
+
+    # The part of a pipelined install that runs in the background
+    # while the installer boots: fill in the disk image if dense, then
+    # download the sets and build the sets ISO
+    def prepare_install_sets(self):
+        if self.image_format == 'dense':
+            densify_image(self.wd0_path(), parse_size(self.disk_size),
+                          self.install_cancel)
+        self.install_disk_ready.set()
+        self.dist.download_sets(cancel = self.install_cancel)
+        if self.install_cancel.is_set():
+            raise RuntimeError("cancelled")
+        if self.ephemeral_dir:
+            iso_path = self.ephemeral_file(self.dist.install_sets_iso_name(),
+                self.dist.install_sets_size())
+            self.dist.sets_iso_dir = os.path.dirname(iso_path)
+        self.dist.make_install_sets_iso()
+
+    # In a pipelined install, wait until the disk image is ready
+    # to be written by the guest
+    def wait_install_disk(self, child):
+        if self.install_prep is None:
+            return
+        t = gather_input_until(child, self.install_disk_ready)
+        self.install_prep.check()
+        self.slog("waited %.3f seconds for the disk image" % t)
+
+    # In a pipelined install, wait until the sets ISO is ready
+    # and insert it in the sets CD-ROM drive
+    def wait_install_sets(self, child):
+        if self.install_prep is None:
+            return
+        t = gather_input_until(child, self.install_prep.done)
+        self.install_prep.check()
+        self.slog("waited %.3f seconds for the install sets" % t)
+        self.install_prep = None
+        if self.sets_cd_pending:
+            self.qemu_change_media(child, 'setscd',
+                                   self.dist.install_sets_iso_path())
+            self.sets_cd_pending = False
+
+    # Change the media in the qemu drive "device" to the image "path",
+    # using QMP if possible, or else the qemu monitor multiplexed on
+    # the console.  Does not send anything to the guest.
+    def qemu_change_media(self, child, device, path):
+        if self.qmp_change_media(device, path):
+            return
+        # Escape into qemu command mode
+        child.send("\001c")
+        child.send(b"change " + device.encode('ASCII') + b" " +
+                   path.encode('ASCII') + b"\n")
+        # Exit qemu command mode
+        child.send("\001c")
+
     def _install(self):
-        # Download or build the install ISO
         self.dist.set_workdir(self.workdir)
+        if self.install_method == 'host':
+            self._install_on_host()
+            return
+        self.resume_checkpoint = self.latest_install_checkpoint()
+        if self.resume_checkpoint:
+            print("resuming the install from checkpoint %s" %
+                  self.resume_checkpoint['name'])
+        # The guest state of a checkpoint includes the sets CD, so
+        # a resumed install is done sequentially
+        if self.pipelined_install and not self.resume_checkpoint:
+            if self.install_can_be_pipelined():
+                self._install_pipelined()
+                return
+            print("note: this install cannot be pipelined, doing it sequentially")
+        # Download or build the install ISO
         if self.get_arch_prop('image_name'):
             self.dist.download()
         else:
-            self.dist.make_install_sets_iso()
+            if self.ephemeral_dir and self.dist.sets_iso_is_generated():
+                # Download first so that we know how big the ISO
+                # will be, and can decide where to put it
+                self.dist.download()
+                iso_path = self.ephemeral_file(self.dist.install_sets_iso_name(),
+                    self.dist.install_sets_size())
+                self.dist.sets_iso_dir = os.path.dirname(iso_path)
+            # A streamed ISO is set up when qemu is started
+            if not self.want_iso_stream():
+                self.dist.make_install_sets_iso()
         # Build the runtime boot ISO if needed
         if self.dist.arch() == 'macppc':
             self.dist.make_runtime_boot_iso()
@@ -1603,10 +5048,36 @@ class Anita(object):
         else:
             self._install_using_sysinst()
 
+    # Start the installer as soon as the boot media have been
+    # downloaded, while creating the disk image and downloading the
+    # sets in the background.  The conversation with sysinst waits
+    # for the background work to be done only when it gets to a point
+    # where the disk is written or the sets are needed.
+    def _install_pipelined(self):
+        self.dist.download_boot_media()
+        print("Creating hard disk image...", end=' ')
+        sys.stdout.flush()
+        make_sparse_image(self.wd0_path(), parse_size(self.disk_size))
+        print("done.")
+        sys.stdout.flush()
+        self.install_disk_ready = threading.Event()
+        # Set to have the background task give up early when the
+        # install fails
+        self.install_cancel = threading.Event()
+        self.install_prep = BackgroundTask(self.prepare_install_sets)
+        try:
+            self._install_using_sysinst()
+        finally:
+            if self.install_prep:
+                # Don't leave the background task writing to the
+                # disk image while it is being removed
+                self.install_cancel.set()
+                self.install_prep.done.wait()
+                self.install_prep = None
+
     def _install_from_image(self):
         image_name = self.get_arch_prop('image_name')
-        gzimage_fn = os.path.join(self.workdir,
-            'download', self.dist.arch(),
+        gzimage_fn = os.path.join(self.dist.download_local_arch_dir(),
             'binary', 'gzimg', image_name)
         print("Decompressing image...", end=' ')
         gzimage = open(gzimage_fn, 'r')
@@ -1616,12 +5087,13 @@ class Anita(object):
         print("done.")
         # Unzip the kernel, whatever its name
         for kernel_name in self.get_arch_prop('kernel_name'):
-            gzkernel_fn = os.path.join(self.workdir,
-                'download', self.dist.arch(), 'binary', 'kernel', kernel_name)
+            gzkernel_fn = os.path.join(self.dist.download_local_arch_dir(),
+                'binary', 'kernel', kernel_name)
             if not os.path.exists(gzkernel_fn):
                 continue
             kernel_name_nogz = kernel_name[:-3]
-            kernel_fn = os.path.join(self.workdir, kernel_name_nogz);
+            kernel_fn = self.ephemeral_file(kernel_name_nogz,
+                                            4 * os.path.getsize(gzkernel_fn))
             gunzip(gzkernel_fn, kernel_fn)
 
         # Boot the system to let it resize the image.
@@ -1631,9 +5103,198 @@ class Anita(object):
         self.child.expect(r"login:")
         self.halt()
 
+    # Install the system by building the disk image on the host,
+    # without booting the guest: extract the sets into a staging
+    # directory, create a root file system from it with makefs,
+    # install the bootblocks, and partition the disk.  This requires
+    # the NetBSD tools makefs, installboot, fdisk, and disklabel,
+    # which on a non-NetBSD host must be cross-built and installed
+    # with an "nb" prefix.
+    def _install_on_host(self):
+        self.dist.download_sets()
+        arch = self.dist.arch()
+        set_paths = []
+        for set in self.dist.flat_sets:
+            if not set['install']:
+                continue
+            for ext in set_exts:
+                path = os.path.join(self.dist.download_local_mi_dir(),
+                                    *self.dist.set_path(set['filename'], ext))
+                if os.path.exists(path):
+                    set_paths.append(path)
+                    break
+
+        # Lay out the disk: an MBR partition for NetBSD starting at
+        # 1 MB, divided into a root partition and a swap partition
+        sector_size = 512
+        disk_bytes = parse_size(self.disk_size)
+        total_sectors = disk_bytes // sector_size
+        part_start = 2048
+        part_sectors = total_sectors - part_start
+        swap_sectors = min(self.memory_size_bytes // sector_size,
+                           part_sectors // 4)
+        root_sectors = part_sectors - swap_sectors
+
+        staging = self.ephemeral_file('hostinstall',
+            3 * sum([os.path.getsize(p) for p in set_paths]))
+        fs_image = self.ephemeral_file('root.img', root_sectors * sector_size)
+        rm_tree(staging)
+        mkdir_p(staging)
+        try:
+            spec = {}
+            for path in set_paths:
+                print("Extracting %s..." % os.path.basename(path), end=' ')
+                sys.stdout.flush()
+                self.extract_set(path, staging, spec)
+                print("done.")
+                sys.stdout.flush()
+
+            disk = self.system_disk_name()
+            def add_file(name, content, mode, append = False):
+                f = open(os.path.join(staging, name), ('wb', 'ab')[append])
+                f.write(content)
+                f.close()
+                spec[name] = 'type=file mode=%04o uname=root gname=wheel' % mode
+
+            # Do the configuration sysinst would do
+            add_file('etc/fstab', (
+                "/dev/%sa / ffs rw 1 1\n" % disk +
+                "/dev/%sb none swap sw,dp 0 0\n" % disk +
+                "kernfs /kern kernfs rw\n" +
+                "procfs /proc procfs rw,noauto\n").encode('ASCII'), 0o644)
+            add_file('etc/rc.conf', b"rc_configured=YES\n", 0o644, append = True)
+            if not self.no_entropy:
+                add_file('var/db/entropy-file', make_entropy_file(32), 0o600)
+            shutil.copyfile(os.path.join(staging, 'usr/mdec/boot'),
+                            os.path.join(staging, 'boot'))
+            spec['boot'] = 'type=file mode=0444 uname=root gname=wheel'
+
+            specfile = os.path.join(self.workdir, 'hostinstall.spec')
+            f = open(specfile, 'w')
+            for name in sorted(spec.keys()):
+                f.write("./%s %s\n" % (mtree_vis(name), spec[name]))
+            f.write(self.device_spec(os.path.join(staging, 'dev')))
+            f.close()
+
+            # Create the root file system and make it bootable
+            if os.path.exists(os.path.join(staging, 'usr/mdec/bootxx_ffsv2')):
+                ffs_version = 2
+            else:
+                ffs_version = 1
+            rm_f(fs_image)
+            spawn(netbsd_tool('makefs'), [netbsd_tool('makefs'),
+                '-t', 'ffs', '-B', 'le', '-o', 'version=%d' % ffs_version,
+                '-s', str(root_sectors * sector_size),
+                '-N', os.path.join(staging, 'etc'), '-F', specfile,
+                fs_image, staging])
+            spawn(netbsd_tool('installboot'), [netbsd_tool('installboot'),
+                '-m', arch, '-o', 'console=com0', fs_image,
+                os.path.join(staging, 'usr/mdec/bootxx_ffsv%d' % ffs_version)])
+
+            # Create the disk image, partition it, and copy in the
+            # root file system
+            print("Creating hard disk image...", end=' ')
+            sys.stdout.flush()
+            make_image(self.wd0_path(), disk_bytes, self.image_format)
+            print("done.")
+            sys.stdout.flush()
+            spawn(netbsd_tool('fdisk'), [netbsd_tool('fdisk'),
+                '-f', '-u', '-0', '-a',
+                '-s', '169/%d/%d' % (part_start, part_sectors),
+                '-F', self.wd0_path()])
+            spawn(netbsd_tool('fdisk'), [netbsd_tool('fdisk'),
+                '-f', '-i', '-c', os.path.join(staging, 'usr/mdec/mbr'),
+                '-F', self.wd0_path()])
+            src = open(fs_image, 'rb')
+            dst = open(self.wd0_path(), 'r+b')
+            dst.seek(part_start * sector_size)
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+            dst.close()
+            src.close()
+
+            proto = os.path.join(self.workdir, 'hostinstall.disklabel')
+            f = open(proto, 'w')
+            f.write(disklabel_proto(total_sectors, [
+                ('a', root_sectors, part_start, '4.2BSD'),
+                ('b', swap_sectors, part_start + root_sectors, 'swap'),
+                ('c', part_sectors, part_start, 'unused'),
+                ('d', total_sectors, 0, 'unused'),
+            ]))
+            f.close()
+            spawn(netbsd_tool('disklabel'), [netbsd_tool('disklabel'),
+                '-R', '-F', '-M', arch, self.wd0_path(), proto])
+        finally:
+            rm_tree(staging)
+            rm_f(fs_image)
+
+    # Extract the set "path" into the directory "dir", and add mtree
+    # specification keywords for the ownership, permissions, and type
+    # of its contents to the dict "spec", indexed by path name.
+    # Device nodes are not extracted but only added to the spec.
+    def extract_set(self, path, dir, spec):
+        tf = tarfile.open(path, 'r:*')
+        members = []
+        for m in tf:
+            name = re.sub(r'^(\./)+', '', m.name).rstrip('/')
+            if name == '.' or name == '':
+                continue
+            # The sets may come from an arbitrary URL; don't let them
+            # write outside "dir"
+            for n in [m.name] + ([m.linkname] if m.islnk() else []):
+                if os.path.isabs(n) or '..' in n.split('/'):
+                    raise RuntimeError("unsafe path name %s in %s" % (n, path))
+            if m.isdir():
+                kw = 'type=dir'
+            elif m.issym():
+                kw = 'type=link link=%s' % mtree_vis(m.linkname)
+            elif m.ischr() or m.isblk():
+                kw = 'type=%s device=netbsd,%d,%d' % \
+                    (('block', 'char')[m.ischr()], m.devmajor, m.devminor)
+            elif m.isfile() or m.islnk():
+                kw = 'type=file'
+            else:
+                continue
+            if not (m.ischr() or m.isblk()):
+                members.append(m)
+            kw += ' mode=%04o' % (m.mode & 0o7777)
+            kw += ' uname=%s' % m.uname if m.uname else ' uid=%d' % m.uid
+            kw += ' gname=%s' % m.gname if m.gname else ' gid=%d' % m.gid
+            spec[name] = kw
+        if hasattr(tarfile, 'tar_filter'):
+            # The modes are taken from the spec, so it doesn't matter
+            # that this filter clears the setuid and group/other write
+            # bits on the extracted files
+            tf.extractall(dir, members, filter = 'tar')
+        else:
+            tf.extractall(dir, members)
+        tf.close()
+
+    # Return mtree specification lines for the device nodes in the
+    # target /dev directory "devdir", as generated by its MAKEDEV
+    # script.  If MAKEDEV can't be run on this host, return nothing
+    # and let init create the device nodes on a tmpfs at boot time.
+    def device_spec(self, devdir):
+        try:
+            output = subprocess.check_output(['sh', './MAKEDEV', '-s', 'all'],
+                                             cwd = devdir, stderr = fnull)
+        except (OSError, subprocess.CalledProcessError):
+            print("warning: could not run MAKEDEV on the host, " +
+                  "device nodes will be created at boot time", file=sys.stderr)
+            return ''
+        lines = []
+        for line in output.decode('ASCII', 'replace').splitlines():
+            if line.startswith('. ') or not line.startswith('.'):
+                continue
+            lines.append('./dev' + line[1:] + '\n')
+        return ''.join(lines)
+
     def _install_using_sysinst(self):
+        self.set_phase('install')
+        self.n_cdrom = 0
         # The name of the CD-ROM device holding the sets
         sets_cd_device = None
+        # The checkpoint to resume from, if any
+        resume = self.resume_checkpoint
 
         arch = self.dist.arch()
 
@@ -1643,11 +5304,13 @@ class Anita(object):
                 xenkernels = [k for k in [
                     self.dist.xen_boot_kernel(type = self.xen_type),
                     self.dist.xen_install_kernel(type = self.xen_type)] if k]
+                got = []
                 for kernel in xenkernels:
-                    download_if_missing_3(self.dist.dist_url(),
+                    self.dist.fetch(got, self.dist.dist_url(),
                             self.dist.download_local_arch_dir(),
                             ["binary", "kernel", kernel],
                             True)
+                self.dist.verify_downloads(got)
             vmm_args = []
             vmm_args += self.xen_args(install = True)
             if self.xen_type == 'pv' or self.xen_type == 'pvshim' or self.xen_type == 'pvh':
@@ -1670,32 +5333,37 @@ class Anita(object):
             # Determine what kind of media to boot from.
             floppy_paths = [ os.path.join(self.dist.floppy_dir(), f) \
                 for f in self.dist.floppies() ]
-            if self.boot_from is None:
-                self.boot_from = self.dist.boot_from_default()
-            if self.boot_from is None:
-                self.boot_from = 'cdrom'
+            self.install_boot_from()
 
             sets_cd_device = None
 
+            # In a pipelined install, the sets CD-ROM drive starts
+            # out empty
+            if self.install_prep:
+                sets_iso_path = None
+                self.sets_cd_pending = True
+            else:
+                sets_iso_path = self.install_sets_iso_file()
+
             # Set up VM arguments based on the chosen boot media
             if self.boot_from == 'cdrom':
                 if self.dist.arch() in ['macppc']:
                     # Boot from the CD we just built, with the sets.
                     # The drive must have index 2.
-                    cd_path = self.dist.install_sets_iso_path()
+                    cd_path = sets_iso_path or self.dist.install_sets_iso_path()
                     vmm_args, sets_cd_device = self.qemu_add_cdrom(cd_path)
                     vmm_args += [ "-prom-env", "boot-device=cd:,netbsd-INSTALL" ]
                 else:
                     # Boot from a downloaded boot CD w/o sets
                     cd_path = os.path.join(self.dist.boot_iso_dir(), self.dist.boot_isos()[0])
                     vmm_args, dummy = self.qemu_add_cdrom(cd_path)
-                vmm_args += ["-boot", "d"]
+                vmm_args += ["-boot", self.install_boot_order('d')]
             elif self.boot_from == 'floppy':
                 if len(floppy_paths) == 0:
                     raise RuntimeError("found no boot floppies")
                 vmm_args = ["-drive", "file=%s,format=raw,if=floppy,readonly=on"
                             % floppy_paths[0]]
-                vmm_args += ["-boot", "a"]
+                vmm_args += ["-boot", self.install_boot_order('a')]
             elif self.boot_from == 'cdrom-with-sets':
                 # Single CD
                 vmm_args = ["-boot", "d"]
@@ -1746,16 +5414,18 @@ class Anita(object):
                             'user,' +
                             qemu_format_attrs([('id', 'um0'),
                                                ('tftp', tftpdir),
-                                               ('bootfile', pxeboot_com_fn)])]
+                                               ('bootfile', pxeboot_com_fn)] +
+                                              self.qemu_nic_attrs())]
             elif self.boot_from == 'kernel':
                 # alpha
-                cd_path = self.dist.install_sets_iso_path()
-                vmm_args, sets_cd_device = self.qemu_add_cdrom(cd_path)
+                vmm_args, sets_cd_device = self.qemu_add_cdrom(sets_iso_path,
+                                                               drive_id = 'setscd')
                 # Uncompress the installation kernel
-                inst_kernel = os.path.join(self.workdir, 'netbsd_install')
-                gunzip(os.path.join(self.dist.download_local_arch_dir(),
-                                    *arch_props[self.dist.arch()]['inst_kernel'].split(os.path.sep)),
-                       inst_kernel)
+                gzkernel_fn = os.path.join(self.dist.download_local_arch_dir(),
+                    *arch_props[self.dist.arch()]['inst_kernel'].split(os.path.sep))
+                inst_kernel = self.ephemeral_file('netbsd_install',
+                                                  4 * os.path.getsize(gzkernel_fn))
+                gunzip(gzkernel_fn, inst_kernel)
                 vmm_args += ['-kernel', inst_kernel]
             else:
                 raise RuntimeError("unsupported boot-from value %s" % self.boot_from)
@@ -1763,9 +5433,32 @@ class Anita(object):
             # If we don't have a CD with sets already, use the next
             # available CD drive
             if not sets_cd_device:
-                sets_cd_args, sets_cd_device = self.qemu_add_cdrom(self.dist.install_sets_iso_path())
+                sets_cd_args, sets_cd_device = self.qemu_add_cdrom(sets_iso_path,
+                                                                   drive_id = 'setscd')
                 vmm_args += sets_cd_args
-            child = self.start_qemu(vmm_args, snapshot_system_disk = False)
+            # If the VM is going to be reset into the installed
+            # system, it needs the devices of the boot VM, too
+            if self.chain_boot_vmm_args is not None:
+                vmm_args += self.chain_boot_vmm_args
+            incoming = None
+            if resume:
+                copy_image(os.path.join(resume['dir'], 'wd0.img'), self.wd0_path(),
+                           self.image_format == 'sparse')
+                incoming = 'exec:cat ' + \
+                    sh_quote(os.path.abspath(os.path.join(resume['dir'], 'state')))
+            child = self.start_qemu(vmm_args, snapshot_system_disk = False,
+                                    incoming = incoming)
+            if resume and resume['hardware'] != self.qemu_hardware:
+                # The options have changed since the checkpoint was
+                # taken; start over
+                print("warning: install checkpoint %s does not match the virtual hardware, "
+                      "not using it" % resume['name'], file=sys.stderr)
+                self.cleanup_child()
+                self.remove_install_checkpoints()
+                self.resume_checkpoint = None
+                make_image(self.wd0_path(), parse_size(self.disk_size),
+                           self.image_format)
+                return self._install_using_sysinst()
         elif self.vmm == 'noemu':
             child = self.start_noemu(['--boot-from', 'net'])
             if self.dist.arch() in ('i386', 'amd64'):
@@ -1799,144 +5492,165 @@ class Anita(object):
         if self.dist.arch() in ['hpcmips', 'landisk', 'hppa']:
             term = 'vt100'
 
-        # Do the floppy swapping dance and other pre-sysinst interaction
-        floppy0_name = None
-        while True:
-            # NetBSD/i386 will prompt for a terminal type if booted from a
-            # CD-ROM, but not when booted from floppies.  Sigh.
-            r = child.expect([
-                # 0 (was Group 1-2)
-                r"insert disk (\d+), and press return...",
-                # 1 (was Group 3)
-                # Match either the English or the German text.
-                # This is a kludge to deal with kernel messages
-                # like "ciss0: normal state on 'ciss0:1'" that
-                # sometimes appear in the middle of one or the
-                # other, but are unlikely to appear in the middle of
-                # both.  The installation is done in English no
-                # matter which one we happen to match.
-                r"Installation messages in English|Installation auf Deutsch",
-                # 2 (was Group 4)
-                r"Terminal type",
-                # 3 (was Group 5)
-                r"Installation medium to load the additional utilities from: ",
-                # 4 (was Group 6)
-                r"1. Install NetBSD",
-                # 5 (was Group 7)
-                r"\(I\)nstall, \(S\)hell or \(H\)alt",
-                # 6 Erlite3 bootloader
-                r'UBNT_E100',
-            ])
-            if r == 0:
-                # We got the "insert disk" prompt
-                # There is no floppy 0, hence the "- 1"
-                floppy_index = int(child.match.group(1)) - 1
-
-                # Escape into qemu command mode to switch floppies
-                child.send("\001c")
-                # We used to wait for a (qemu) prompt here, but qemu 0.9.1
-                # no longer prints it
-                # child.expect(r'\(qemu\)')
-                if not floppy0_name:
-                    # Between qemu 0.9.0 and 0.9.1, the name of the floppy
-                    # device accepted by the "change" command changed from
-                    # "fda" to "floppy0" without any provision for backwards
-                    # compatibility.  Deal with it.  Also deal with the fact
-                    # that as of qemu 0.15, "info block" no longer prints
-                    # "type=floppy" for floppy drives.  And in qemu 2.5.0,
-                    # the format changed again from "floppy0: " to
-                    # "floppy0 (#block544): ", so we no longer match the
-                    # colon and space.
-                    child.send("info block\n")
-                    child.expect(r'\n(fda|floppy0)')
-                    floppy0_name = child.match.group(1)
-                # Now we can change the floppy
-                child.send(b"change " + floppy0_name + b" " +
-                           floppy_paths[floppy_index].encode('ASCII') + b"\n")
-                # Exit qemu command mode
-                child.send("\001c\n")
-            elif r == 1:
-                # "Installation messages in English"
-                break
-            elif r == 2:
-                # "Terminal type"
-                child.send("xterm\n")
-                term = "xterm"
-            elif r == 3:
-                # "Installation medium to load the additional utilities from"
-                # (SPARC)
-                child.send("cdrom\n")
-                child.expect(r"CD-ROM device to use")
-                child.send("\n")
-                child.expect(r"Path to instfs.tgz")
-                child.send("\n")
-                child.expect(r"Terminal type")
-                # The default is "sun", but anita is more likely to run
-                # in an xterm or some other ansi-like terminal than on
-                # a sun console.
-                child.send("xterm\n")
-                term = "xterm"
-                child.expect(r"nstall/Upgrade")
-                child.send("I\n")
-            elif r == 4:
-                # "1. Install NetBSD"
-                child.send("1\n")
-            elif r == 5:
-                # "(I)nstall, (S)hell or (H)alt ?"
-                child.send("i\n")
-            elif r == 6:
-                child.send('\003') # control-c
-                child.expect('Octeon ubnt_e100#')
-                child.send('dhcp;tftp $loadaddr erlite.elf32;bootoctlinux\r')
-        if self.vmm == 'noemu':
-            self.slog("wait for envsys to settle down")
-            time.sleep(30)
-
-        # Confirm "Installation messages in English"
-        child.send("\n")
+        if resume:
+            # Continue the conversation where the checkpoint was taken
+            self.restore_install_checkpoint(child, resume)
+            term = resume['variables']['term']
+        else:
+            # Do the floppy swapping dance and other pre-sysinst interaction
+            floppy0_name = None
+            while True:
+                # NetBSD/i386 will prompt for a terminal type if booted from a
+                # CD-ROM, but not when booted from floppies.  Sigh.
+                r = child.expect([
+                    # 0 (was Group 1-2)
+                    r"insert disk (\d+), and press return...",
+                    # 1 (was Group 3)
+                    # Match either the English or the German text.
+                    # This is a kludge to deal with kernel messages
+                    # like "ciss0: normal state on 'ciss0:1'" that
+                    # sometimes appear in the middle of one or the
+                    # other, but are unlikely to appear in the middle of
+                    # both.  The installation is done in English no
+                    # matter which one we happen to match.
+                    r"Installation messages in English|Installation auf Deutsch",
+                    # 2 (was Group 4)
+                    r"Terminal type",
+                    # 3 (was Group 5)
+                    r"Installation medium to load the additional utilities from: ",
+                    # 4 (was Group 6)
+                    r"1. Install NetBSD",
+                    # 5 (was Group 7)
+                    r"\(I\)nstall, \(S\)hell or \(H\)alt",
+                    # 6 Erlite3 bootloader
+                    r'UBNT_E100',
+                ])
+                if r == 0:
+                    # We got the "insert disk" prompt
+                    # There is no floppy 0, hence the "- 1"
+                    floppy_index = int(child.match.group(1)) - 1
 
-        # i386 and amd64 ask for keyboard type here; sparc doesn't.
-        # vax may ask for the date.
-        while True:
-            r = child.expect([
-                r"Keyboard type",
-                r"a: Install NetBSD to hard disk",
-                r"Shall we continue",
-                r"Please .* date and time",
-            ])
-            if r == 0 or r == 1:
-                # Keyboard type or Install NetBSD
-                child.send("\n")
-            elif r == 2:
-                # Shall we continue
-                child.expect(r"([a-z]): Yes")
-                child.send(child.match.group(1) + b"\n")
-                break
-            elif r == 3:
-                # date and time
-                self.set_date(child)
-            else:
-                raise AssertionError
+                    if self.vmm == 'qemu' and \
+                       self.qmp_change_media('floppy0', floppy_paths[floppy_index]):
+                        child.send("\n")
+                        continue
+
+                    # Escape into qemu command mode to switch floppies
+                    child.send("\001c")
+                    # We used to wait for a (qemu) prompt here, but qemu 0.9.1
+                    # no longer prints it
+                    # child.expect(r'\(qemu\)')
+                    if not floppy0_name:
+                        # Between qemu 0.9.0 and 0.9.1, the name of the floppy
+                        # device accepted by the "change" command changed from
+                        # "fda" to "floppy0" without any provision for backwards
+                        # compatibility.  Deal with it.  Also deal with the fact
+                        # that as of qemu 0.15, "info block" no longer prints
+                        # "type=floppy" for floppy drives.  And in qemu 2.5.0,
+                        # the format changed again from "floppy0: " to
+                        # "floppy0 (#block544): ", so we no longer match the
+                        # colon and space.
+                        child.send("info block\n")
+                        child.expect(r'\n(fda|floppy0)')
+                        floppy0_name = child.match.group(1)
+                    # Now we can change the floppy
+                    child.send(b"change " + floppy0_name + b" " +
+                               floppy_paths[floppy_index].encode('ASCII') + b"\n")
+                    # Exit qemu command mode
+                    child.send("\001c\n")
+                elif r == 1:
+                    # "Installation messages in English"
+                    break
+                elif r == 2:
+                    # "Terminal type"
+                    child.send("xterm\n")
+                    term = "xterm"
+                elif r == 3:
+                    # "Installation medium to load the additional utilities from"
+                    # (SPARC)
+                    child.send("cdrom\n")
+                    child.expect(r"CD-ROM device to use")
+                    child.send("\n")
+                    child.expect(r"Path to instfs.tgz")
+                    child.send("\n")
+                    child.expect(r"Terminal type")
+                    # The default is "sun", but anita is more likely to run
+                    # in an xterm or some other ansi-like terminal than on
+                    # a sun console.
+                    child.send("xterm\n")
+                    term = "xterm"
+                    child.expect(r"nstall/Upgrade")
+                    child.send("I\n")
+                elif r == 4:
+                    # "1. Install NetBSD"
+                    child.send("1\n")
+                elif r == 5:
+                    # "(I)nstall, (S)hell or (H)alt ?"
+                    child.send("i\n")
+                elif r == 6:
+                    child.send('\003') # control-c
+                    child.expect('Octeon ubnt_e100#')
+                    child.send('dhcp;tftp $loadaddr erlite.elf32;bootoctlinux\r')
+            if self.vmm == 'noemu':
+                self.slog("wait for envsys to settle down")
+                t = wait_for_quiet(child, 5, 30)
+                self.slog("waited %.3f seconds for envsys" % t)
+
+            # Confirm "Installation messages in English"
+            child.send("\n")
+
+            # i386 and amd64 ask for keyboard type here; sparc doesn't.
+            # vax may ask for the date.
+            while True:
+                r = child.expect([
+                    r"Keyboard type",
+                    r"a: Install NetBSD to hard disk",
+                    r"Shall we continue",
+                    r"Please .* date and time",
+                ])
+                if r == 0 or r == 1:
+                    # Keyboard type or Install NetBSD
+                    child.send("\n")
+                elif r == 2:
+                    # Shall we continue
+                    child.expect(r"([a-z]): Yes")
+                    child.send(child.match.group(1) + b"\n")
+                    break
+                elif r == 3:
+                    # date and time
+                    self.set_date(child)
+                else:
+                    raise AssertionError
 
-        # We may or may not get an entropy prompt here.  Then,
-        # dpending on the number of disks attached, we get either
-        # "found only one disk" followed by "Hit enter to continue",
-        # or "On which disk do you want to install".
+            # We may or may not get an entropy prompt here.  Then,
+            # dpending on the number of disks attached, we get either
+            # "found only one disk" followed by "Hit enter to continue",
+            # or "On which disk do you want to install".
 
-        while True:
-            r = child.expect([r'not enough entropy|if a small random seed',
-                              r'Hit enter to continue',
-                              r'On which disk do you want to install'])
-            if r == 0:
-                self.provide_entropy(child)
-            elif r == 1:
-                child.send("\n")
-                break
-            elif r == 2:
-                child.send("a\n")
-                break
-            else:
-                raise AssertionError
+            while True:
+                r = child.expect([r'not enough entropy|if a small random seed',
+                                  r'Hit enter to continue',
+                                  r'On which disk do you want to install'])
+                if r == 0:
+                    self.provide_entropy(child)
+                elif r == 1:
+                    child.send("\n")
+                    break
+                elif r == 2:
+                    # Choose the system disk by name if we know it and
+                    # it is listed, otherwise the first disk
+                    disk = self.system_disk_name()
+                    letter = b"a"
+                    if disk and self.disk_interface != 'ide':
+                        try:
+                            child.expect(r'([a-z]): ' + disk + r'\b', 10)
+                            letter = child.match.group(1)
+                        except pexpect.TIMEOUT:
+                            pass
+                    child.send(letter + b"\n")
+                    break
+                else:
+                    raise AssertionError
 
         def choose_no():
             child.expect(r"([a-z]): No")
@@ -1951,40 +5665,47 @@ class Anita(object):
         labels_seen = set()
 
         def choose_sets(set_list, level = 0):
-            sets_this_screen = []
-            # First parse the set selection screen or popup; it's messy.
-            while True:
-                # Match a letter-label pair, like "h: Compiler Tools",
-                # followed by an installation status of Yes, No, All,
-                # or None.  The label can be separated from the "Yes/No"
-                # field either by spaces (at least two, so that there can
-                # be single spaces within the label), or by a cursor
-                # positioning escape sequence.  The escape sequence may
-                # be preceded by zero or more spaces.  Apparently this
-                # variety arises from the fact that the submenus are drawn
-                # on top of the existing text of the main menu without
-                # clearing the screen inbetween, so that the preexisting
-                # screen content between the label and the "Yes/No" may
-                # or may not consist of spaces that curses can reuse.
-                #
-                # Alternatively, match the special letter "x: " which
-                # is not followed by an installation status.
-                child.expect(
-                    r"(?:([a-z]): ([^ \x1b]+(?: [^ \x1b]+)*)(?:(?:\s\s+)|(?:\s*\x1b\[\d+;\d+H\x00*))(Yes|No|All|None))|(x: )")
-                (letter, label, yesno, exit) = child.match.groups()
-                if exit:
-                    if len(sets_this_screen) != 0:
-                        break
-                else:
-                    #self.slog(label)
+            # Find the sets of "set_list" not handled yet among the
+            # items of the set selection screen or popup, along with
+            # the letters used to select them and their installation
+            # status of Yes, No, All, or None.  The labels of the
+            # sets of the main menu may remain visible on the screen
+            # when a popup is drawn on top of it.
+            def find_sets(screen):
+                found = []
+                for letter, label, yesno, selected, row, col in screen.menu_items():
+                    if yesno is None or label in labels_seen:
+                        continue
                     for set in set_list:
-                        if re.match(set[r'label'], label) and label not in labels_seen:
-                            sets_this_screen.append({
+                        if re.match(set[r'label'], label):
+                            found.append({
                                 'set': set,
                                 'letter': letter,
-                                'state': yesno
+                                'label': label,
+                                'state': yesno,
+                                'row': row,
+                                'col': col
                             })
-                            labels_seen.add(label)
+                            break
+                return found
+            # Wait for the screen or popup to be fully drawn, with the
+            # special letter "x: " for exiting it, which is not
+            # followed by an installation status.  When a popup is
+            # drawn over the main menu, the "x: " of the main menu
+            # may still be visible, so require it in the same column
+            # as the sets found and below them.
+            def fully_drawn(screen):
+                found = find_sets(screen)
+                if not found:
+                    return False
+                last = max(found, key = lambda item: item['row'])
+                return any([letter == b'x' and row > last['row'] and
+                            col == last['col'] for letter, label, yesno,
+                            selected, row, col in screen.menu_items()])
+            self.wait_for_screen(child, fully_drawn)
+            sets_this_screen = find_sets(self.screen)
+            for item in sets_this_screen:
+                labels_seen.add(item['label'])
 
             # Then make the actual selections
             for item in sets_this_screen:
@@ -2024,15 +5745,17 @@ class Anita(object):
             self.slog('new-style interface list')
             child.expect(r'Available interfaces')
             # Choose the first non-fwip interface
-            while True:
-                # Make sure to match the digit after the interface
-                # name so that we don't accept a partial interface
-                # name like "fw" from "fwip0".
-                child.expect(r"([a-z]): ([a-z]+)[0-9]")
-                if child.match.group(2) != 'fwip':
+            def interfaces(screen):
+                return [(letter, label) for letter, label, value, selected,
+                        row, col in screen.menu_items()
+                        if re.match(br'[a-z]+[0-9]+$', label)]
+            self.wait_for_screen(child, interfaces)
+            for letter, label in interfaces(self.screen):
+                if not label.startswith(b'fwip'):
                     # Found an acceptable interface
-                    child.send(child.match.group(1) + b"\n")
-                    break
+                    child.send(letter + b"\n")
+                    return
+            raise RuntimeError("no usable network interface")
 
         def configure_network():
             def choose_dns_server():
@@ -2069,394 +5792,327 @@ class Anita(object):
 
         self.network_configured = False
 
-        # Many different things can happen at this point:
-        #
-        # Versions older than 2009/08/23 21:16:17 will display a menu
-        # for choosing the extraction verbosity
-        #
-        # Versions older than 2010/03/30 20:09:25 will display a menu for
-        # choosing the CD-ROM device (newer versions will choose automatically)
-        #
-        # Versions older than Fri Apr 6 23:48:53 2012 UTC will ask
-        # you to "Please choose the timezone", wheras newer ones will
-        # instead as you to "Configure the additional items".
-        #
-        # At various points, we may or may not get "Hit enter to continue"
-        # prompts (and some of them seem to appear nondeterministically)
-        #
-        # i386/amd64 can ask whether to use normal or serial console bootblocks
-        #
-        # Try to deal with all of the possible options.
-        #
-        # We specify a longer timeout than the default here, because the
-        # set extraction can take a long time on slower machines.
-        #
-        # It has happened (at least with NetBSD 3.0.1) that sysinst paints the
-        # screen twice.  This can cause problem because we will then respond
-        # twice, and the second response will be interpreted as a response to
-        # a subsequent prompt.  Therefore, we check whether the match is the
-        # same as the previous one and ignore it if so.
-        #
-        # OTOH, -current as of 2009.08.23.20.57.40 will issue the message "Hit
-        # enter to continue" twice in a row, first as a result of MAKEDEV
-        # printing a warning messages "MAKEDEV: dri0: unknown device", and
-        # then after "sysinst will give you the opportunity to configure
-        # some essential things first".  We match the latter text separately
-        # so that the "Hit enter to continue" matches are not consecutive.
-        #
-        # The changes of Apr 6 2012 broght with them a new redraw problem,
-        # which is worked around using the seen_essential_things variable.
-        #
-        prevmatch = []
-        seen_essential_things = 0
-        loop = 0
-        while True:
-            loop = loop + 1
-            if loop == 100:
-                raise RuntimeError("loop detected")
-            r = child.expect([
-                # 0 (unused, never matches)
-                r"(?!)",
-                # 1
-                r"a: Progress bar",
-                # 2
-                r"Select medium|Install from",
-                # 3
-                r"Enter the CDROM device",
-                # 4
-                r"unused-group-should-not-match",
-                # 5
-                r"Hit enter to continue",
-                # 6
-                r"b: Use serial port com0",
-                # 7
-                r"Please choose the timezone",
-                # 8
-                r"essential things",
-                # 9
-                r"Configure the additional items",
-                # 10
-                r"Multiple CDs found",
-                # 11
-                r"The following are the http site",
-                # 12
-                r"Is the network information you entered accurate",
-                # 13 (old-style)
-                r"I have found the following network interface",
-                # 14 (new-style)
-                r"Which network device would you like to use",
-                # 15
-                r"No allows you to continue anyway",
-                # 16
-                r"Can't connect to",
-                # 17
-                r"/sbin/newfs",
-                # 18
-                r"Do you want to install the NetBSD bootcode",
-                # 19
-                r"Do you want to update the bootcode in the Master Boot Record to the latest",
-                # 20
-                r"([a-z]): Custom installation",
-                # 21 (unused, never matches)
-                r"(?!)",
-                # 22
-                r"a: This is the correct geometry",
-                # 23
-                r"a: Use one of these disks",
-                # 24
-                r"([a-z]): Set sizes of NetBSD partitions",
-                # 25 (unused, never matches)
-                r"(?!)",
-                # 26
-                r"a partitioning scheme",
-                # 27
-                r"([a-z]): Use the entire disk",
-                # 28 (unused, never matches)
-                r"(?!)",
-                # 29
-                r'Do you want to install the NetBSD bootcode',
-                # 30
-                r'Do you want to update the bootcode',
-                # 31
-                r"Please enter a name for your NetBSD disk",
-                # 32
-                # Matching "This is your last chance" will not work
-                r"ready to install NetBSD on your hard disk",
-                # 33
-                r"We now have your (?:BSD.|GPT.)?(?:disklabel )?partitions",
-                # 34 (formerly 28)
-                r'Your disk currently has a non-NetBSD partition',
-                # 35 (formerly 25)
-                r"Sysinst could not automatically determine the BIOS geometry of the disk",
-                # 36
-                r"Do you want to re-edit the disklabel partitions",
-                # 37 (to reset timeout while set extraction is making progress)
-                r'Command: ',
-                # 38
-                r'not enough entropy',
-                # 39
-                r'Changing local password for root',
-                # 40
-                r'(Accept partition sizes)|(Go on)',
-                ], 10800)
-
-            if child.match.group(0) == prevmatch:
-                self.slog('ignoring repeat match')
-                continue
-            prevmatch = child.match.group(0)
-            if r == 0:
-                 raise AssertionError
-            elif r == 1:
-                # (a: Progress bar)
-                child.send("\n")
-            elif r == 2:
-                # (Install from)
-                choose_install_media()
-            elif r == 3:
-                # "(Enter the CDROM device)"
-                if sets_cd_device != 'cd0a':
-                    child.send(b"a\n" + sets_cd_device.encode('ASCII') + b"\n")
-                # In 3.0.1, you type "c" to continue, whereas in -current,
-                # you type "x".  Handle both cases.
-                child.expect(r"([cx]): Continue")
-                child.send(child.match.group(1) + b"\n")
-            elif r == 5:
-                # (Hit enter to continue)
-                if seen_essential_things >= 2:
-                    # This must be a redraw
-                    pass
-                else:
-                    child.send("\n")
-            elif r == 6:
-                # (b: Use serial port com0)
-                child.send("bx\n")
-            elif r == 7:
-                # (Please choose the timezone)
-                # "Press 'x' followed by RETURN to quit the timezone selection"
-                child.send("x\n")
-                # The strange non-deterministic "Hit enter to continue" prompt has
-                # also been spotted after executing the sed commands to set the
-                # root password cipher, with 2010.10.27.10.42.12 source.
-                while True:
-                    child.expect(r"(([a-z]): DES)|(root password)|(Hit enter to continue)")
-                    if child.match.group(1):
-                        # DES
-                        child.send(child.match.group(2) + b"\n")
-                    elif child.match.group(3):
-                        # root password
+        # The rest of the conversation is driven by the prompts in
+        # sysinst_prompts; see the comments there.  The actions for
+        # them follow.  An action returns true when the installation
+        # is finished.
+
+        # Number of times "essential things" has been seen, for
+        # detecting redraws; a list so that the actions can update it
+        seen_essential_things = [0]
+
+        # The states seen so far and the checkpoints taken or
+        # resumed from, for deciding when to take the next
+        # checkpoint of sysinst_checkpoints
+        states_seen = set()
+        checkpoints_taken = set()
+
+        if resume:
+            variables = resume['variables']
+            seen_essential_things[0] = variables['essential_things']
+            self.network_configured = variables['network_configured']
+            states_seen.update(variables['states_seen'])
+            checkpoints_taken.update(variables['checkpoints_taken'])
+
+        def checkpoint(state):
+            if self.install_checkpoints:
+                for name, states, after in sysinst_checkpoints:
+                    if name in checkpoints_taken:
+                        continue
+                    if state in states and (after is None or after in states_seen):
+                        checkpoints_taken.add(name)
+                        self.save_install_checkpoint(child, name, state, {
+                            'term': term,
+                            'essential_things': seen_essential_things[0],
+                            'network_configured': self.network_configured,
+                            'states_seen': states_seen,
+                            'checkpoints_taken': checkpoints_taken,
+                        })
                         break
-                    elif child.match.group(4):
-                        # (Hit enter to continue)
-                        child.send("\n")
-                    else:
-                        raise AssertionError
-                # Don't set a root password
-                child.expect(r"b: No")
-                child.send("b\n")
-                child.expect(r"a: /bin/sh")
+            states_seen.add(state)
+
+        def progress_bar():
+            # (a: Progress bar)
+            child.send("\n")
+        def install_from():
+            # (Install from)
+            self.wait_install_sets(child)
+            choose_install_media()
+        def cdrom_device():
+            # "(Enter the CDROM device)"
+            self.wait_install_sets(child)
+            if sets_cd_device != 'cd0a':
+                child.send(b"a\n" + sets_cd_device.encode('ASCII') + b"\n")
+            # In 3.0.1, you type "c" to continue, whereas in -current,
+            # you type "x".  Handle both cases.
+            child.expect(r"([cx]): Continue")
+            child.send(child.match.group(1) + b"\n")
+        def hit_enter():
+            # (Hit enter to continue)
+            if seen_essential_things[0] >= 2:
+                # This must be a redraw
+                pass
+            else:
                 child.send("\n")
+        def serial_bootblocks():
+            # (b: Use serial port com0)
+            child.send("bx\n")
+        def timezone():
+            # (Please choose the timezone)
+            # "Press 'x' followed by RETURN to quit the timezone selection"
+            child.send("x\n")
+            # The strange non-deterministic "Hit enter to continue" prompt has
+            # also been spotted after executing the sed commands to set the
+            # root password cipher, with 2010.10.27.10.42.12 source.
+            while True:
+                child.expect(r"(([a-z]): DES)|(root password)|(Hit enter to continue)")
+                if child.match.group(1):
+                    # DES
+                    child.send(child.match.group(2) + b"\n")
+                elif child.match.group(3):
+                    # root password
+                    break
+                elif child.match.group(4):
+                    # (Hit enter to continue)
+                    child.send("\n")
+                else:
+                    raise AssertionError
+            # Don't set a root password
+            child.expect(r"b: No")
+            child.send("b\n")
+            child.expect(r"a: /bin/sh")
+            child.send("\n")
+
+            # "The installation of NetBSD-3.1 is now complete.  The system
+            # should boot from hard disk.  Follow the instructions in the
+            # INSTALL document about final configuration of your system.
+            # The afterboot(8) manpage is another recommended reading; it
+            # contains a list of things to be checked after the first
+            # complete boot."
+            #
+            # We are supposed to get a single "Hit enter to continue"
+            # prompt here, but sometimes we get a weird spurious one
+            # after running chpass above.
 
-                # "The installation of NetBSD-3.1 is now complete.  The system
-                # should boot from hard disk.  Follow the instructions in the
-                # INSTALL document about final configuration of your system.
-                # The afterboot(8) manpage is another recommended reading; it
-                # contains a list of things to be checked after the first
-                # complete boot."
-                #
-                # We are supposed to get a single "Hit enter to continue"
-                # prompt here, but sometimes we get a weird spurious one
-                # after running chpass above.
-
-                while True:
-                    child.expect(r"(Hit enter to continue)|(x: Exit)")
-                    if child.match.group(1):
-                        child.send("\n")
-                    elif child.match.group(2):
-                        child.send("x\n")
-                        break
-                    else:
-                        raise AssertionError
-                break
-            elif r == 8:
-                # (essential things)
-                seen_essential_things += 1
-            elif r == 9:
-                # (Configure the additional items)
-                child.expect(r"x: Finished configuring")
-                child.send("x\n")
-                break
-            elif r == 10:
-                # (Multiple CDs found)
-                # This happens if we have a boot CD and a CD with sets;
-                # we need to choose the latter.
-                child.send("b\n")
-            elif r == 11:
-                gather_input(child, 1)
-                # (The following are the http site)
-                # \027 is control-w, which clears the field
-                child.send("a\n") # IP address
-                child.send("\027" +
-                       (self.net_config.get('serveraddr') or "10.169.0.1") + "\n")
-                child.send("b\n\027\n") # Directory = empty string
-                if not self.network_configured:
-                    child.send("j\n") # Configure network
-                    choose_interface_newstyle()
-                    configure_network()
-                # We get 'Hit enter to continue' if this sysinst
-                # version tries ping6 even if we have not configured
-                # IPv6
-                expect_any(child,
-                    r'Hit enter to continue', '\r',
-                    r'x: Get Distribution', 'x\n')
-                r = child.expect([r"Install from", r"/usr/bin/ftp"])
-                if r == 0:
-                    # ...and I'm back at the "Install from" menu?
-                    # Probably the same bug reported as install/49440.
-                    choose_install_media()
-                    # And again...
-                    child.expect(r"The following are the http site")
-                    child.expect(r"x: Get Distribution")
+            while True:
+                child.expect(r"(Hit enter to continue)|(x: Exit)")
+                if child.match.group(1):
+                    child.send("\n")
+                elif child.match.group(2):
                     child.send("x\n")
-                elif r == 1:
-                    pass
+                    break
                 else:
-                    assert(0)
-            elif r == 12:
-                # "Is the network information you entered accurate"
-                child.expect(r"([a-z]): Yes")
-                child.send(child.match.group(1) + b"\n")
-            elif r == 13:
-                 # "(I have found the following network interfaces)"
-                choose_interface_oldstyle()
-                configure_network()
-            elif r == 14:
-                # "(Which network device would you like to use)"
+                    raise AssertionError
+            return True
+        def essential_things():
+            # (essential things)
+            seen_essential_things[0] += 1
+        def additional_items():
+            # (Configure the additional items)
+            child.expect(r"x: Finished configuring")
+            child.send("x\n")
+            return True
+        def multiple_cds():
+            # (Multiple CDs found)
+            # This happens if we have a boot CD and a CD with sets;
+            # we need to choose the latter.
+            self.wait_install_sets(child)
+            child.send("b\n")
+        def http_site():
+            t = wait_for_quiet(child, 0.5, 1)
+            self.slog("waited %.3f seconds for the form" % t)
+            # (The following are the http site)
+            # \027 is control-w, which clears the field
+            child.send("a\n") # IP address
+            host = self.server_addr()
+            if self.dist_server and self.dist_server.http_port != 80:
+                host += ":%d" % self.dist_server.http_port
+            child.send("\027" + host + "\n")
+            child.send("b\n\027\n") # Directory = empty string
+            if not self.network_configured:
+                child.send("j\n") # Configure network
                 choose_interface_newstyle()
                 configure_network()
-            elif r == 15:
-                choose_no()
-                child.expect(r"No aborts the install process")
-                choose_yes()
-            elif r == 16:
-                self.slog("network problems detected")
-                child.send("\003") # control-c
-                gather_input(child, 666)
-                for i in range(60):
-                    child.send("ifconfig -a\n")
-                    gather_input(child, 1)
-                # would run netstat here but it's not on the install media
-                gather_input(child, 30)
-                sys.exit(1)
-            elif r == 17:
-                self.slog("matched newfs to defeat repeat match detection")
-            elif r == 18:
-                # "Do you want to install the NetBSD bootcode"
-                choose_yes()
-            elif r == 19:
-                # "Do you want to update the bootcode in the Master Boot Record to the latest"
-                choose_yes()
-            elif r == 20:
-                # Custom installation is choice "d" in 6.0,
-                # but choice "c" or "b" in older versions
-                # We could use "Minimal", but it doesn't exist in
-                # older versions.
-                child.send(child.match.group(1) + b"\n")
-                # Enable/disable sets.
-                choose_sets(self.dist.sets)
-            elif r == 21:
-                raise AssertionError
-            # On non-Xen i386/amd64 we first get group 22 or 23,
-            # then group 24; on sparc and Xen, we just get group 24.
-            elif r == 22:
-                # "This is the correct geometry"
-                child.send("\n")
-            elif r == 23:
-                # "a: Use one of these disks"
-                child.send("a\n")
-                child.expect(r"Choose disk")
-                child.send("0\n")
-            elif r == 24:
-                # "(([a-z]): Set sizes of NetBSD partitions)"
-                child.send(child.match.group(1) + b"\n")
-            elif r == 25:
-                raise AssertionError
-            elif r == 26:
-                # "a partitioning scheme"
-                if self.partitioning_scheme == 'MBR':
-                    child.expect(r"([a-z]): Master Boot Record")
-                    child.send(child.match.group(1) + b"\n")
-                else:
-                    # Sparc asks the question but does not have MBR as an option,
-                    # only disklabel.  Just use the first choice, whatever that is.
-                    child.send("a\n")
-            elif r == 27:
-                # "([a-z]): use the entire disk"
-                child.send(child.match.group(1) + b"\n")
-            elif r == 28:
-                raise AssertionError
-            elif r == 29 or r == 30:
-                # Install or replace bootcode
-                child.expect(r"a: Yes")
-                child.send("\n")
-            elif r == 31:
-                # "Please enter a name for your NetBSD disk"
-                child.send("\n")
-            elif r == 32:
-                # "ready to install NetBSD on your hard disk"
-                child.expect(r"Shall we continue")
-                child.expect(r"b: Yes")
-                child.send("b\n")
-                # newfs is run at this point
-            elif r == 33:
-                # "We now have your BSD disklabel partitions"
-                child.expect(r"x: Partition sizes ok")
+            # We get 'Hit enter to continue' if this sysinst
+            # version tries ping6 even if we have not configured
+            # IPv6
+            expect_any(child,
+                r'Hit enter to continue', '\r',
+                r'x: Get Distribution', 'x\n')
+            r = child.expect([r"Install from", r"/usr/bin/ftp"])
+            if r == 0:
+                # ...and I'm back at the "Install from" menu?
+                # Probably the same bug reported as install/49440.
+                choose_install_media()
+                # And again...
+                child.expect(r"The following are the http site")
+                child.expect(r"x: Get Distribution")
                 child.send("x\n")
-            elif r == 34:
-                # Your disk currently has a non-NetBSD partition
-                choose_yes()
-            elif r == 35:
-                # We need to enter these values in cases where sysinst could not
-                # determine disk geometry. Currently, this happens for NetBSD/hpcmips
-                child.expect(r"sectors")
-                child.send("\n")
-                child.expect(r"heads")
-                child.send("\n")
-            elif r == 36:
-                raise RuntimeError('setting up partitions did not work first time')
-            elif r == 37:
+            elif r == 1:
                 pass
-            elif r == 38:
-                # not enough entropy
-                self.provide_entropy(child)
-            elif r == 39:
-                # Changing local password for root
-                child.expect(r"sword:")
-                child.send("\n")
-            elif r == 40:
-                # (Accept partition sizes)|(Go on)
-                #
-                # In 2.1, no letter label like "x: " is printed before
-                # "Accept partition sizes", hence the kludge of sending
-                # multiple cursor-down sequences.
-
-                #child.send(child.match.group(1) + "\n")
-                # Press cursor-down enough times to get to the end of the list,
-                # to the "Accept partition sizes" entry, then press
-                # enter to continue.  Previously, we used control-N ("\016"),
-                # but if it gets echoed (which has happened), it is interpreted by
-                # the terminal as "enable line drawing character set", leaving the
-                # terminal in an unusable state.
-                if term in ['xterm', 'vt100']:
-                    # For unknown reasons, when using a terminal type of "xterm",
-                    # sysinst puts the terminal in "application mode", causing the
-                    # cursor keys to send a different escape sequence than the default.
-                    cursor_down = b"\033OB"
-                else:
-                    # Use the default ANSI cursor-down escape sequence
-                    cursor_down = b"\033[B"
-                child.send(cursor_down * 8 + b"\n")
             else:
-                raise AssertionError
+                assert(0)
+        def network_accurate():
+            # "Is the network information you entered accurate"
+            child.expect(r"([a-z]): Yes")
+            child.send(child.match.group(1) + b"\n")
+        def interface_oldstyle():
+            # "(I have found the following network interfaces)"
+            choose_interface_oldstyle()
+            configure_network()
+        def interface_newstyle():
+            # "(Which network device would you like to use)"
+            choose_interface_newstyle()
+            configure_network()
+        def continue_anyway():
+            choose_no()
+            child.expect(r"No aborts the install process")
+            choose_yes()
+        def cant_connect():
+            self.slog("network problems detected")
+            child.send("\003") # control-c
+            gather_input(child, 666)
+            for i in range(60):
+                child.send("ifconfig -a\n")
+                gather_input(child, 1)
+            # would run netstat here but it's not on the install media
+            gather_input(child, 30)
+            sys.exit(1)
+        def newfs():
+            self.slog("matched newfs to defeat repeat match detection")
+        def custom_installation():
+            # Custom installation is choice "d" in 6.0,
+            # but choice "c" or "b" in older versions
+            # We could use "Minimal", but it doesn't exist in
+            # older versions.
+            child.send(child.match.group(1) + b"\n")
+            # Enable/disable sets.
+            choose_sets(self.dist.sets)
+        # On non-Xen i386/amd64 we first get correct_geometry or
+        # use_one_of_these_disks, then set_sizes; on sparc and Xen,
+        # we just get set_sizes.
+        def correct_geometry():
+            # "This is the correct geometry"
+            child.send("\n")
+        def use_one_of_these_disks():
+            # "a: Use one of these disks"
+            child.send("a\n")
+            child.expect(r"Choose disk")
+            child.send("0\n")
+        def choose_letter():
+            # "(([a-z]): Set sizes of NetBSD partitions)" or
+            # "([a-z]): use the entire disk"
+            child.send(child.match.group(1) + b"\n")
+        def partitioning_scheme():
+            # "a partitioning scheme"
+            if self.partitioning_scheme == 'MBR':
+                child.expect(r"([a-z]): Master Boot Record")
+                child.send(child.match.group(1) + b"\n")
+            else:
+                # Sparc asks the question but does not have MBR as an option,
+                # only disklabel.  Just use the first choice, whatever that is.
+                child.send("a\n")
+        def update_bootcode():
+            # Replace bootcode
+            child.expect(r"a: Yes")
+            child.send("\n")
+        def disk_name():
+            # "Please enter a name for your NetBSD disk"
+            child.send("\n")
+        def ready_to_install():
+            # "ready to install NetBSD on your hard disk"
+            self.wait_install_disk(child)
+            child.expect(r"Shall we continue")
+            child.expect(r"b: Yes")
+            child.send("b\n")
+            # newfs is run at this point
+        def partitions_ok():
+            # "We now have your BSD disklabel partitions"
+            child.expect(r"x: Partition sizes ok")
+            child.send("x\n")
+        def bios_geometry():
+            # We need to enter these values in cases where sysinst could not
+            # determine disk geometry. Currently, this happens for NetBSD/hpcmips
+            child.expect(r"sectors")
+            child.send("\n")
+            child.expect(r"heads")
+            child.send("\n")
+        def reedit_disklabel():
+            raise RuntimeError('setting up partitions did not work first time')
+        def command():
+            pass
+        def entropy():
+            # not enough entropy
+            self.provide_entropy(child)
+        def root_password():
+            # Changing local password for root
+            child.expect(r"sword:")
+            child.send("\n")
+        def accept_partition_sizes():
+            # (Accept partition sizes)|(Go on)
+            #
+            # In 2.1, no letter label like "x: " is printed before
+            # "Accept partition sizes", hence the kludge of sending
+            # multiple cursor-down sequences.
+
+            #child.send(child.match.group(1) + "\n")
+            # Press cursor-down enough times to get to the end of the list,
+            # to the "Accept partition sizes" entry, then press
+            # enter to continue.  Previously, we used control-N ("\016"),
+            # but if it gets echoed (which has happened), it is interpreted by
+            # the terminal as "enable line drawing character set", leaving the
+            # terminal in an unusable state.
+            if term in ['xterm', 'vt100']:
+                # For unknown reasons, when using a terminal type of "xterm",
+                # sysinst puts the terminal in "application mode", causing the
+                # cursor keys to send a different escape sequence than the default.
+                cursor_down = b"\033OB"
+            else:
+                # Use the default ANSI cursor-down escape sequence
+                cursor_down = b"\033[B"
+            child.send(cursor_down * 8 + b"\n")
+
+        # When resuming from the "configured" checkpoint, the
+        # conversation has already finished
+        if not (resume and resume['name'] == 'configured'):
+            self.sysinst_conversation(child, {
+                'progress_bar': progress_bar,
+                'install_from': install_from,
+                'cdrom_device': cdrom_device,
+                'hit_enter': hit_enter,
+                'serial_bootblocks': serial_bootblocks,
+                'timezone': timezone,
+                'essential_things': essential_things,
+                'additional_items': additional_items,
+                'multiple_cds': multiple_cds,
+                'http_site': http_site,
+                'network_accurate': network_accurate,
+                'interface_oldstyle': interface_oldstyle,
+                'interface_newstyle': interface_newstyle,
+                'continue_anyway': continue_anyway,
+                'cant_connect': cant_connect,
+                'newfs': newfs,
+                'install_bootcode': choose_yes,
+                'update_mbr_bootcode': choose_yes,
+                'custom_installation': custom_installation,
+                'correct_geometry': correct_geometry,
+                'use_one_of_these_disks': use_one_of_these_disks,
+                'set_sizes': choose_letter,
+                'partitioning_scheme': partitioning_scheme,
+                'entire_disk': choose_letter,
+                'update_bootcode': update_bootcode,
+                'disk_name': disk_name,
+                'ready_to_install': ready_to_install,
+                'partitions_ok': partitions_ok,
+                'non_netbsd_partition': choose_yes,
+                'bios_geometry': bios_geometry,
+                'reedit_disklabel': reedit_disklabel,
+                'command': command,
+                'entropy': entropy,
+                'root_password': root_password,
+                'accept_partition_sizes': accept_partition_sizes,
+            }, checkpoint)
+            checkpoint('configured')
 
         # Installation is finished, halt the system.
         # Historically, i386 and amd64, you get a root shell,
@@ -2464,6 +6120,7 @@ class Anita(object):
         # Since Fri Apr 6 23:48:53 2012 UTC, you are kicked
         # back into the main menu.
 
+        self.set_phase('install-halt')
         x_sent = False
         while True:
             r = child.expect([r'Hit enter to continue',
@@ -2495,18 +6152,123 @@ class Anita(object):
 
         self.halted = True
         self.is_logged_in = False
+        if self.chain_boot_vmm_args is not None and self.reset_into_installed_system():
+            return
         self.post_halt_cleanup()
 
-    def post_halt_cleanup(self):
-        # Keep logging for a few seconds more so that we gather
-        # the autoconf detach messages or a possible panic on
-        # detach.  If we get EOF during the wait, ignore it.
+    # Carry on the main part of the sysinst conversation, waiting for
+    # any of the prompts in sysinst_prompts (as modified for the
+    # NetBSD version) and calling the function for its state in the
+    # dict "actions", until one returns true.  If "checkpoint" is
+    # given, it is called with the state before the action.  The
+    # time spent waiting for and handling each state is logged, and
+    # summarized at the end.
+    def sysinst_conversation(self, child, actions, checkpoint = None):
+        states, patterns = compiled_sysinst_prompts(dist_major_version(self.dist))
+        timing = {}
+        prevmatch = None
+        last = time.time()
+        for loop in range(1, 100):
+            # We specify a longer timeout than the default here, because
+            # the set extraction can take a long time on slower machines.
+            r = child.expect(patterns, 10800)
+            matched = time.time()
+            state = states[r]
+            if child.match.group(0) == prevmatch:
+                self.slog('ignoring repeat match')
+                continue
+            prevmatch = child.match.group(0)
+            if checkpoint:
+                checkpoint(state)
+            done = actions[state]()
+            handled = time.time()
+            self.slog("sysinst state %s: waited %.3f seconds, handled in %.3f seconds" %
+                      (state, matched - last, handled - matched))
+            t = timing.setdefault(state, [0, 0.0, 0.0])
+            t[0] += 1
+            t[1] += matched - last
+            t[2] += handled - matched
+            last = handled
+            if done:
+                break
+        else:
+            raise RuntimeError("loop detected")
+        for state in sorted(timing.keys(), key = lambda s: -timing[s][1] - timing[s][2]):
+            self.slog("sysinst state %s: %d times, waited %.3f seconds, handled in %.3f seconds" %
+                      tuple([state] + timing[state]))
+
+    # Return the qemu boot order for booting the installer from the
+    # drive "drive": only the first time if the VM is going to be
+    # reset into the installed system, otherwise always
+    def install_boot_order(self, drive):
+        if self.chain_boot_vmm_args is not None:
+            return 'once=' + drive
+        return drive
+
+    # Return true if the install and the boot can be done in the
+    # same VM
+    def chain_boot_possible(self):
+        return self.chain_boot and self.vmm == 'qemu' and \
+            self.dist.arch() in ('i386', 'amd64') and \
+            self.install_method == 'sysinst' and \
+            not self.get_arch_prop('image_name') and \
+            self.install_boot_from() in ('cdrom', 'floppy')
+
+    # After the guest has halted at the end of the install, reset
+    # the VM so that it boots the installed system, diverting
+    # further writes to the system disk to a temporary overlay if
+    # the disk is to be snapshotted.  Returns true on success; on
+    # failure, the VM is left halted.
+    def reset_into_installed_system(self):
+        child = self.child
         try:
-            gather_input(self.child, 5)
-        except pexpect.EOF:
-            pass
+            child.expect(r'The operating system has halted', timeout = 60)
+        except (pexpect.TIMEOUT, pexpect.EOF):
+            print("note: did not see the guest halt, not reusing the VM")
+            return False
+        if not self.persist:
+            overlay = self.ephemeral_file('wd0-overlay.qcow2',
+                                          parse_size(self.disk_size))
+            rm_f(overlay)
+            ok, r = self.qmp_command('blockdev-snapshot-sync',
+                                     {'device': 'hd0',
+                                      'snapshot-file': os.path.abspath(overlay),
+                                      'format': 'qcow2'})
+            if not ok:
+                print("note: could not snapshot the system disk, not reusing the VM")
+                return False
+            self.system_disk_overlay = overlay
+        ok, r = self.qmp_command('system_reset')
+        if not ok:
+            return False
+        self.slog("reset into the installed system")
+        self.system_disk_snapshotted = not self.persist
+        self.halted = False
+        self.chained = True
+        self.dist.cleanup()
+        return True
+
+    def post_halt_cleanup(self, gather = True):
+        if gather:
+            # Keep logging for a few seconds more so that we gather
+            # the autoconf detach messages or a possible panic on
+            # detach, but stop early if the console goes quiet or the
+            # VMM exits.
+            start = time.time()
+            try:
+                wait_for_quiet(self.child, 2, 5)
+            except pexpect.EOF:
+                pass
+            self.slog("waited %.3f seconds after halt" % (time.time() - start))
+            # The guest has synced its disks, so qemu can be made to exit
+            # right away rather than waiting for the pty to be closed
+            if self.vmm == 'qemu':
+                self.qemu_quit()
+        self.set_phase(None)
         self.slog('done')
+        start = time.time()
         self.child.close()
+        self.slog("waited %.3f seconds for the VMM to exit" % (time.time() - start))
         self.dist.cleanup()
         self.cleanup_child()
 
@@ -2523,16 +6285,37 @@ class Anita(object):
             # Already installed?
             if os.path.exists(self.wd0_path()):
                 return
-            try:
-                self._install()
-            except:
-                # "xl destroy" gets confused if the disk image
-                # has been removed, so run it before removing
-                # the disk image rather than after.
-                self.cleanup_child()
-                if os.path.exists(self.wd0_path()):
-                    os.unlink(self.wd0_path())
-                raise
+            attempt = 1
+            while True:
+                try:
+                    self._install()
+                    break
+                except Exception as e:
+                    self.install_failed()
+                    if attempt > self.install_retries:
+                        raise
+                    print("warning: install attempt %d failed: %s" % (attempt, e),
+                          file=sys.stderr)
+                    attempt += 1
+                except:
+                    self.install_failed()
+                    raise
+            if self.install_checkpoints:
+                self.remove_install_checkpoints()
+
+    # Clean up after a failed install
+    def install_failed(self):
+        # "xl destroy" gets confused if the disk image
+        # has been removed, so run it before removing
+        # the disk image rather than after.
+        self.cleanup_child()
+        if os.path.exists(self.wd0_path()):
+            os.unlink(self.wd0_path())
+        # Don't resume from the same checkpoint again, in case it
+        # is what made the install fail
+        if self.resume_checkpoint:
+            rm_tree(self.resume_checkpoint['dir'])
+            self.resume_checkpoint = None
 
     # Boot the virtual machine (installing it first if it's not
     # installed already).  The vmm_args argument applies when
@@ -2548,7 +6331,18 @@ class Anita(object):
             snapshot_system_disk = not self.persist
 
         if install:
-            self.install()
+            self.chained = False
+            if self.chain_boot_possible():
+                self.chain_boot_vmm_args = vmm_args[:]
+            try:
+                self.install()
+            finally:
+                self.chain_boot_vmm_args = None
+            if self.chained:
+                # The install VM has been reset into the installed
+                # system
+                self.set_phase('boot')
+                return self.child
 
         # Start counting CD drives from 0 again after the install
         self.n_cdrom = 0
@@ -2563,10 +6357,11 @@ class Anita(object):
             vmm_args += args
             vmm_args += ["-prom-env", "boot-device=cd:,netbsd-GENERIC"]
         if self.dist.arch() == 'alpha':
-            generic_kernel = os.path.join(self.workdir, 'netbsd_generic')
-            gunzip(os.path.join(self.dist.download_local_arch_dir(),
-                                "binary", "kernel", "netbsd-GENERIC.gz"),
-                   generic_kernel)
+            gzkernel_fn = os.path.join(self.dist.download_local_arch_dir(),
+                                       "binary", "kernel", "netbsd-GENERIC.gz")
+            generic_kernel = self.ephemeral_file('netbsd_generic',
+                                                 4 * os.path.getsize(gzkernel_fn))
+            gunzip(gzkernel_fn, generic_kernel)
             vmm_args += ['-kernel', generic_kernel]
 
         if self.vmm == 'qemu':
@@ -2596,12 +6391,20 @@ class Anita(object):
         else:
             raise RuntimeError('unknown vmm %s' % vmm)
         self.child = child
+        self.set_phase('boot')
         return child
 
     # Like start_boot(), but wait for a login prompt.
     def boot(self, vmm_args = None):
         # Needed to determine runtime_boot_iso_path on macppc
         self.dist.set_workdir(self.workdir)
+        if vmm_args is None:
+            vmm_args = []
+        # Attach a scratch disk for file transfers unless the
+        # caller has attached one already
+        if self.transfer_size and not self.scratch_disk_path:
+            vmm_args = vmm_args + self.prepare_scratch_disk('transfer.img',
+                                                            self.transfer_size)
         self.start_boot(vmm_args)
         while True:
             r = self.child.expect([r'\033\[c', r'\033\[5n', r'login:'])
@@ -2634,6 +6437,7 @@ class Anita(object):
         # of data read from the slave, or otherwise everything will be
         # printed twice.  We can still log to the structured log, though.
         self.child.logfile_read = Logger('recv', self.structured_log_f)
+        self.set_phase('interact')
         self.slog('entering console interaction')
         self.child.interact()
 
@@ -2644,41 +6448,26 @@ class Anita(object):
         mkdir_p(self.workdir)
         results_by_net = (self.vmm == 'noemu')
 
-        # Create a scratch disk image for exporting test results from the VM.
-        # The results are stored in tar format because that is more portable
-        # and easier to manipulate than a file system image, especially if the
-        # host is a non-NetBSD system.
-        #
-        # If we are getting the results back by tftp, this file will
-        # be overwritten.
-        scratch_disk_path = os.path.join(self.workdir, "tests-results.img")
-        if vmm_is_xen(self.vmm):
-            scratch_disk = 'xbd1d'
-        elif self.dist.arch() == 'evbarm-earmv7hf' and self.machine == 'virt':
-            scratch_disk = 'ld5c'
-        else:
-            scratch_disk = self.get_arch_prop('scratch_disk')
+        # Create a scratch disk image for exporting test results from
+        # the VM, or when getting the results back by tftp, a file to
+        # receive them.
+        scratch_image_megs = 100
+        scratch_disk = self.scratch_disk()
 
         scratch_disk_args = []
+        if results_by_net:
+            # This file will be overwritten when the results are
+            # received by tftp
+            scratch_disk_path = os.path.join(self.workdir, "tests-results.img")
+            make_dense_image(scratch_disk_path, scratch_image_megs * 2 ** 20)
+        elif scratch_disk:
+            scratch_disk_args = self.prepare_scratch_disk("tests-results.img",
+                                                          scratch_image_megs * 2 ** 20)
+            scratch_disk_path = self.scratch_disk_path
         if scratch_disk:
-            scratch_image_megs = 100
-            make_dense_image(scratch_disk_path, parse_size('%dM' % scratch_image_megs))
             # Leave a 10% safety margin
             max_result_size_k = scratch_image_megs * 900
 
-            if vmm_is_xen(self.vmm):
-                scratch_disk_args = [self.xen_disk_arg(os.path.abspath(scratch_disk_path), 1)]
-            elif self.vmm == 'qemu':
-                scratch_disk_args = self.qemu_disk_args(os.path.abspath(scratch_disk_path), 1, True, False)
-            elif self.vmm == 'noemu':
-                pass
-            elif self.vmm == 'gxemul':
-                scratch_disk_args = self.gxemul_disk_args(os.path.abspath(scratch_disk_path))
-            elif self.vmm == 'simh':
-                scratch_disk_args = ['set rq1 ra92', 'attach rq1 ' + scratch_disk_path]
-            else:
-                raise RuntimeError('unknown vmm')
-
         child = self.boot(scratch_disk_args)
         self.login()
 
@@ -2721,11 +6510,14 @@ class Anita(object):
 
         # Build a shell command to save the test results
         if results_by_net:
+            tftp_server = self.server_addr()
+            if self.dist_server:
+                tftp_server += " %d" % self.dist_server.tftp_port
             save_test_results_cmd = (
                 "{ cd $t && " +
                 "tar cf tests-results.img tests && " +
                 "(echo blksize 8192; echo put tests-results.img) | tftp %s; }; " % \
-                (self.net_config.get('serveraddr') or "10.169.0.1")
+                tftp_server
             )
         elif scratch_disk:
             save_test_results_cmd = (
@@ -2743,6 +6535,8 @@ class Anita(object):
         else:
             save_test_results_cmd = ""
 
+        self.login()
+        self.set_phase('tests')
         exit_status = self.shell_cmd(
             "t=/var/tmp; " +
             "df -k | sed 's/^/df-pre-test /'; " +
@@ -2755,6 +6549,7 @@ class Anita(object):
             "vmstat -s; " +
             "s=$(cat $t/tests/test.status); sh -c \"exit $s\"",
             timeout, [r'\d test cases', r'\[\d+\.\d+s\]'])
+        self.set_phase('command')
 
         # Halt the VM before reading the scratch disk, to
         # ensure that it has been flushed.  This matters
@@ -2775,27 +6570,279 @@ class Anita(object):
             if not os.path.lexists(compat_link):
                 os.symlink('tests', compat_link)
 
+        if self.history:
+            self.history.update_run(self.run_id, {'tests_status': exit_status})
+            tps = os.path.join(self.workdir, 'tests', 'test.tps')
+            if self.tests == 'atf' and os.path.exists(tps):
+                self.history.add_tests(self.run_id, parse_atf_tps(tps))
+
         return exit_status
 
     # Backwards compatibility
     run_atf_tests = run_tests
 
+    # Create a zero-filled scratch disk image of "size" bytes as the
+    # work file "name" and return the VMM arguments for attaching it
+    # as the second disk of the VM, where the guest will see it as
+    # the device returned by scratch_disk().  Data is moved through
+    # the disk in tar format, because that is more portable and
+    # easier to manipulate than a file system image, especially if
+    # the host is a non-NetBSD system.
+    def prepare_scratch_disk(self, name, size):
+        path = self.ephemeral_file(name, size)
+        make_dense_image(path, size)
+        self.scratch_disk_path = path
+        self.scratch_disk_size = size
+        if vmm_is_xen(self.vmm):
+            return [self.xen_disk_arg(os.path.abspath(path), 1)]
+        elif self.vmm == 'qemu':
+            return self.qemu_disk_args(os.path.abspath(path), 1, True, False)
+        elif self.vmm == 'noemu':
+            return []
+        elif self.vmm == 'gxemul':
+            return self.gxemul_disk_args(os.path.abspath(path))
+        elif self.vmm == 'simh':
+            return ['set rq1 ra92', 'attach rq1 ' + path]
+        else:
+            raise RuntimeError('unknown vmm')
+
+    # Check that files can be transferred to and from the running VM
+    # through its scratch disk.  This requires the guest to see the
+    # data written to the image by the host and vice versa without
+    # halting, which qemu guarantees for raw images.
+    def check_transfer(self):
+        if self.vmm != 'qemu':
+            raise RuntimeError("file transfers are only supported with qemu")
+        if not self.scratch_disk():
+            raise RuntimeError("file transfers are not supported on %s" %
+                               self.dist.arch())
+        if not (self.child and self.scratch_disk_path):
+            raise RuntimeError("file transfers require booting with a transfer size")
+
+    # Copy the host files or directory trees "paths" into the
+    # directory "guest_dir" of the running VM
+    def put_files(self, paths, guest_dir):
+        self.check_transfer()
+        start = time.time()
+        def owned_by_root(info):
+            info.uid = info.gid = 0
+            info.uname = 'root'
+            info.gname = 'wheel'
+            return info
+        names = [os.path.basename(os.path.normpath(path)) for path in paths]
+        for name in names:
+            if names.count(name) > 1:
+                raise RuntimeError("more than one path is named %s" % name)
+        f = open(self.scratch_disk_path, 'r+b')
+        try:
+            tf = tarfile.open(fileobj = f, mode = 'w', format = tarfile.USTAR_FORMAT)
+            for path in paths:
+                tf.add(path, arcname = os.path.basename(os.path.normpath(path)),
+                       filter = owned_by_root)
+            tf.close()
+            size = f.tell()
+            f.flush()
+            if size > self.scratch_disk_size:
+                raise RuntimeError("files to transfer do not fit in %d bytes" %
+                                   self.scratch_disk_size)
+            status = self.shell_cmd("mkdir -p %s && cd %s && tar xf /dev/r%s; " \
+                                    "s=$?; cd /; sh -c \"exit $s\"" %
+                                    (sh_quote(guest_dir), sh_quote(guest_dir),
+                                     self.scratch_disk()))
+            if status != 0:
+                raise RuntimeError("extracting files in the guest failed with status %d" % status)
+        finally:
+            # Leave the disk zero-filled for the next transfer
+            f.truncate(self.scratch_disk_size)
+            f.close()
+            densify_image(self.scratch_disk_path, self.scratch_disk_size)
+        self.slog("put %d bytes in %.3f seconds" % (size, time.time() - start))
+
+    # Copy the files or directory trees "guest_paths" (absolute
+    # pathnames) from the running VM into the host directory "host_dir"
+    def get_files(self, guest_paths, host_dir):
+        self.check_transfer()
+        start = time.time()
+        mkdir_p(host_dir)
+        names = []
+        tar_args = []
+        for path in guest_paths:
+            path = os.path.normpath(path)
+            if not os.path.isabs(path):
+                raise RuntimeError("guest path %s is not absolute" % path)
+            name = os.path.basename(path)
+            if not name:
+                raise RuntimeError("cannot get the guest root directory")
+            # The files are placed in the same directory on the host
+            if name in names:
+                raise RuntimeError("more than one guest path is named %s" % name)
+            names.append(name)
+            tar_args += ['-C', sh_quote(os.path.dirname(path)),
+                         sh_quote(os.path.basename(path))]
+        disk = '/dev/r%s' % self.scratch_disk()
+        try:
+            status = self.shell_cmd(
+                # Make sure the files will fit on the scratch disk,
+                # leaving a 10% safety margin
+                "test `du -sk %s | awk '{s += $1} END {print s}'` -lt %d && " %
+                    (' '.join([sh_quote(p) for p in guest_paths]),
+                     self.scratch_disk_size // 1024 * 9 // 10) +
+                # To guard against accidentally overwriting the wrong
+                # disk, check that the start of the disk contains
+                # nothing but nulls.
+                "test `dd if=%s bs=64k count=16 2>/dev/null | tr -d '\\000' | wc -c` = 0 && " % disk +
+                "tar cf %s %s" % (disk, ' '.join(tar_args)))
+            if status != 0:
+                raise RuntimeError("archiving files in the guest failed with status %d" % status)
+            # As in run_tests(), give tar the names to extract to
+            # guard against arbitrary file overwrites by an untrusted
+            # guest
+            f = open(self.scratch_disk_path, "r")
+            status = subprocess.call(["tar", "xf", "-"] + names, cwd = host_dir, stdin = f)
+            f.close()
+            if status != 0:
+                raise RuntimeError("extracting the files from the guest failed with status %d" % status)
+        finally:
+            densify_image(self.scratch_disk_path, self.scratch_disk_size)
+        self.slog("get took %.3f seconds" % (time.time() - start))
+
+    # Return the version of the VMM, if known
+    def vmm_version(self):
+        if self.vmm != 'qemu' or self.replay_log:
+            return None
+        try:
+            output = subprocess.check_output([self.qemu, '--version'])
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return output.decode('ASCII', 'ignore').splitlines()[0]
+
+    # Benchmark the latency of installing, booting to the login
+    # prompt, logging in, running a trivial shell command, getting
+    # files from the VM through the scratch disk (with qemu), and
+    # halting, doing "runs" installs with "commands" shell commands
+    # each.  Each install is done from scratch, and the installed
+    # disk image is removed afterwards.  Returns a dict of the
+    # samples and their percentiles along with host and VMM
+    # metadata, suitable for saving as JSON.
+    def bench(self, runs = 5, commands = 20):
+        if self.vmm != 'noemu' and os.path.exists(self.wd0_path()):
+            raise RuntimeError("benchmarking requires a work directory " +
+                               "without an installed system")
+        start = time.time()
+        # Download up front, so that it is not part of the first install
+        self.dist.set_workdir(self.workdir)
+        self.dist.download()
+        can_transfer = self.vmm == 'qemu' and self.scratch_disk()
+        if can_transfer and not self.transfer_size:
+            self.transfer_size = parse_size('10M')
+        get_dir = os.path.join(self.workdir, 'bench-get')
+        samples = {}
+        def measure(name, func, *args):
+            t = time.time()
+            func(*args)
+            samples.setdefault(name, []).append(time.time() - t)
+        try:
+            for i in range(runs):
+                self.slog("benchmark run %d of %d" % (i + 1, runs))
+                measure('install', self.install)
+                measure('boot', self.boot)
+                measure('login', self.login)
+                for j in range(commands):
+                    measure('command', self.shell_cmd, 'true')
+                if can_transfer:
+                    measure('get_files', self.get_files, ['/etc'], get_dir)
+                measure('halt', self.halt)
+                if self.vmm != 'noemu':
+                    os.unlink(self.wd0_path())
+        finally:
+            rm_tree(get_dir)
+        def summarize(values):
+            return {
+                'samples': values,
+                'min': min(values),
+                'max': max(values),
+                'mean': sum(values) / len(values),
+                'p50': percentile(values, 50),
+                'p90': percentile(values, 90),
+                'p99': percentile(values, 99),
+            }
+        return {
+            'anita_version': __version__,
+            'pexpect_version': pexpect.__version__,
+            'python_version': platform.python_version(),
+            'host': {
+                'system': platform.system(),
+                'release': platform.release(),
+                'machine': platform.machine(),
+                'cpus': host_cpus(),
+            },
+            'vmm': self.vmm,
+            'vmm_version': self.vmm_version(),
+            'accel': self.qemu_accel,
+            'vcpus': self.qemu_cpus,
+            'url': self.dist_url(),
+            'arch': self.dist.arch(),
+            'start': start,
+            'runs': runs,
+            'commands_per_run': commands,
+            'results': dict([(name, summarize(values))
+                             for name, values in samples.items()]),
+        }
+
     # Log in, if not logged in already
     def login(self):
         if self.is_logged_in:
             return
         login(self.child)
         self.is_logged_in = True
-
-    # Run a shell command and return its exit status
+        self.shell_prompt = None
+        self.set_phase('command')
+
+    # Run a shell command and return its exit status.  With the
+    # "framed" protocol, the shell is set up once per login, and each
+    # command is followed by one that reports its exit status, so
+    # that running it takes a single round trip over the console.
+    # The "classic" protocol sets up a new shell for each command,
+    # which keeps working if a command changes the shell or its
+    # prompt.
     def shell_cmd(self, cmd, timeout = -1, keepalive_patterns = None):
         self.login()
-        return shell_cmd(self.child, cmd, timeout, keepalive_patterns)
+        if self.shell_protocol == 'classic':
+            return shell_cmd(self.child, cmd, timeout, keepalive_patterns)
+        if self.shell_prompt is None:
+            self.shell_prompt = start_shell(self.child)
+        return framed_shell_cmd(self.child, cmd, self.shell_prompt,
+                                timeout, keepalive_patterns)
+
+    # Return true if the VM should be torn down without halting
+    # the guest.  By default, this is done when the system disk is
+    # snapshotted and so will be thrown away anyway.
+    def use_fast_teardown(self):
+        if self.vmm != 'qemu' or self.teardown == 'graceful':
+            return False
+        return self.teardown == 'fast' or self.system_disk_snapshotted
+
+    # Tear down the VM without halting the guest: flush the guest
+    # buffer cache so that any results written to disk make it to
+    # the disk images, then make qemu exit
+    def fast_halt(self):
+        start = time.time()
+        self.shell_cmd("sync")
+        self.qemu_quit()
+        self.halted = True
+        self.is_logged_in = False
+        self.post_halt_cleanup(gather = False)
+        self.slog("fast teardown took %.3f seconds" % (time.time() - start))
 
     # Halt the VM
     def halt(self):
         if self.halted:
             return
+        if self.use_fast_teardown():
+            self.set_phase('teardown')
+            self.fast_halt()
+            return
+        self.set_phase('halt')
         self.login()
         self.child.send("halt\n")
         try:
@@ -2805,13 +6852,15 @@ class Anita(object):
                                r'> ', # sparc64 firmware prompt
                                r'System halted!', # hppa
                                r'halted', # macppc
-                              ], timeout = 60)
+                              ], timeout = self.phase_timeout('halt', 60))
         except pexpect.EOF:
             # Didn't see the text but got an EOF; that's OK.
             print("EOF")
         except pexpect.TIMEOUT as e:
             # This is unexpected but mostly harmless
             print("timeout waiting for halt confirmation:", e)
+            if self.vmm == 'qemu':
+                self.slog("qemu status %s" % self.qemu_status())
         self.halted = True
         self.is_logged_in = False
         self.post_halt_cleanup()
@@ -2854,27 +6903,54 @@ def expect_with_keepalive(child, patterns, timeout, keepalive_patterns):
             break
     return i
 
-# Calling this directly is deprecated, use Anita.shell_cmd()
+# Like expect_with_keepalive(), but catch EOF to log the signalstatus,
+# to help debug qemu crashes
 
-def shell_cmd(child, cmd, timeout = -1, keepalive_patterns = None):
-    child.send("exec /bin/sh\n")
-    child.expect(r"# ")
-    prompt = gen_shell_prompt()
-    child.send("PS1=" + quote_prompt(prompt) + "\n")
-    prompt_re = prompt
-    child.expect(prompt_re)
-    child.send(cmd + "\n")
-    # Catch EOF to log the signalstatus, to help debug qemu crashes
+def expect_cmd_done(child, patterns, timeout, keepalive_patterns):
     try:
-        expect_with_keepalive(child, [prompt_re], timeout, keepalive_patterns)
+        return expect_with_keepalive(child, patterns, timeout, keepalive_patterns)
     except pexpect.EOF:
         print("pexpect reported EOF - VMM exited unexpectedly")
         child.close()
         print("exitstatus", child.exitstatus)
         print("signalstatus", child.signalstatus)
         raise
-    except:
-        raise
+
+# Start a Bourne shell with a distinctive prompt, and return the prompt
+
+def start_shell(child):
+    child.send("exec /bin/sh\n")
+    child.expect(r"# ")
+    prompt = gen_shell_prompt()
+    child.send("PS1=" + quote_prompt(prompt) + "\n")
+    child.expect(prompt)
+    return prompt
+
+# Run a shell command in a shell started by start_shell() with the
+# prompt "prompt", and return its exit status.  The command is sent
+# along with a second one echoing a marker containing the exit
+# status, so that no further round trips are needed.  The command
+# runs with its standard input redirected from /dev/null so that it
+# can't read the second one from the console.  The marker is quoted
+# like the prompt so that its echo is not mistaken for the output.
+
+def framed_shell_cmd(child, cmd, prompt, timeout = -1, keepalive_patterns = None):
+    marker = 'anita-cmd-done-%s' % str(time.time())
+    child.send("{ " + cmd + "\n} </dev/null; echo " + quote_prompt(marker) +
+               "=$?=\n")
+    expect_cmd_done(child, [re.escape(marker) + r"=(\d+)="], timeout,
+                    keepalive_patterns)
+    r = int(child.match.group(1))
+    child.expect(prompt, timeout)
+    return r
+
+# Calling this directly is deprecated, use Anita.shell_cmd()
+
+def shell_cmd(child, cmd, timeout = -1, keepalive_patterns = None):
+    prompt = start_shell(child)
+    prompt_re = prompt
+    child.send(cmd + "\n")
+    expect_cmd_done(child, [prompt_re], timeout, keepalive_patterns)
     child.send("echo exit_status=$?=\n")
     child.expect(r"exit_status=(\d+)=")
     r = int(child.match.group(1))